@@ -1,7 +1,16 @@
-import json
-import boto3
-from botocore.exceptions import NoCredentialsError
 import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import jsonCodec
+from metrics import metrics
+
+# requests that kept failing are moved here, listings never hand these keys out
+DEAD_LETTER_PREFIX = 'dead-letter/'
+# lease and member objects of consumers sharing the bucket, see leases.py
+LEASE_PREFIX = 'leases/'
 
 class S3Processor():
     def __init__():
@@ -13,16 +22,18 @@ class S3Processor():
     """
     def downloadBucket(session, bucket, key):
         requestObject = session.get_object(Bucket=bucket, Key=key)
-        data = requestObject['Body'].read().decode('utf-8')
-        return json.loads(data)
+        return jsonCodec.loads(requestObject['Body'].read())
 
         
     """
     Functions to determine if bucket is an s3 or dynamo table
     """
-    def does_s3_bucket_exist(bucket_name, region_name):
+    def does_s3_bucket_exist(bucket_name, region_name, s3=None):
+        from botocore.exceptions import NoCredentialsError
         try:
-            s3 = boto3.client('s3', region_name=region_name)
+            if s3 is None:
+                import boto3
+                s3 = boto3.client('s3', region_name=region_name)
             s3.head_bucket(Bucket=bucket_name)
             return True
         except NoCredentialsError:
@@ -31,17 +42,337 @@ class S3Processor():
             return False  
 
 
+class RequestLister():
+    """
+    Streams request keys from the source bucket in key order, one
+    ListObjectsV2 page at a time. Only the current page is held in memory.
+    Once a listing runs out, the next one resumes after the last key handed
+    out (StartAfter) instead of listing the bucket from the start again.
+    With owns(key) set, only the keys it accepts are handed out, e.g. the
+    keys of the partitions this consumer holds a lease on. Keys under the
+    skip prefixes are never handed out, they are not requests, and neither
+    are keys in skip_keys, e.g. a RequestAcker's written requests that are
+    not deleted yet.
+    """
+    def __init__(self, session, bucket, page_size=1000, owns=None, skip=(DEAD_LETTER_PREFIX, LEASE_PREFIX),
+                 skip_keys=None):
+        self.session = session
+        self.bucket = bucket
+        self.page_size = page_size
+        self.owns = owns
+        self.skip = tuple(skip)
+        self.skipKeys = skip_keys
+        self.keys = deque()
+        self.sizes = deque() # object sizes from the listing, in step with keys
+        self.lastKey = None
+        self.lastSize = 0
+        self.continuationToken = None
+        self.pages = 0 # pages listed so far
+
+
     """
-    Get request from source bucket and return a queue
+    Requests known to be waiting, the rest of this page plus a full page
+    when the listing says there are more
     """
-    def getRequestQueue(session, sourceBucket):
-        requestQueue = []
+    def backlog(self):
+        return len(self.keys) + (self.page_size if self.continuationToken else 0)
+
+
+    """
+    Return the next request key, or None if the bucket has nothing after the last key
+    """
+    def next_key(self):
+        if not self.keys:
+            self._list_page()
+            # a page can hold none of the keys this consumer owns
+            while not self.keys and self.continuationToken and self._list_page():
+                pass
+        return self.pop_key()
+
+
+    """
+    Start the next listing from the beginning of the bucket, used once the
+    bucket looks empty so keys that sort before the last one are not missed
+    """
+    def rewind(self):
+        self.keys.clear()
+        self.sizes.clear()
+        self.lastKey = None
+        self.continuationToken = None
+
+
+    """
+    A failed listing is logged and looks like an empty page, the caller
+    polls again the same way it does for an empty bucket. Returns False
+    when the listing failed
+    """
+    def _list_page(self):
         logging.info("Listing objects in bucket")
-        requests = session.list_objects(Bucket=sourceBucket)
-        if 'Contents' not in requests:
-            pass
-        else: # sort widgets with smallest key first and ad to queue 
-            requestQueue = sorted(requests['Contents'], key=lambda x: x['Key'])
-        return requestQueue
+        try:
+            with metrics.time('list'):
+                response = self.session.list_objects_v2(**self.page_params())
+        except Exception as e:
+            logging.error(f"Error listing objects in bucket {self.bucket}: {e}")
+            return False
+        self.add_page(response)
+        return True
+
+
+    """
+    Parameters for the next ListObjectsV2 call, and taking its response.
+    Split out so a caller can make the call itself, like the async engine
+    """
+    def page_params(self):
+        params = {'Bucket': self.bucket, 'MaxKeys': self.page_size}
+        if self.continuationToken:
+            params['ContinuationToken'] = self.continuationToken
+        elif self.lastKey is not None:
+            params['StartAfter'] = self.lastKey
+        return params
+
+
+    def add_page(self, response):
+        # ListObjectsV2 returns keys in ascending order, smallest key first
+        self.pages += 1
+        contents = response.get('Contents', [])
+        if self.skip:
+            contents = [item for item in contents if not item['Key'].startswith(self.skip)]
+        if self.owns is not None:
+            contents = [item for item in contents if self.owns(item['Key'])]
+        if self.skipKeys is not None:
+            contents = [item for item in contents if item['Key'] not in self.skipKeys]
+        self.keys.extend(item['Key'] for item in contents)
+        self.sizes.extend(item.get('Size', 0) for item in contents)
+        self.continuationToken = response.get('NextContinuationToken') if response.get('IsTruncated') else None
+
+
+    """
+    Next key from the current page without listing, None when the page is used up
+    """
+    def pop_key(self):
+        if not self.keys:
+            return None
+        self.lastKey = self.keys.popleft()
+        self.lastSize = self.sizes.popleft()
+        return self.lastKey
+
+
+class RequestAcker():
+    """
+    Collects the keys of requests that have been written and deletes them
+    from the source bucket with DeleteObjects, up to 1000 keys a call. A
+    key is only added once its write succeeded, so a request that was not
+    written stays in the bucket and is read again after a crash. Keys can
+    be added from several threads.
+
+    ready() is True once max_pending keys are waiting or the oldest key
+    has waited flush_interval seconds, max_pending None only waits for the
+    interval. `key in acker` is True from add(key) until the key is
+    deleted. A request whose write failed is read
+    again on the next pass over the bucket, and until then the widget it
+    belongs to is held back so its later requests are not written first.
+    With max_attempts set, a request that failed that many times is moved
+    to the dead letter prefix instead, never deleted.
+    """
+    def __init__(self, session, bucket, batch_size=1000, flush_interval=5.0, max_attempts=None,
+                 dead_letter_prefix=DEAD_LETTER_PREFIX, max_pending=1000):
+        self.session = session
+        self.bucket = bucket
+        self.batch_size = min(batch_size, 1000)
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.dead_letter_prefix = dead_letter_prefix
+        self.lock = threading.Lock()
+        self.keys = []
+        self.pendingKeys = set() # every key added and not deleted yet, including the ones being deleted
+        self.oldest = None
+        self.attempts = {} # key -> failed writes, only for keys that failed
+        self.heldWidgets = set() # widgets with a failed request in this pass
+
+
+    def add(self, key):
+        with self.lock:
+            if not self.keys:
+                self.oldest = time.monotonic()
+            self.keys.append(key)
+            self.pendingKeys.add(key)
+
+
+    def __contains__(self, key):
+        return key in self.pendingKeys
+
+
+    """
+    Record a failed write and hold back the rest of its widget's requests
+    for this pass. Returns True when the request has been moved to the dead
+    letter prefix, False while it should be read again
+    """
+    def failed(self, key, widgetId=None):
+        with self.lock:
+            attempts = self.attempts[key] = self.attempts.get(key, 0) + 1
+            if widgetId is not None:
+                self.heldWidgets.add(widgetId)
+        if self.max_attempts is None or attempts < self.max_attempts:
+            return False
+        logging.error(f"Giving up on request {key} after {attempts} failed writes, moving it to {self.dead_letter_prefix}")
+        try:
+            self.session.copy_object(Bucket=self.bucket, Key=f"{self.dead_letter_prefix}{key}",
+                                     CopySource={'Bucket': self.bucket, 'Key': key})
+        except Exception as e:
+            # left where it is and read again
+            logging.error(f"Error moving request {key} to {self.dead_letter_prefix}: {e}")
+            return False
+        metrics.inc('requests_given_up')
+        self.add(key)
+        return True
+
+
+    """
+    True while an earlier request of the widget failed in this pass
+    """
+    def held(self, widgetId):
+        return widgetId in self.heldWidgets
+
+
+    """
+    A new pass over the bucket starts, the failed requests come first again
+    """
+    def rewind(self):
+        with self.lock:
+            self.heldWidgets = set()
+
+
+    def ready(self):
+        with self.lock:
+            return (self.max_pending is not None and len(self.keys) >= self.max_pending) or (
+                bool(self.keys) and time.monotonic() - self.oldest >= self.flush_interval)
+
+
+    """
+    Delete every collected key. commit() is called first to make the
+    writes of those keys durable, e.g. flushing a batching destination.
+    When commit() fails nothing is deleted, and keys that could not be
+    deleted are kept, both are tried again on the next flush
+    """
+    def flush(self, commit=None):
+        with self.lock:
+            keys = self.keys
+            self.keys = []
+            self.oldest = None
+        if not keys:
+            return
+        if commit is not None:
+            try:
+                commit()
+            except Exception as e:
+                logging.error(f"Error committing the writes of {len(keys)} requests, keeping them: {e}")
+                with self.lock:
+                    self.keys[:0] = keys
+                    self.oldest = time.monotonic()
+                return
+        for start in range(0, len(keys), self.batch_size):
+            self._delete(keys[start:start + self.batch_size])
+
+
+    def _delete(self, keys):
+        try:
+            with metrics.time('source_delete'):
+                response = self.session.delete_objects(
+                    Bucket=self.bucket, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+        except Exception as e:
+            logging.error(f"Error deleting {len(keys)} requests from bucket {self.bucket}: {e}")
+            retry = keys
+        else:
+            retry = [error['Key'] for error in response.get('Errors', [])]
+            for error in response.get('Errors', []):
+                logging.error(f"Error deleting request {error['Key']}: {error.get('Code')} {error.get('Message')}")
+        metrics.inc('source_deleted', len(keys) - len(retry))
+
+        with self.lock:
+            for key in keys:
+                self.attempts.pop(key, None)
+            self.pendingKeys.difference_update(keys)
+            self.pendingKeys.update(retry)
+            if retry:
+                if not self.keys:
+                    self.oldest = time.monotonic()
+                self.keys.extend(retry)
+
+
+class RequestPrefetcher():
+    """
+    Keeps the next depth requests downloading and decoding on background
+    threads while the caller writes the current one. Requests come back in
+    key order. max_bytes caps the listed size of the requests held at once,
+    one request is always allowed so a large object cannot stall the loop.
+    fetch(key) downloads and decodes one request.
+    """
+    def __init__(self, lister, fetch, depth=8, max_bytes=8 * 1024 * 1024, threads=None):
+        self.lister = lister
+        self.fetch = fetch
+        self.depth = depth # can be changed between calls, up to threads
+        self.max_bytes = max_bytes
+        self.downloads = deque() # (key, size, future)
+        self.bytes = 0
+        self.held = None # next key and size, listed but over the byte cap
+        self.listedOut = False
+        self.executor = ThreadPoolExecutor(max_workers=threads or depth)
+
+
+    def __len__(self):
+        return len(self.downloads)
+
+
+    """
+    Start downloads until depth or max_bytes is reached or the listing runs out
+    """
+    def fill(self):
+        while len(self.downloads) < self.depth:
+            if self.held is None:
+                if self.listedOut:
+                    return
+                key = self.lister.next_key()
+                if key is None:
+                    self.listedOut = True
+                    return
+                self.held = (key, self.lister.lastSize)
+            key, size = self.held
+            if self.downloads and self.bytes + size > self.max_bytes:
+                return
+            self.held = None
+            self.bytes += size
+            logging.info(f"Downloading request: {key}")
+            self.downloads.append((key, size, self.executor.submit(self.fetch, key)))
+
+
+    """
+    Next (key, future) in key order, None once the listing is used up and
+    every download has been handed out. The future holds fetch's result
+    """
+    def next(self):
+        self.fill()
+        if not self.downloads:
+            return None
+        key, size, download = self.downloads.popleft()
+        self.bytes -= size
+        self.fill()
+        return key, download
+
+
+    """
+    List from the start of the bucket again on the next call, downloads
+    that were not handed out yet are dropped
+    """
+    def rewind(self):
+        for key, size, download in self.downloads:
+            download.cancel()
+        self.downloads.clear()
+        self.bytes = 0
+        self.lister.rewind()
+        self.held = None
+        self.listedOut = False
 
 
+    def close(self):
+        self.executor.shutdown()
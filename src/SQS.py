@@ -1,18 +1,31 @@
-import boto3
 import logging
+import time
+
+from metrics import metrics
 
 class SQSHandler:
-    def __init__(self, queue_url, region_name='us-east-1'):
-        self.sqs = boto3.client('sqs', region_name=region_name)
+    def __init__(self, queue_url, region_name='us-east-1', wait_time=20, visibility_timeout=None, sqs=None):
+        if sqs is None:
+            import boto3
+            sqs = boto3.client('sqs', region_name=region_name)
+        self.sqs = sqs
         self.queue_url = queue_url
+        self.wait_time = wait_time # long poll, seconds to wait for a message to arrive
+        self.visibility_timeout = visibility_timeout # None keeps the queue's own setting
 
     def receive_messages(self, max_number=10):
         try:
-            response = self.sqs.receive_message(
-                QueueUrl=self.queue_url,
-                MaxNumberOfMessages=max_number
-            )
+            params = {
+                'QueueUrl': self.queue_url,
+                'MaxNumberOfMessages': max_number,
+                'WaitTimeSeconds': self.wait_time,
+            }
+            if self.visibility_timeout is not None:
+                params['VisibilityTimeout'] = self.visibility_timeout
+            with metrics.time('receive'):
+                response = self.sqs.receive_message(**params)
             messages = response.get('Messages', [])
+            metrics.inc('messages_received', len(messages))
             return messages
         except Exception as e:
             logging.error(f"Error receiving messages from SQS: {e}")
@@ -27,5 +40,111 @@ class SQSHandler:
         except Exception as e:
             logging.error(f"Error deleting message from SQS: {e}")
 
-    # Other SQS-related methods can be added here based on your requirements
+    """
+    Delete messages 10 at a time with DeleteMessageBatch. Entries that fail
+    on the server side are retried, the rest are logged. Returns the
+    messages that could not be deleted
+    """
+    def delete_messages(self, messages, retries=2):
+        failed = []
+        for start in range(0, len(messages), 10):
+            chunk = messages[start:start + 10]
+            for attempt in range(retries + 1):
+                chunk = self._delete_batch(chunk, failed)
+                if not chunk or attempt == retries:
+                    break
+            for message in chunk:
+                logging.error(f"Could not delete message from SQS: {message['MessageId']}")
+            failed.extend(chunk)
+        return failed
+
+    """
+    Make messages visible again right away, used for messages that were
+    received but will not be processed
+    """
+    def release_messages(self, messages):
+        for start in range(0, len(messages), 10):
+            entries = [{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle'], 'VisibilityTimeout': 0}
+                       for i, message in enumerate(messages[start:start + 10])]
+            try:
+                self.sqs.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+            except Exception as e:
+                logging.error(f"Error releasing messages to SQS: {e}")
+
+    """
+    Messages waiting to be received, as SQS estimates it. 0 when the
+    attribute cannot be read so a scaler falls back to its minimum
+    """
+    def approximate_backlog(self):
+        try:
+            response = self.sqs.get_queue_attributes(QueueUrl=self.queue_url,
+                                                     AttributeNames=['ApproximateNumberOfMessages'])
+            return int(response['Attributes']['ApproximateNumberOfMessages'])
+        except Exception as e:
+            logging.error(f"Error reading SQS queue attributes: {e}")
+            return 0
+
+    def _delete_batch(self, messages, failed):
+        entries = [{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']}
+                   for i, message in enumerate(messages)]
+        try:
+            with metrics.time('ack'):
+                response = self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+        except Exception as e:
+            logging.error(f"Error deleting messages from SQS: {e}")
+            return messages
+
+        retry = []
+        for failure in response.get('Failed', []):
+            message = messages[int(failure['Id'])]
+            if failure.get('SenderFault'):
+                # a bad receipt handle will not get better by retrying
+                logging.error(f"Error deleting message {message['MessageId']} from SQS: {failure.get('Message')}")
+                failed.append(message)
+            else:
+                retry.append(message)
+        return retry
+
+
+class MessageAcker():
+    """
+    Collects the messages of one receive loop whose writes have been made
+    and deletes them once the destination has committed them. With
+    flush_interval 0 the messages of every receive are deleted right after
+    it, a longer interval lets a batching destination like the S3 snapshot
+    writer commit once for many receives. Keep it well under the visibility
+    timeout, or the messages are delivered again before they are deleted.
+    """
+    def __init__(self, sqs_handler, flush_interval=0.0):
+        self.sqs_handler = sqs_handler
+        self.flush_interval = flush_interval
+        self.messages = []
+        self.oldest = None
+
+
+    def add(self, messages):
+        if messages and not self.messages:
+            self.oldest = time.monotonic()
+        self.messages.extend(messages)
+
+
+    def ready(self):
+        return bool(self.messages) and time.monotonic() - self.oldest >= self.flush_interval
+
 
+    """
+    Delete every collected message after commit() made their writes
+    durable. When commit() fails the messages are kept for the next flush
+    """
+    def flush(self, commit=None):
+        if not self.messages:
+            return
+        if commit is not None:
+            try:
+                commit()
+            except Exception as e:
+                logging.error(f"Error committing the writes of {len(self.messages)} messages, keeping them: {e}")
+                self.oldest = time.monotonic()
+                return
+        messages, self.messages = self.messages, []
+        self.sqs_handler.delete_messages(messages)
@@ -0,0 +1,360 @@
+"""
+asyncio version of the consumer. A source, a transform stage and a sink
+run as tasks connected by bounded asyncio.Queues, so a slow stage holds the
+others back instead of letting requests pile up in memory.
+
+    source     lists/receives requests and starts their downloads
+    transform  decodes requests in order and turns them into destination calls
+    sink       one lane per concurrency slot, a widget always uses the same
+               lane so its requests are applied in order, then acks the source
+
+A source is any object with these async methods. requests(idle) yields
+(token, body) pairs in order, where body is an awaitable that returns the
+raw request bytes, and idle() returns once every request handed out so
+far has been acked. ack(token) is awaited once a request has been
+written, close() at the end. S3Source reads the request bucket,
+SQSSource a queue.
+
+Backends are async clients with the same method names, parameters and
+responses as the boto3 clients. AsyncClient runs a real boto3 client on a
+thread pool, localBackends.AsyncLocalClient is the in-process stand-in.
+"""
+import asyncio
+import functools
+import io
+import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import requestTransformer
+from metrics import metrics
+from requestValidator import get_validator
+from S3Processor import RequestLister
+
+
+class AsyncClient():
+    """
+    Async backend over a blocking boto3 client, every call runs on a thread
+    pool sized for the engine's concurrency
+    """
+    def __init__(self, client, max_workers=32):
+        self.client = client
+        self.meta = client.meta
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        async def call(**params):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(method, **params))
+        return call
+
+
+    """
+    Read the body on the pool too, so reading it later does not block the loop
+    """
+    async def get_object(self, **params):
+        def get():
+            response = self.client.get_object(**params)
+            response['Body'] = io.BytesIO(response['Body'].read())
+            return response
+        return await asyncio.get_running_loop().run_in_executor(self.executor, get)
+
+
+class S3Source():
+    def __init__(self, s3, bucket, empty_polls=10, poll_interval=0.5, page_size=1000):
+        self.s3 = s3
+        self.bucket = bucket
+        self.empty_polls = empty_polls
+        self.poll_interval = poll_interval
+        self.lister = RequestLister(s3, bucket, page_size)
+
+
+    async def requests(self, idle):
+        stop_times = self.empty_polls
+        while True:
+            requestKey = self.lister.pop_key()
+            if requestKey is None:
+                logging.info("Listing objects in bucket")
+                with metrics.time('list'):
+                    self.lister.add_page(await self.s3.list_objects_v2(**self.lister.page_params()))
+                requestKey = self.lister.pop_key()
+
+            if requestKey is None:
+                # let in-flight requests be deleted before listing from the start again
+                await idle()
+                logging.info("No requests to process, checking for more")
+                self.lister.rewind()
+                stop_times -= 1
+                await asyncio.sleep(self.poll_interval)
+                if stop_times == 0:
+                    logging.info("Finished processing requests, Stopping")
+                    return
+                continue
+
+            logging.info(f"Downloading request: {requestKey}")
+            yield requestKey, self._download(requestKey)
+
+
+    async def ack(self, token):
+        with metrics.time('source_delete'):
+            await self.s3.delete_object(Bucket=self.bucket, Key=token)
+
+
+    async def close(self):
+        pass
+
+
+    async def _download(self, key):
+        with metrics.time('download'):
+            response = await self.s3.get_object(Bucket=self.bucket, Key=key)
+        return response['Body'].read()
+
+
+class SQSSource():
+    def __init__(self, sqs, queue_url, wait_time=20, visibility_timeout=None, empty_receives=3, ack_interval=1.0):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.wait_time = wait_time
+        self.visibility_timeout = visibility_timeout
+        self.empty_receives = empty_receives
+        self.ack_interval = ack_interval
+        self.acks = []
+        self.flusher = None
+
+
+    async def requests(self, idle):
+        params = {'QueueUrl': self.queue_url, 'MaxNumberOfMessages': 10, 'WaitTimeSeconds': self.wait_time}
+        if self.visibility_timeout is not None:
+            params['VisibilityTimeout'] = self.visibility_timeout
+        stop_times = self.empty_receives
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self._flush_every())
+        while True:
+            messages = (await self.sqs.receive_message(**params)).get('Messages', [])
+            if not messages:
+                await self._flush_acks()
+                stop_times -= 1
+                if stop_times == 0:
+                    logging.info("No messages to process, stopping")
+                    return
+                continue
+            stop_times = self.empty_receives
+            for message in messages:
+                logging.info(f"Processing message: {message['MessageId']}")
+                yield message, _ready(message['Body'])
+
+
+    """
+    Acks are deleted 10 at a time with DeleteMessageBatch. A remainder is
+    deleted every ack_interval seconds and on every empty receive, long
+    before the messages would become visible again
+    """
+    async def ack(self, token):
+        self.acks.append(token)
+        if len(self.acks) >= 10:
+            await self._delete_acks()
+
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            try:
+                await self.flusher
+            except asyncio.CancelledError:
+                pass
+            self.flusher = None
+        await self._flush_acks()
+
+
+    async def _flush_every(self):
+        while True:
+            await asyncio.sleep(self.ack_interval)
+            try:
+                await self._flush_acks()
+            except Exception as e:
+                logging.error(f"Error deleting messages from SQS: {e}")
+
+
+    async def _flush_acks(self):
+        while self.acks:
+            await self._delete_acks()
+
+
+    async def _delete_acks(self):
+        messages, self.acks = self.acks[:10], self.acks[10:]
+        entries = [{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']} for i, message in enumerate(messages)]
+        response = await self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+        for failure in response.get('Failed', []):
+            logging.error(f"Error deleting message {messages[int(failure['Id'])]['MessageId']} from SQS: {failure.get('Message')}")
+
+
+async def _ready(value):
+    return value
+
+
+def check_type(request):
+    if request['type'] not in ('create', 'update', 'delete'):
+        raise ValueError(f"Unknown request type: {request['type']}")
+
+
+"""
+Transform stage functions, turn a decoded request into the destination call
+(method name and parameters) the sink should make
+"""
+def transform_for_s3(request, bucket):
+    check_type(request)
+    if request['type'] == 'delete':
+        return 'delete_object', {'Bucket': bucket, 'Key': requestTransformer.s3_key(request)}
+    key, body = requestTransformer.to_s3_object(request)
+    return 'put_object', {'Bucket': bucket, 'Key': key, 'Body': body}
+
+
+def transform_for_dynamo(request, table):
+    check_type(request)
+    if request['type'] == 'delete':
+        return 'delete_item', {'TableName': table, 'Key': {'id': {'S': request['widgetId']}}}
+    if request['type'] == 'create':
+        return 'put_item', {'TableName': table, 'Item': requestTransformer.to_dynamo_item(request)}
+    return 'update_item', requestTransformer.to_dynamo_update(request, table)
+
+
+class AsyncEngine():
+    def __init__(self, source, sink, transform, concurrency=100):
+        self.source = source
+        self.sink = sink
+        self.transform = transform
+        self.concurrency = concurrency
+        self.errors = 0
+        self.processed = 0
+
+
+    async def run(self):
+        # downloads in flight are capped by the fetch queue, lanes by their own queues
+        self.fetched = asyncio.Queue(maxsize=self.concurrency)
+        self.lanes = [asyncio.Queue(maxsize=2) for _ in range(self.concurrency)]
+        self.outstanding = 0
+        self.drained = asyncio.Event()
+        self.drained.set()
+
+        lanes = [asyncio.create_task(self._lane(lane)) for lane in self.lanes]
+        transform = asyncio.create_task(self._transform())
+        metrics.gauge('queue_depth', self.fetched.qsize)
+        metrics.gauge('in_flight', lambda: self.outstanding)
+        try:
+            async for token, body in self.source.requests(self._idle):
+                self.outstanding += 1
+                self.drained.clear()
+                await self.fetched.put((token, asyncio.ensure_future(body)))
+            await self.fetched.put(None)
+            await transform
+            for lane in self.lanes:
+                await lane.put(None)
+            await asyncio.gather(*lanes)
+        finally:
+            metrics.remove_gauge('queue_depth')
+            metrics.remove_gauge('in_flight')
+            transform.cancel()
+            for lane in lanes:
+                lane.cancel()
+            await self.source.close()
+
+
+    async def _idle(self):
+        await self.drained.wait()
+
+
+    def _done(self):
+        self.outstanding -= 1
+        if self.outstanding == 0:
+            self.drained.set()
+
+
+    async def _transform(self):
+        while True:
+            item = await self.fetched.get()
+            if item is None:
+                return
+            token, body = item
+            try:
+                body = await body
+                with metrics.time('decode'):
+                    request, errors = get_validator().check(body)
+                if errors:
+                    # invalid requests are acked so they are not read again
+                    metrics.inc('requests', outcome='rejected')
+                    self.errors += 1
+                    logging.error(f"Rejected request {token}: {'; '.join(errors)}")
+                    await self.source.ack(token)
+                    self._done()
+                    continue
+                widgetId = request['widgetId']
+                call = self.transform(request)
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"Error reading request {token}: {e}")
+                self._done()
+                continue
+            lane = self.lanes[zlib.crc32(widgetId.encode('utf-8')) % len(self.lanes)]
+            await lane.put((token, call, request['type']))
+
+
+    async def _lane(self, lane):
+        while True:
+            item = await lane.get()
+            if item is None:
+                return
+            token, (method, params), requestType = item
+            try:
+                with metrics.time('write', type=requestType):
+                    await getattr(self.sink, method)(**params)
+                await self.source.ack(token)
+                metrics.inc('requests', type=requestType, outcome='processed')
+                self.processed += 1
+            except Exception as e:
+                metrics.inc('requests', type=requestType, outcome='failed')
+                self.errors += 1
+                logging.error(f"Error processing request {token}: {e}")
+            finally:
+                self._done()
+
+
+"""
+Build the engine for a bucket or SQS source and an S3 or DynamoDB destination
+"""
+def make_engine(dest, destBucket, source=None, sourceBucket=None, sqs=None, queue_url=None,
+                concurrency=100, **source_options):
+    if sqs is not None:
+        requestSource = SQSSource(sqs, queue_url, **source_options)
+    else:
+        requestSource = S3Source(source, sourceBucket, **source_options)
+
+    if dest.meta.service_model.service_name == "dynamodb":
+        transform = functools.partial(transform_for_dynamo, table="widgets")
+    else:
+        transform = functools.partial(transform_for_s3, bucket=destBucket)
+    return AsyncEngine(requestSource, dest, transform, concurrency)
+
+
+"""
+Run the async engine with boto3 clients, used by consumer.py --engine async
+"""
+def run_async(dest_session, destBucket, source_session=None, sourceBucket=None, queue_url=None,
+              concurrency=100, visibility_timeout=None, sqs_client=None):
+    dest = AsyncClient(dest_session, concurrency)
+    if queue_url:
+        if sqs_client is None:
+            from clientRegistry import get_registry
+            sqs_client = get_registry().client('sqs')
+        sqs = AsyncClient(sqs_client, concurrency)
+        engine = make_engine(dest, destBucket, sqs=sqs, queue_url=queue_url, concurrency=concurrency,
+                             visibility_timeout=visibility_timeout)
+    else:
+        source = AsyncClient(source_session, concurrency)
+        engine = make_engine(dest, destBucket, source=source, sourceBucket=sourceBucket,
+                             concurrency=concurrency)
+    asyncio.run(engine.run())
+    logging.info(f"Processed {engine.processed} requests, {engine.errors} errors")
+    return engine
@@ -0,0 +1,74 @@
+import math
+import time
+
+
+class IdlePoller():
+    """
+    Decides how long to wait after a poll that found no work. The wait
+    starts at interval and doubles on every further empty poll up to
+    max_interval, and goes straight back to interval as soon as work shows
+    up. With stop_after set, the loop stops after that many empty polls in
+    a row, None keeps it running until it is killed.
+    """
+    def __init__(self, interval=0.5, max_interval=20.0, factor=2.0, stop_after=10):
+        self.interval = interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.stop_after = stop_after
+        self.idlePolls = 0
+
+
+    """
+    Work was found, poll again right away from now on
+    """
+    def busy(self):
+        self.idlePolls = 0
+
+
+    """
+    Record an empty poll, return False once the loop should stop
+    """
+    def idle(self):
+        self.idlePolls += 1
+        return self.stop_after is None or self.idlePolls < self.stop_after
+
+
+    def wait_time(self):
+        if self.idlePolls == 0:
+            return 0
+        return min(self.max_interval, self.interval * self.factor ** (self.idlePolls - 1))
+
+
+    def wait(self):
+        seconds = self.wait_time()
+        if seconds:
+            time.sleep(seconds)
+
+
+class BacklogScaler():
+    """
+    Picks how many workers to run for the observed backlog, one worker for
+    every per_worker waiting requests, kept between min_workers and
+    max_workers. Scaling up happens at once so a spike is drained quickly,
+    scaling down halves at most once per cooldown seconds so a short gap
+    between bursts does not throw the workers away.
+    """
+    def __init__(self, min_workers=1, max_workers=16, per_worker=10, cooldown=30.0):
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.per_worker = per_worker
+        self.cooldown = cooldown
+        self.workers = min_workers
+        self.lastDown = time.monotonic()
+
+
+    def target(self, backlog):
+        wanted = min(self.max_workers, max(self.min_workers, math.ceil(backlog / self.per_worker)))
+        now = time.monotonic()
+        if wanted > self.workers:
+            self.workers = wanted
+            self.lastDown = now
+        elif wanted < self.workers and now - self.lastDown >= self.cooldown:
+            self.workers = max(wanted, self.workers // 2, self.min_workers)
+            self.lastDown = now
+        return self.workers
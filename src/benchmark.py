@@ -0,0 +1,771 @@
+"""
+Throughput benchmarks for the consumer, run against the in-process
+stand-ins in localBackends so no AWS account is needed.
+
+Example:
+    python3 benchmark.py workers -n 2000 --latency 0.005 --workers 1 4 16
+    python3 benchmark.py e2e -n 100000 --mode run sqs --latency 0.001
+"""
+import argparse
+import asyncio
+import copy
+import functools
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import threading
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+import uuid
+from collections import defaultdict, deque
+
+import consumer
+import jsonCodec
+import requestTransformer
+from asyncEngine import make_engine
+from dynamoDBProcessor import dynamoDBProcessor
+from dynamoBatchWriter import DynamoBatchWriter
+from leases import LeaseManager
+from throttle import AdaptiveLimiter, ThrottledClient
+from writeCache import WriteCache
+from localBackends import AsyncLocalClient, LocalDynamoDB, LocalS3, LocalSQS
+from metrics import metrics
+from shardedConsumer import run_sharded, widget_id_of
+from SQS import SQSHandler
+from requestValidator import get_validator
+from S3Processor import RequestLister
+from widgetRequest import WidgetRequest
+
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(os.path.dirname(__file__))), 'sample-requests')
+
+
+"""
+Load the valid requests from the sample-requests folder to use as templates
+"""
+def load_sample_requests(path=SAMPLE_DIR):
+    samples = []
+    for name in sorted(os.listdir(path)):
+        try:
+            with open(os.path.join(path, name)) as f:
+                request = json.load(f)
+        except ValueError:
+            continue
+        if request.get('type') in ('create', 'update') and 'owner' in request:
+            samples.append(request)
+    return samples
+
+
+"""
+Build n requests spread over a set of widgets. The first request for a widget
+is a create, the rest are updates, and every widget's requests stay in key order
+"""
+def synthetic_requests(n, widgets=None):
+    samples = load_sample_requests()
+    widgetIds = [str(uuid.uuid4()) for _ in range(widgets or max(1, n // 4))]
+    seen = set()
+    requests = []
+    for i in range(n):
+        template = samples[i % len(samples)]
+        widgetId = widgetIds[i % len(widgetIds)]
+        request = {
+            'type': 'update' if widgetId in seen else 'create',
+            'requestId': str(uuid.uuid4()),
+            'widgetId': widgetId,
+            'owner': template['owner'],
+            'description': template['description'],
+            'otherAttributes': template['otherAttributes'],
+        }
+        if request['type'] == 'create':
+            request['label'] = template.get('label', 'LABEL')
+        seen.add(widgetId)
+        requests.append(request)
+    return requests
+
+
+"""
+Raw request bodies from a corpus, either a JSON lines file with one request
+per line or a folder with one request per file like sample-requests.
+Bodies are kept as they are, invalid ones included
+"""
+def load_corpus(path):
+    if os.path.isdir(path):
+        bodies = []
+        for name in sorted(os.listdir(path)):
+            with open(os.path.join(path, name), 'rb') as f:
+                bodies.append(f.read())
+        return bodies
+    with open(path, 'rb') as f:
+        return [line.rstrip(b'\r\n') for line in f if line.strip()]
+
+
+"""
+Put the requests in the bucket with increasing timestamp style keys,
+requests can be dicts or raw bodies
+"""
+def seed_bucket(s3, bucket, requests, start=1612306368338):
+    s3.create_bucket(Bucket=bucket)
+    for i, request in enumerate(requests):
+        body = request if isinstance(request, (str, bytes)) else json.dumps(request)
+        s3.put_object(Bucket=bucket, Key=str(start + i), Body=body)
+    s3.calls.clear()
+
+
+def make_destination(kind, latency, **faults):
+    if kind == 'dynamodb':
+        dest = LocalDynamoDB(latency, **faults)
+        dest.create_table(TableName='widgets')
+        return dest, 'widgets'
+    dest = LocalS3(latency, **faults)
+    dest.create_bucket(Bucket='widget-bucket')
+    return dest, 'widget-bucket'
+
+
+def local_destination(kind, latency):
+    return make_destination(kind, latency)[0]
+
+
+def bench_workers(args):
+    requests = synthetic_requests(args.n, args.widgets)
+    print(f"{args.n} requests, {args.latency * 1000:.1f} ms per call, destination {args.dest}")
+    for workers in args.workers:
+        source = LocalS3(args.latency)
+        seed_bucket(source, 'request-bucket', requests)
+        local, destBucket = make_destination(args.dest, args.latency)
+        dest = DynamoBatchWriter(local) if args.batch and args.dest == 'dynamodb' else local
+
+        start = time.perf_counter()
+        consumer.run(source, 'request-bucket', dest, destBucket,
+                     workers=workers, empty_polls=1, poll_interval=0)
+        consumer.flush_destination(dest, close=True)
+        elapsed = time.perf_counter() - start
+        print(f"  workers={workers:<3} {elapsed:7.2f} s  {args.n / elapsed:9.1f} req/s  "
+              f"destination calls {sum(local.calls.values())}")
+
+
+def bench_sqs(args):
+    requests = synthetic_requests(args.n, args.widgets)
+    sqs = LocalSQS(args.latency)
+    for request in requests:
+        sqs.send_message(QueueUrl='local', MessageBody=json.dumps(request))
+    sqs.calls.clear()
+    local, destBucket = make_destination(args.dest, args.latency)
+    dest = DynamoBatchWriter(local) if args.batch and args.dest == 'dynamodb' else local
+
+    start = time.perf_counter()
+    consumer.run_consumer_with_sqs('local', dest, destBucket, empty_receives=1,
+                                   sqs_handler=SQSHandler('local', wait_time=0.1, sqs=sqs))
+    consumer.flush_destination(dest, close=True)
+    elapsed = time.perf_counter() - start
+    print(f"{args.n} messages, {args.latency * 1000:.1f} ms per call, destination {args.dest}")
+    print(f"  {elapsed:7.2f} s  {args.n / elapsed:9.1f} msg/s  "
+          f"SQS calls {sum(sqs.calls.values())} ({sum(sqs.calls.values()) / args.n:.2f} per message)  "
+          f"destination calls {sum(local.calls.values())}")
+
+
+def bench_async(args):
+    requests = synthetic_requests(args.n, args.widgets)
+    print(f"{args.n} requests, {args.latency * 1000:.1f} ms per call, destination {args.dest}, asyncio engine")
+    for concurrency in args.concurrency:
+        source = LocalS3()
+        seed_bucket(source, 'request-bucket', requests)
+        local, destBucket = make_destination(args.dest, 0)
+        engine = make_engine(AsyncLocalClient(local, args.latency), destBucket,
+                             source=AsyncLocalClient(source, args.latency), sourceBucket='request-bucket',
+                             concurrency=concurrency, empty_polls=1, poll_interval=0)
+
+        start = time.perf_counter()
+        asyncio.run(engine.run())
+        elapsed = time.perf_counter() - start
+        print(f"  concurrency={concurrency:<4} {elapsed:7.2f} s  {args.n / elapsed:9.1f} req/s  errors {engine.errors}")
+
+
+def bench_processes(args):
+    requests = synthetic_requests(args.n, args.widgets)
+    print(f"{args.n} requests, {args.latency * 1000:.1f} ms per destination call, destination {args.dest}, "
+          f"{os.cpu_count()} cpus")
+    for processes in args.processes:
+        source = LocalS3()
+        seed_bucket(source, 'request-bucket', requests)
+        destBucket = make_destination(args.dest, 0)[1]
+
+        start = time.perf_counter()
+        sharded = run_sharded(source, 'request-bucket', functools.partial(local_destination, args.dest, args.latency),
+                              destBucket, processes, empty_polls=1, poll_interval=0)
+        elapsed = time.perf_counter() - start
+        print(f"  processes={processes:<3} {elapsed:7.2f} s  {args.n / elapsed:9.1f} req/s  "
+              f"per worker {sharded.per_worker}")
+
+
+"""
+Several consumers on one request bucket, as threads sharing the local
+stand-ins. Without leases they all read the same keys, with leases each
+works its own partitions. Duplicates are destination writes beyond one
+per request
+"""
+def bench_leases(args):
+    requests = synthetic_requests(args.n, args.widgets)
+    print(f"{args.n} requests, {args.latency * 1000:.1f} ms per call, {args.partitions} partitions")
+    for leased in (False, True):
+        for consumers in args.consumers:
+            source = LocalS3(args.latency)
+            seed_bucket(source, 'request-bucket', requests)
+            local, destBucket = make_destination('dynamodb', args.latency)
+            managers = [LeaseManager(source, 'request-bucket', args.partitions, owner=f"consumer-{i}")
+                        for i in range(consumers)] if leased else []
+            # two rounds, the first consumers let go of what the later ones are owed
+            for manager in managers + managers:
+                manager.refresh()
+
+            start = time.perf_counter()
+            runs = [threading.Thread(target=consumer.run, args=(source, 'request-bucket', local, destBucket),
+                                     kwargs={'empty_polls': 1, 'poll_interval': 0,
+                                             'owns': managers[i].owns if leased else None})
+                    for i in range(consumers)]
+            for run in runs:
+                run.start()
+            for run in runs:
+                run.join()
+            elapsed = time.perf_counter() - start
+            writes = local.calls.get('put_item', 0) + local.calls.get('update_item', 0) + local.calls.get('delete_item', 0)
+            print(f"  {'leases' if leased else 'racing'} consumers={consumers:<3} {elapsed:7.2f} s  "
+                  f"{args.n / elapsed:9.1f} req/s  duplicate writes {writes - args.n}  "
+                  f"get_object {source.calls.get('get_object', 0)}")
+
+
+"""
+Request bucket loop against a table with limited write capacity, writing
+as fast as it can or through the adaptive rate controller
+"""
+def bench_throttle(args):
+    requests = synthetic_requests(args.n, args.widgets)
+    print(f"{args.n} requests, {args.latency * 1000:.1f} ms per call, {args.capacity} write units/s, {args.workers} workers")
+    for controlled in (False, True):
+        source = LocalS3(args.latency)
+        seed_bucket(source, 'request-bucket', requests)
+        local = LocalDynamoDB(args.latency, capacity=args.capacity)
+        local.create_table(TableName='widgets')
+        dest = local
+        if controlled:
+            limiter = AdaptiveLimiter(args.rate, concurrency=args.workers)
+            dest = ThrottledClient(local, limiter)
+        if args.batch:
+            dest = DynamoBatchWriter(dest)
+
+        failed = sum(value for (name, labels), value in metrics.counters.items()
+                     if name == 'requests' and ('outcome', 'failed') in labels)
+        start = time.perf_counter()
+        consumer.run(source, 'request-bucket', dest, 'widgets', workers=args.workers, empty_polls=2, poll_interval=0)
+        consumer.flush_destination(dest, close=True)
+        elapsed = time.perf_counter() - start
+        # failed writes stay in the bucket and are read again on a later pass
+        failed = sum(value for (name, labels), value in metrics.counters.items()
+                     if name == 'requests' and ('outcome', 'failed') in labels) - failed
+        print(f"  {'adaptive' if controlled else 'unpaced':<8} {elapsed:7.2f} s  {args.n / elapsed:8.1f} req/s  "
+              f"{local.consumed / elapsed:7.1f} units/s  throttled calls {sum(local.failures.values())}  "
+              f"failed writes {failed}  left in bucket {len(source.buckets['request-bucket'])}"
+              + (f"  final rate {limiter.rate:.1f}" if controlled else ''))
+
+
+"""
+Request bucket loop on traffic where a share of the updates re-send what
+the widget already holds, with and without the write cache
+"""
+def bench_unchanged(args):
+    requests = synthetic_requests(args.n, args.widgets)
+    rng = random.Random(1)
+    last = {}
+    for request in requests:
+        previous = last.get(request['widgetId'])
+        if previous is not None and request['type'] == 'update' and rng.random() < args.repeat:
+            request.update({name: previous[name] for name in ('owner', 'description', 'otherAttributes')})
+        if request['type'] == 'update':
+            last[request['widgetId']] = request
+    print(f"{args.n} requests, {args.latency * 1000:.1f} ms per call, destination {args.dest}, "
+          f"{args.repeat:.0%} of updates repeated")
+    for cached in (False, True):
+        source = LocalS3(args.latency)
+        seed_bucket(source, 'request-bucket', requests)
+        local, destBucket = make_destination(args.dest, args.latency)
+        dest = WriteCache(local) if cached else local
+        skipped = sum(value for (name, labels), value in metrics.counters.items() if name == 'writes_skipped')
+
+        start = time.perf_counter()
+        consumer.run(source, 'request-bucket', dest, destBucket, empty_polls=1, poll_interval=0)
+        elapsed = time.perf_counter() - start
+        skipped = sum(value for (name, labels), value in metrics.counters.items() if name == 'writes_skipped') - skipped
+        writes = sum(count for name, count in local.calls.items() if name not in ('describe_table', 'head_bucket'))
+        print(f"  {'cache' if cached else 'no cache':<8} {elapsed:7.2f} s  {args.n / elapsed:8.1f} req/s  "
+              f"destination writes {writes}  skipped {skipped}")
+
+
+class LatencyTracker():
+    """
+    Per-request latency from the moment the source hands a request out
+    (get_object, receive_message) to the destination write for its widget.
+    Starts are matched to writes first in first out per widget, requests
+    folded away by coalescing or rejected never get a write and are not counted
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = defaultdict(deque)
+        self.latencies = []
+
+
+    def start(self, body):
+        widgetId = widget_id_of(body if isinstance(body, bytes) else body.encode('utf-8'), '')
+        with self.lock:
+            self.started[widgetId].append(time.perf_counter())
+
+
+    def finish(self, widgetId):
+        now = time.perf_counter()
+        with self.lock:
+            waiting = self.started.get(widgetId.encode('utf-8'))
+            if waiting:
+                self.latencies.append(now - waiting.popleft())
+
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class TrackedClient():
+    """
+    Wraps a local client and reports request starts and destination writes
+    to a LatencyTracker, everything else goes straight to the client
+    """
+    def __init__(self, client, tracker):
+        self.client = client
+        self.tracker = tracker
+        self.meta = client.meta
+
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+    def get_object(self, **params):
+        response = self.client.get_object(**params)
+        body = response['Body'].read()
+        self.tracker.start(body)
+        response['Body'] = io.BytesIO(body)
+        return response
+
+
+    def receive_message(self, **params):
+        response = self.client.receive_message(**params)
+        for message in response.get('Messages', []):
+            self.tracker.start(message['Body'])
+        return response
+
+
+    def put_object(self, **params):
+        return self._write('put_object', params, params['Key'].rsplit('/', 1)[-1])
+
+
+    def delete_object(self, **params):
+        return self._write('delete_object', params, params['Key'].rsplit('/', 1)[-1])
+
+
+    def put_item(self, **params):
+        return self._write('put_item', params, params['Item']['id']['S'])
+
+
+    def update_item(self, **params):
+        return self._write('update_item', params, params['Key']['id']['S'])
+
+
+    def delete_item(self, **params):
+        return self._write('delete_item', params, params['Key']['id']['S'])
+
+
+    def batch_write_item(self, **params):
+        response = self.client.batch_write_item(**params)
+        for requests in params['RequestItems'].values():
+            for request in requests:
+                if 'PutRequest' in request:
+                    self.tracker.finish(request['PutRequest']['Item']['id']['S'])
+                else:
+                    self.tracker.finish(request['DeleteRequest']['Key']['id']['S'])
+        return response
+
+
+    def _write(self, name, params, widgetId):
+        response = getattr(self.client, name)(**params)
+        self.tracker.finish(widgetId)
+        return response
+
+
+"""
+One end to end run, in its own process so peak RSS belongs to this run only.
+The RSS includes the in-memory backends holding the corpus
+"""
+def e2e_scenario(mode, options):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    if options['corpus']:
+        bodies = load_corpus(options['corpus'])
+    else:
+        bodies = [json.dumps(request) for request in synthetic_requests(options['n'], options['widgets'])]
+    count = len(bodies)
+    faults = {'fail_rate': options['fail_rate'], 'seed': 1} if options['fail_rate'] else {}
+    tracker = LatencyTracker()
+    local, destBucket = make_destination(options['dest'], options['latency'], **faults)
+    dest = TrackedClient(local, tracker)
+    if options['batch'] and options['dest'] == 'dynamodb':
+        dest = DynamoBatchWriter(dest)
+
+    # failures are switched on once the source is filled
+    if mode == 'run':
+        source = LocalS3(options['latency'], seed=1)
+        seed_bucket(source, 'request-bucket', bodies)
+        source.fail_rate = options['fail_rate']
+        del bodies
+        start = time.perf_counter()
+        consumer.run(TrackedClient(source, tracker), 'request-bucket', dest, destBucket,
+                     workers=options['workers'], empty_polls=2, poll_interval=0)
+        left = len(source.buckets['request-bucket'])
+    else:
+        sqs = LocalSQS(options['latency'], visibility_timeout=0.2, seed=1)
+        sqs.send_message_batch(QueueUrl='local', Entries=[
+            {'Id': str(i), 'MessageBody': body if isinstance(body, str) else body.decode('utf-8')}
+            for i, body in enumerate(bodies)])
+        sqs.fail_rate = options['fail_rate']
+        del bodies
+        sqs.calls.clear()
+        start = time.perf_counter()
+        consumer.run_consumer_with_sqs('local', dest, destBucket, empty_receives=3,
+                                       sqs_handler=SQSHandler('local', wait_time=0.1, sqs=TrackedClient(sqs, tracker)))
+        left = len(sqs.messages)
+    consumer.flush_destination(dest, close=True)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'requests': count,
+        'seconds': elapsed,
+        'throughput': (count - left) / elapsed,
+        'p50': tracker.percentile(50) * 1000,
+        'p99': tracker.percentile(99) * 1000,
+        'writes': len(tracker.latencies),
+        'left': left,
+        'injected': sum(local.failures.values()) + sum((source if mode == 'run' else sqs).failures.values()),
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def bench_e2e(args):
+    options = {'n': args.n, 'widgets': args.widgets, 'corpus': args.corpus, 'dest': args.dest,
+               'latency': args.latency, 'workers': args.workers, 'batch': args.batch, 'fail_rate': args.fail_rate}
+    print(f"{'corpus ' + args.corpus if args.corpus else str(args.n) + ' synthetic requests'}, "
+          f"{args.latency * 1000:.1f} ms per call, destination {args.dest}, fail rate {args.fail_rate}")
+    # a fresh interpreter per run keeps the peak RSS numbers apart
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for mode in args.mode:
+            result = pool.apply(e2e_scenario, (mode, options))
+            print(f"  {mode:<4} {result['seconds']:7.2f} s  {result['throughput']:9.1f} req/s  "
+                  f"p50 {result['p50']:7.2f} ms  p99 {result['p99']:7.2f} ms  "
+                  f"peak RSS {result['peak_rss']:7.1f} MB  writes {result['writes']}  "
+                  f"left {result['left']}  injected failures {result['injected']}")
+            if args.record:
+                with open(args.record, 'a') as f:
+                    f.write(json.dumps(dict(result, mode=mode, options=options,
+                                            time=time.strftime('%Y-%m-%dT%H:%M:%S'))) + '\n')
+
+
+def bench_transform(args):
+    samples = load_sample_requests()
+    processor = dynamoDBProcessor()
+
+    # the old functions change their input, so they get a fresh copy each time,
+    # the copy is timed on its own and taken off
+    def old_s3(request):
+        data = consumer.processData(copy.deepcopy(request))
+        return bytes(json.dumps(data), 'utf-8')
+
+    def old_item(request):
+        return processor.processData(consumer.processData(copy.deepcopy(request)))
+
+    def old_update(request):
+        return dynamoDBProcessor.getUpdateExpression(old_item(request))
+
+    cases = [
+        ('S3 body', old_s3, requestTransformer.to_s3_object),
+        ('DynamoDB item', old_item, requestTransformer.to_dynamo_item),
+        ('DynamoDB update', old_update, requestTransformer.to_dynamo_update),
+    ]
+
+    def per_request(fn):
+        seconds = min(timeit.repeat(lambda: [fn(request) for request in samples], number=args.n, repeat=5))
+        return seconds / (args.n * len(samples)) * 1e6
+
+    copying = per_request(copy.deepcopy)
+    print(f"{len(samples)} sample requests, microseconds per request (deepcopy {copying:.2f} us taken off the old path)")
+    for name, old, new in cases:
+        before = per_request(old) - copying
+        after = per_request(new)
+        print(f"  {name:<16} old {before:6.2f} us  new {after:6.2f} us  {before / after:4.1f}x")
+    info = requestTransformer.update_template.cache_info()
+    print(f"  update template cache: {info.hits} hits, {info.misses} misses")
+
+
+def bench_validate(args):
+    samples = load_sample_requests()
+    bodies = [json.dumps(request).encode('utf-8') for request in samples]
+    validator = get_validator()
+
+    # what Lambda.validate_widget_request used to do
+    required = {
+        'create': ['requestId', 'widgetId', 'owner', 'label', 'description', 'otherAttributes'],
+        'update': ['requestId', 'widgetId', 'owner', 'description', 'otherAttributes'],
+        'delete': ['requestId', 'widgetId', 'owner'],
+    }
+    def old_validate(request):
+        request = json.loads(str(request).replace("'", "\""))
+        return all(field in request for field in required[request['type']])
+
+    def per_request(fn, items):
+        seconds = min(timeit.repeat(lambda: [fn(item) for item in items], number=args.n, repeat=5))
+        return seconds / (args.n * len(items)) * 1e6
+
+    print(f"{len(samples)} sample requests, microseconds per request")
+    print(f"  old str/replace/json.loads check   {per_request(old_validate, samples):6.2f} us")
+    print(f"  schema validator, decoded request  {per_request(validator.validate, samples):6.2f} us")
+    print(f"  schema validator, raw bytes        {per_request(validator.check, bodies):6.2f} us")
+    print(f"  json.loads alone, raw bytes        {per_request(json.loads, bodies):6.2f} us")
+
+
+"""
+Decode a raw request and encode the S3 widget object, the old str based
+json path against jsonCodec. corpus is a JSONL file or a directory of
+requests, by default the sample requests with their long note attributes
+"""
+def bench_codec(args):
+    bodies = load_corpus(args.corpus or SAMPLE_DIR)
+    requests = []
+    for body in bodies:
+        try:
+            request = json.loads(body)
+        except ValueError:
+            continue
+        if isinstance(request, dict) and request.get('type') in ('create', 'update') and 'owner' in request:
+            requests.append((body, request))
+    bodies = [body for body, request in requests]
+    data = [request for body, request in requests]
+
+    def old_decode(body):
+        return json.loads(body.decode('utf-8'))
+
+    def old_encode(value):
+        return bytes(json.dumps(value), 'utf-8')
+
+    def per_request(fn, items):
+        seconds = min(timeit.repeat(lambda: [fn(item) for item in items], number=args.n, repeat=5))
+        return seconds / (args.n * len(items)) * 1e6
+
+    size = sum(len(body) for body in bodies) / len(bodies)
+    print(f"{len(bodies)} requests, {size:.0f} bytes on average, microseconds per request, codec backend {jsonCodec.BACKEND}")
+    print(f"  decode  bytes -> str -> json.loads   {per_request(old_decode, bodies):6.2f} us")
+    print(f"  decode  jsonCodec.loads(bytes)        {per_request(jsonCodec.loads, bodies):6.2f} us")
+    print(f"  encode  bytes(json.dumps(), 'utf-8')  {per_request(old_encode, data):6.2f} us")
+    print(f"  encode  jsonCodec.dumps()             {per_request(jsonCodec.dumps, data):6.2f} us")
+
+
+"""
+Bytes held per request: a listed key waiting in the queue, and a decoded
+request waiting in the prefetcher, a worker queue or a coalescing window
+"""
+def bench_memory(args):
+    bodies = [body for body in load_corpus(args.corpus or SAMPLE_DIR) if consumer.get_validator().check(body)[1] == []]
+    bodies = [bodies[i % len(bodies)] for i in range(args.n)]
+    keys = [str(1612306368338 + i) for i in range(args.n)]
+
+    def retained(build):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        held = build()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        del held
+        return used / args.n
+
+    # what getRequestQueue held, the whole list_objects entry of every key
+    def listing_entries():
+        return [{'Key': key, 'LastModified': time.time(), 'ETag': f'"{uuid.uuid4().hex}"', 'Size': 600,
+                 'StorageClass': 'STANDARD', 'Owner': {'DisplayName': 'owner', 'ID': uuid.uuid4().hex * 2}}
+                for key in keys]
+
+    def lister_keys():
+        lister = RequestLister(None, 'requests')
+        lister.add_page({'Contents': [{'Key': key, 'Size': 600} for key in keys]})
+        return lister
+
+    print(f"{args.n} requests, {sum(len(body) for body in bodies) / len(bodies):.0f} bytes of JSON on average, bytes held per request")
+    print(f"  queued key, list_objects entry dict     {retained(listing_entries):7.0f}")
+    print(f"  queued key, RequestLister               {retained(lister_keys):7.0f}")
+    print(f"  decoded request, dict                   {retained(lambda: [jsonCodec.loads(body) for body in bodies]):7.0f}")
+    print(f"  decoded request, WidgetRequest          {retained(lambda: [WidgetRequest.from_dict(jsonCodec.loads(body)) for body in bodies]):7.0f}")
+
+
+"""
+Run in a fresh interpreter by bench_startup. Prints the import times and the
+time from process start until the first SQS message is written, in ms
+"""
+STARTUP_SCRIPT = '''
+import json, os, sys, time
+started = float(os.environ['BENCH_STARTED'])
+t = time.perf_counter()
+import consumer
+import_consumer = time.perf_counter() - t
+from localBackends import LocalS3, LocalSQS
+from SQS import SQSHandler
+sqs, dest = LocalSQS(), LocalS3()
+dest.create_bucket(Bucket='widget-bucket')
+sqs.send_message(QueueUrl='local', MessageBody=json.dumps(json.loads(sys.argv[1])))
+consumer.run_consumer_with_sqs('local', dest, 'widget-bucket', SQSHandler('local', wait_time=0, sqs=sqs), empty_receives=1)
+first_message = time.time() - started
+t = time.perf_counter()
+import Lambda
+import_lambda = time.perf_counter() - t
+t = time.perf_counter()
+Lambda.lambda_handler(sys.argv[1])
+first_invocation = time.perf_counter() - t
+print(json.dumps({'import consumer': import_consumer * 1000, 'first message': first_message * 1000,
+                  'import Lambda': import_lambda * 1000, 'first invocation': first_invocation * 1000}))
+'''
+
+
+def bench_startup(args):
+    request = json.dumps(synthetic_requests(1)[0])
+    env = dict(os.environ)
+    env.pop('REQUEST_QUEUE_URL', None)
+    runs = []
+    for _ in range(args.runs):
+        env['BENCH_STARTED'] = repr(time.time())
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, request], env=env, check=True,
+                                capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+    result = {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+    print(f"median of {args.runs} fresh interpreters")
+    for name, ms in result.items():
+        print(f"  {name:<17} {ms:8.1f} ms")
+    if args.record:
+        # one line per run so the numbers can be compared over time
+        with open(args.record, 'a') as f:
+            f.write(json.dumps(dict(result, time=time.strftime('%Y-%m-%dT%H:%M:%S'))) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Consumer benchmarks against local stand-ins")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    workers = commands.add_parser('workers', help="Request bucket loop with a worker pool")
+    workers.add_argument('-n', type=int, default=2000, help="Number of requests")
+    workers.add_argument('--latency', type=float, default=0.005, help="Seconds added to every call")
+    workers.add_argument('--widgets', type=int, help="Distinct widgets, default n/4")
+    workers.add_argument('--dest', choices=['s3', 'dynamodb'], default='dynamodb')
+    workers.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    workers.add_argument('--batch', action='store_true', help="Batch DynamoDB creates and deletes")
+    workers.set_defaults(func=bench_workers)
+
+    sqs = commands.add_parser('sqs', help="SQS receive loop")
+    sqs.add_argument('-n', type=int, default=2000, help="Number of messages")
+    sqs.add_argument('--latency', type=float, default=0.005, help="Seconds added to every call")
+    sqs.add_argument('--widgets', type=int, help="Distinct widgets, default n/4")
+    sqs.add_argument('--dest', choices=['s3', 'dynamodb'], default='dynamodb')
+    sqs.add_argument('--batch', action='store_true', help="Batch DynamoDB creates and deletes")
+    sqs.set_defaults(func=bench_sqs)
+
+    engine = commands.add_parser('async', help="asyncio engine, request bucket source")
+    engine.add_argument('-n', type=int, default=5000, help="Number of requests")
+    engine.add_argument('--latency', type=float, default=0.005, help="Seconds added to every call")
+    engine.add_argument('--widgets', type=int, help="Distinct widgets, default n/4")
+    engine.add_argument('--dest', choices=['s3', 'dynamodb'], default='dynamodb')
+    engine.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 100, 200])
+    engine.set_defaults(func=bench_async)
+
+    processes = commands.add_parser('processes', help="Request bucket consumer sharded over processes")
+    processes.add_argument('-n', type=int, default=20000, help="Number of requests")
+    processes.add_argument('--latency', type=float, default=0.0, help="Seconds added to every destination call")
+    processes.add_argument('--widgets', type=int, help="Distinct widgets, default n/4")
+    processes.add_argument('--dest', choices=['s3', 'dynamodb'], default='dynamodb')
+    processes.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    processes.set_defaults(func=bench_processes)
+
+    lease = commands.add_parser('leases', help="Several consumers on one request bucket, racing or with leases")
+    lease.add_argument('-n', type=int, default=2000, help="Number of requests")
+    lease.add_argument('--latency', type=float, default=0.005, help="Seconds added to every call")
+    lease.add_argument('--widgets', type=int, help="Distinct widgets, default n/4")
+    lease.add_argument('--partitions', type=int, default=16)
+    lease.add_argument('--consumers', type=int, nargs='+', default=[1, 2, 4])
+    lease.set_defaults(func=bench_leases)
+
+    throttled = commands.add_parser('throttle', help="Writes to a table with limited capacity, unpaced and adaptive")
+    throttled.add_argument('-n', type=int, default=3000, help="Number of requests")
+    throttled.add_argument('--latency', type=float, default=0.002, help="Seconds added to every call")
+    throttled.add_argument('--widgets', type=int, help="Distinct widgets, default n/4")
+    throttled.add_argument('--capacity', type=float, default=300, help="Write capacity units per second of the table")
+    throttled.add_argument('--rate', type=float, default=50, help="Starting rate of the controller")
+    throttled.add_argument('--workers', type=int, default=8)
+    throttled.add_argument('--batch', action='store_true', help="Batch DynamoDB creates and deletes")
+    throttled.set_defaults(func=bench_throttle)
+
+    unchanged = commands.add_parser('unchanged', help="Repetitive updates with and without the write cache")
+    unchanged.add_argument('-n', type=int, default=2000, help="Number of requests")
+    unchanged.add_argument('--latency', type=float, default=0.005, help="Seconds added to every call")
+    unchanged.add_argument('--widgets', type=int, default=100, help="Distinct widgets")
+    unchanged.add_argument('--dest', choices=['s3', 'dynamodb'], default='dynamodb')
+    unchanged.add_argument('--repeat', type=float, default=0.5, help="Share of updates that re-send the widget's last update")
+    unchanged.set_defaults(func=bench_unchanged)
+
+    transform = commands.add_parser('transform', help="Request transform microbenchmark")
+    transform.add_argument('-n', type=int, default=2000, help="Passes over the sample requests")
+    transform.set_defaults(func=bench_transform)
+
+    e2e = commands.add_parser('e2e', help="End to end run and SQS loops with latency percentiles and peak RSS")
+    e2e.add_argument('-n', type=int, default=10000, help="Synthetic requests, 10k to 1M")
+    e2e.add_argument('--corpus', type=str, help="JSON lines file or request folder to use instead of synthetic requests")
+    e2e.add_argument('--widgets', type=int, help="Distinct widgets, default n/4")
+    e2e.add_argument('--mode', choices=['run', 'sqs'], nargs='+', default=['run', 'sqs'])
+    e2e.add_argument('--latency', type=float, default=0.0, help="Seconds added to every call")
+    e2e.add_argument('--dest', choices=['s3', 'dynamodb'], default='dynamodb')
+    e2e.add_argument('--workers', type=int, default=1, help="Worker threads for run")
+    e2e.add_argument('--batch', action='store_true', help="Batch DynamoDB creates and deletes")
+    e2e.add_argument('--fail_rate', type=float, default=0.0, help="Fraction of source and destination calls that fail")
+    e2e.add_argument('--record', type=str, help="Append the results to this JSON lines file")
+    e2e.set_defaults(func=bench_e2e)
+
+    validate = commands.add_parser('validate', help="Request validation microbenchmark")
+    validate.add_argument('-n', type=int, default=2000, help="Passes over the sample requests")
+    validate.set_defaults(func=bench_validate)
+
+    codec = commands.add_parser('codec', help="JSON decode and encode microbenchmark")
+    codec.add_argument('-n', type=int, default=2000, help="Passes over the requests")
+    codec.add_argument('--corpus', type=str, help="JSONL file or directory of requests, the sample requests by default")
+    codec.set_defaults(func=bench_codec)
+
+    memory = commands.add_parser('memory', help="Bytes held per queued and in-flight request")
+    memory.add_argument('-n', type=int, default=20000, help="Requests to hold")
+    memory.add_argument('--corpus', type=str, help="JSONL file or directory of requests, the sample requests by default")
+    memory.set_defaults(func=bench_memory)
+
+    startup = commands.add_parser('startup', help="Import time and time to the first processed message")
+    startup.add_argument('--runs', type=int, default=10, help="Fresh interpreters to start")
+    startup.add_argument('--record', type=str, help="Append the medians to this JSON lines file")
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    args.func(args)
@@ -0,0 +1,154 @@
+"""
+Checkpoint journal of the requests that have been written, so a restart or
+a redelivered SQS message does not write the same request twice.
+
+Request IDs are appended to a local file and kept in memory in a bounded
+LRU of the most recent capacity IDs. The LRU is exact, a Bloom filter
+would be smaller but a false positive would silently drop a write. IDs
+are written to the file when the destination writes are committed
+(flush_destination), so the journal never claims a write that was lost.
+Once the file holds twice capacity lines it is rewritten with only the
+IDs still in memory.
+
+An ID can carry a value, written after a tab on its line, which is how
+the write cache keeps the digest of each widget's last write. Without a
+path the journal only lives in memory.
+
+The consumer uses the process wide journal opened with open_journal.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from utils import replace_file
+
+
+class CheckpointJournal():
+    def __init__(self, path, capacity=100000, sync=True):
+        self.path = path
+        self.capacity = capacity
+        self.sync = sync # fsync on every commit
+        self.lock = threading.Lock()
+        self.recent = OrderedDict() # requestId -> value or None, oldest first
+        self.pending = []           # lines recorded, not committed to the file yet
+        self.lines = 0
+        self._load()
+        self.file = open(path, 'a') if path else None
+
+
+    """
+    Read the IDs of an earlier run. A last line cut off by a crash is
+    dropped from the file so new lines are not glued onto it
+    """
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        good = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                good += len(line)
+                requestId, _, value = line[:-1].decode('utf-8').partition('\t')
+                self._remember(requestId, value or None)
+                self.lines += 1
+        if good != os.path.getsize(self.path):
+            logging.info(f"Dropping a partly written line from {self.path}")
+            with open(self.path, 'r+b') as f:
+                f.truncate(good)
+        logging.info(f"Loaded {len(self.recent)} request IDs from {self.path}")
+
+
+    def _remember(self, requestId, value=None):
+        self.recent[requestId] = value
+        self.recent.move_to_end(requestId)
+        if len(self.recent) > self.capacity:
+            self.recent.popitem(last=False)
+
+
+    """
+    True if the request has already been written
+    """
+    def seen(self, requestId):
+        with self.lock:
+            if requestId in self.recent:
+                self.recent.move_to_end(requestId)
+                return True
+            return False
+
+
+    """
+    The value recorded with an ID, None if there is none
+    """
+    def get(self, requestId):
+        with self.lock:
+            value = self.recent.get(requestId)
+            if value is not None:
+                self.recent.move_to_end(requestId)
+            return value
+
+
+    """
+    Remember a request that has just been written, it reaches the file
+    on the next commit
+    """
+    def record(self, requestId, value=None):
+        with self.lock:
+            self._remember(requestId, value)
+            self.pending.append(requestId if value is None else f"{requestId}\t{value}")
+
+
+    """
+    Append the recorded IDs to the file, called once their writes are durable
+    """
+    def commit(self):
+        with self.lock:
+            if not self.pending:
+                return
+            if self.file is None:
+                self.pending = []
+                return
+            self.file.write('\n'.join(self.pending) + '\n')
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+            self.lines += len(self.pending)
+            self.pending = []
+            if self.lines > 2 * self.capacity:
+                self._compact()
+
+
+    """
+    Rewrite the file with only the IDs still in memory, caller holds the lock
+    """
+    def _compact(self):
+        self.file.close()
+        replace_file(self.path, ''.join(f"{requestId}\n" if value is None else f"{requestId}\t{value}\n"
+                                        for requestId, value in self.recent.items()), sync=True)
+        self.file = open(self.path, 'a')
+        self.lines = len(self.recent)
+        logging.info(f"Compacted {self.path} to {self.lines} request IDs")
+
+
+    def close(self):
+        self.commit()
+        if self.file is not None:
+            self.file.close()
+
+
+# the journal process_request checks, None when checkpointing is off
+journal = None
+
+
+def open_journal(path, capacity=100000):
+    global journal
+    journal = CheckpointJournal(path, capacity)
+    return journal
+
+
+def close_journal():
+    global journal
+    if journal is not None:
+        journal.close()
+        journal = None
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from S3Processor import S3Processor
+from dynamoDBProcessor import dynamoDBProcessor
+from utils import replace_file
+
+
+class ClientRegistry():
+    """
+    Shares boto3 sessions and clients across the consumer. There is one
+    session per credential set and one client per service and pool size,
+    so workers and handlers reuse the same connection pools instead of
+    each building their own.
+
+    It also remembers whether a name is a DynamoDB table or an S3 bucket.
+    Answers are kept for kind_ttl seconds, and can be saved to a JSON file
+    so restarts and other containers skip the describe_table/head_bucket
+    calls.
+
+    boto3 is imported on the first session, so building a registry is free
+    and a client is only loaded for the services actually used.
+    """
+    def __init__(self, region_name='us-east-1', max_pool_connections=10, kind_ttl=3600, kind_cache_path=None):
+        self.region_name = region_name
+        self.max_pool_connections = max_pool_connections
+        self.kind_ttl = kind_ttl
+        self.kind_cache_path = kind_cache_path
+        self.lock = threading.RLock()
+        self.sessions = {}
+        self.clients = {}
+        self.kinds = None
+        self.pid = os.getpid()
+
+
+    """
+    Session for a credentials dict like credsManager.get_aws_creds returns
+    """
+    def session(self, creds=None):
+        creds = creds or {}
+        key = (creds.get('aws_access_key_id'), creds.get('aws_secret_access_key'),
+               creds.get('aws_session_token'), self.region_name)
+        with self.lock:
+            if self.pid != os.getpid():
+                # forked worker process, connections can not be shared with the parent
+                self.sessions, self.clients, self.pid = {}, {}, os.getpid()
+            if key not in self.sessions:
+                import boto3
+                self.sessions[key] = boto3.Session(
+                    aws_access_key_id=creds.get('aws_access_key_id'),
+                    aws_secret_access_key=creds.get('aws_secret_access_key'),
+                    aws_session_token=creds.get('aws_session_token'),
+                    region_name=self.region_name
+                )
+            return self.sessions[key]
+
+
+    def client(self, service, creds=None, max_pool_connections=None):
+        pool = max_pool_connections or self.max_pool_connections
+        with self.lock:
+            session = self.session(creds)
+            key = (id(session), service, pool)
+            if key not in self.clients:
+                from botocore.config import Config
+                self.clients[key] = session.client(service, config=Config(max_pool_connections=pool))
+            return self.clients[key]
+
+
+    """
+    Return 'dynamodb' or 's3' for a table or bucket name, or None if it is neither
+    """
+    def resource_kind(self, name, creds=None):
+        with self.lock:
+            kinds = self._load_kinds()
+            cached = kinds.get(name)
+            if cached and time.time() - cached['checked'] < self.kind_ttl:
+                return cached['kind']
+
+        if dynamoDBProcessor.does_dynamo_table_exist(name, self.region_name, self.client('dynamodb', creds)):
+            kind = 'dynamodb'
+        elif S3Processor.does_s3_bucket_exist(name, self.region_name, self.client('s3', creds)):
+            kind = 's3'
+        else:
+            return None
+
+        with self.lock:
+            kinds[name] = {'kind': kind, 'checked': time.time()}
+            self._save_kinds()
+        return kind
+
+
+    def _load_kinds(self):
+        if self.kinds is None:
+            self.kinds = {}
+            if self.kind_cache_path and os.path.exists(self.kind_cache_path):
+                try:
+                    with open(self.kind_cache_path) as f:
+                        self.kinds = json.load(f)
+                except (OSError, ValueError) as e:
+                    logging.error(f"Error reading resource cache {self.kind_cache_path}: {e}")
+        return self.kinds
+
+
+    def _save_kinds(self):
+        if not self.kind_cache_path:
+            return
+        try:
+            replace_file(self.kind_cache_path, json.dumps(self.kinds))
+        except OSError as e:
+            logging.error(f"Error writing resource cache {self.kind_cache_path}: {e}")
+
+
+shared_registry = None
+
+
+"""
+The process wide registry, created on first use
+"""
+def get_registry(**options):
+    global shared_registry
+    if shared_registry is None:
+        shared_registry = ClientRegistry(**options)
+    else:
+        for name, value in options.items():
+            setattr(shared_registry, name, value)
+    return shared_registry
@@ -0,0 +1,142 @@
+import logging
+import time
+from collections import OrderedDict
+
+
+class RequestCoalescer():
+    """
+    Buffers requests for up to window seconds or max_requests requests and
+    folds each widget's chain of requests into its net effect:
+
+        create + updates          one put
+        update + updates          one update
+        ... + delete              one delete, or nothing when the chain
+                                  started by creating the widget
+
+    Each net operation is a (requestType, request) pair, where requestType
+    picks the handler to run and may differ from request['type']. A create
+    folded with updates is still applied as a put, but carries the last
+    request's fields, so the result is the same as applying every step.
+
+    merge_updates matches how the destination applies an update. DynamoDB
+    update_item only sets the attributes it names, so folded updates merge
+    their fields. An S3 update replaces the whole object, so the last one wins.
+    Requests that change the owner are not folded, the owner is part of
+    the S3 key.
+    """
+    def __init__(self, window=1.0, max_requests=500, merge_updates=True):
+        self.window = window
+        self.max_requests = max_requests
+        self.merge_updates = merge_updates
+        self.widgets = OrderedDict() # widgetId -> list of [requestType, request, fresh]
+        self.tokens = []
+        self.widgetTokens = {} # widgetId -> tokens of its requests
+        self.widgetRequestIds = {} # widgetId -> requestIds of its requests, folded away or not
+        self.started = None
+
+
+    """
+    Add a decoded request, token is whatever the caller needs to ack it
+    afterwards. A request of an unknown type raises ValueError and is not added
+    """
+    def add(self, request, token=None):
+        ops = self.widgets.get(request['widgetId'], [])
+        self._fold(ops, request['type'], request)
+        if self.started is None:
+            self.started = time.monotonic()
+        self.widgets[request['widgetId']] = ops
+        self.tokens.append(token)
+        self.widgetTokens.setdefault(request['widgetId'], []).append(token)
+        if request.get('requestId') is not None:
+            self.widgetRequestIds.setdefault(request['widgetId'], []).append(request['requestId'])
+
+
+    """
+    True once the buffer is full or the oldest request has waited the whole window
+    """
+    def ready(self):
+        if not self.tokens:
+            return False
+        return len(self.tokens) >= self.max_requests or time.monotonic() - self.started >= self.window
+
+
+    """
+    Return (widgetId, net operations, tokens, requestIds) for every widget
+    in arrival order, so a caller can ack each widget's requests once its
+    writes are made. requestIds holds the IDs of every request added for
+    the widget, including the ones folded away or cancelled out
+    """
+    def drain_widgets(self):
+        widgets = [(widgetId, [(requestType, request) for requestType, request, fresh in ops],
+                    self.widgetTokens[widgetId], self.widgetRequestIds.get(widgetId, []))
+                   for widgetId, ops in self.widgets.items()]
+        if self.tokens:
+            logging.info(f"Coalesced {len(self.tokens)} requests into {sum(len(widget[1]) for widget in widgets)} writes")
+        self._clear()
+        return widgets
+
+
+    def _clear(self):
+        self.widgets = OrderedDict()
+        self.tokens = []
+        self.widgetTokens = {}
+        self.widgetRequestIds = {}
+        self.started = None
+
+
+    """
+    fresh marks a create for a widget that did not exist before it, so
+    deleting it again within the window needs no write at all
+    """
+    def _fold(self, ops, requestType, request):
+        if requestType not in ('create', 'update', 'delete'):
+            raise ValueError(f"Unknown request type: {requestType}")
+        last = ops[-1] if ops else None
+        if last is not None and last[1]['owner'] != request['owner']:
+            ops.append([requestType, request, requestType == 'create'])
+            return
+
+        if requestType == 'delete':
+            needs_delete = True
+            if last is not None and last[0] != 'delete':
+                ops.pop()
+                needs_delete = not last[2]
+            if needs_delete and not (ops and ops[-1][0] == 'delete'):
+                ops.append(['delete', request, False])
+
+        elif requestType == 'create':
+            if last is None:
+                ops.append(['create', request, True])
+            else:
+                # a put replaces whatever was there
+                ops[-1] = ['create', request, last[0] == 'create' and last[2]]
+
+        elif requestType == 'update':
+            if last is None:
+                ops.append(['update', request, False])
+            elif last[0] == 'delete':
+                if self.merge_updates:
+                    # an update after a delete only sets some fields, both writes are needed
+                    ops.append(['update', request, False])
+                else:
+                    ops[-1] = ['update', request, False]
+            elif self.merge_updates:
+                ops[-1] = [last[0], merge_requests(last[1], request), last[2]]
+            else:
+                ops[-1] = [last[0], request, last[2]]
+
+
+"""
+Lay an update over an earlier request, otherAttributes are merged by name
+"""
+def merge_requests(earlier, later):
+    merged = dict(earlier)
+    for key, value in later.items():
+        if key == 'otherAttributes':
+            attributes = {attribute['name']: attribute for attribute in earlier.get('otherAttributes', [])}
+            for attribute in value:
+                attributes[attribute['name']] = attribute
+            merged[key] = list(attributes.values())
+        else:
+            merged[key] = value
+    return merged
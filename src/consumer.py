@@ -7,29 +7,41 @@ A02264961
 Oct 20 2023
 """
 import argparse
-import boto3
-from botocore.exceptions import NoCredentialsError
-import time
-import json
+import functools
+import threading
 import logging
 import os
-from credsManager import credsManager
-from S3Processor import S3Processor
-from dynamoDBProcessor import dynamoDBProcessor
-from SQS import SQSHandler
+from concurrent.futures import ThreadPoolExecutor
+from S3Processor import RequestAcker, RequestLister, RequestPrefetcher
+import requestTransformer
+from requestValidator import get_validator
+from widgetRequest import WidgetRequest
+from dynamoBatchWriter import DynamoBatchWriter
+from s3SnapshotWriter import S3SnapshotWriter
+from SQS import MessageAcker, SQSHandler
+from workerPool import KeyedWorkerPool
+from coalescer import RequestCoalescer
+from metrics import metrics
+import checkpoint
+import writeCache
+from autoscale import BacklogScaler, IdlePoller
 
 
-# Create the log directory if it doesn't exist
-log_dir = '../logs'
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
+"""
+Log to ../logs/consumer.log and the console. Called from main so importing
+the module (tests, benchmarks, Lambda) does not create files or handlers
+"""
+def setup_logging(log_dir='../logs'):
+    # Create the log directory if it doesn't exist
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
 
-# Configure the logger
-log_format = '%(asctime)s - %(levelname)s - %(message)s'
-logging.basicConfig(filename='../logs/consumer.log', level=logging.INFO, format=log_format)
-console_handler = logging.StreamHandler()  # Add a stream handler to log to the console
-console_handler.setFormatter(logging.Formatter(log_format))
-logging.getLogger().addHandler(console_handler)  # Add the console handler to the root logger
+    # Configure the logger
+    log_format = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(filename=os.path.join(log_dir, 'consumer.log'), level=logging.INFO, format=log_format)
+    console_handler = logging.StreamHandler()  # Add a stream handler to log to the console
+    console_handler.setFormatter(logging.Formatter(log_format))
+    logging.getLogger().addHandler(console_handler)  # Add the console handler to the root logger
 
 
 """
@@ -43,150 +55,872 @@ def processData(data):
 
 
 """
-Create, Update, and Delete widget functions
+Create, Update, and Delete widget functions. The request is turned into
+the destination's format in one pass by requestTransformer
 """
-def create_widget(data, dest_session, destBucket, dynamoProcessor):
-    data = processData(data)
-    requestKey = f"widgets/{data['owner']}/{data['widgetId']}"
+def create_widget(data, dest_session, destBucket):
     logging.info(f"Creating a new widget with id: {data['widgetId']}")
 
     if dest_session.meta.service_model.service_name == "dynamodb":
-        processed_data = dynamoProcessor.processData(data)
-        dest_session.put_item(TableName="widgets", Item=processed_data)
+        dest_session.put_item(TableName="widgets", Item=requestTransformer.to_dynamo_item(data))
     else:
-        dest_session.put_object(Bucket=destBucket, Key=requestKey, Body=json.dumps(data))
-
+        requestKey, body = requestTransformer.to_s3_object(data)
+        dest_session.put_object(Bucket=destBucket, Key=requestKey, Body=body)
 
-from decimal import Decimal  # Import Decimal for handling Decimal types
 
-def update_widget(data, dest_session, destBucket, dynamoProcessor):
-    processed_data = processData(data)  # Avoid overwriting the input data
-    
-    widget_id = processed_data['widgetId']
-    logging.info(f"Updating a widget with ID: {widget_id}")
+def update_widget(data, dest_session, destBucket):
+    logging.info(f"Updating a widget with ID: {data['widgetId']}")
 
     if dest_session.meta.service_model.service_name == "dynamodb":
-        dynamo_data = dynamoProcessor.processData(data)  # Correct the variable name
-        key = {'id': {'S': widget_id}}  # Ensure the key format matches the primary key in DynamoDB
-        update_expression, expression_attribute_values, expression_attribute_names = dynamoDBProcessor.getUpdateExpression(dynamo_data)
-
-        dest_session.update_item(
-            TableName="widgets",
-            Key=key,
-            UpdateExpression=update_expression,
-            ExpressionAttributeValues=expression_attribute_values,
-            ExpressionAttributeNames=expression_attribute_names
-        )
-    
+        dest_session.update_item(**requestTransformer.to_dynamo_update(data, "widgets"))
     else:
-        data_bytes = bytes(json.dumps(processed_data), 'utf-8')
-        dest_session.put_object(Bucket=destBucket, Key=f"widgets/{processed_data['owner']}/{widget_id}", Body=data_bytes)
+        requestKey, body = requestTransformer.to_s3_object(data)
+        dest_session.put_object(Bucket=destBucket, Key=requestKey, Body=body)
 
 
 def delete_widget(data, dest_session, destBucket):
-    processed_data = processData(data)
-    widget_id = processed_data['widgetId']
+    widget_id = data['widgetId']
     logging.info(f"Deleting a widget with ID: {widget_id}")
 
     if dest_session.meta.service_model.service_name == "dynamodb":
         key = {'id': {'S': widget_id}}  # Ensure the key format matches the primary key in DynamoDB
         dest_session.delete_item(TableName="widgets", Key=key)
     else:
-        dest_session.delete_object(Bucket=destBucket, Key=f"widgets/{processed_data['owner']}/{widget_id}")
+        dest_session.delete_object(Bucket=destBucket, Key=requestTransformer.s3_key(data))
+
+
+"""
+Decode a raw request and check it against the widget request schema, so bad
+requests are dropped before any write. Returns None after logging the errors.
+Valid requests come back as a compact WidgetRequest, they may wait in the
+prefetcher, the worker queues or a coalescing window
+"""
+def checked_request(body, name):
+    with metrics.time('decode'):
+        request, errors = get_validator().check(body)
+    if errors:
+        metrics.inc('requests', outcome='rejected')
+        logging.error(f"Rejected request {name}: {'; '.join(errors)}")
+        return None
+    return WidgetRequest.from_dict(request)
+
 
+def download_request(source_session, sourceBucket, requestKey):
+    with metrics.time('download'):
+        body = source_session.get_object(Bucket=sourceBucket, Key=requestKey)['Body'].read()
+    return checked_request(body, requestKey)
+
+
+"""
+Delete the collected requests from the source bucket, after writing out
+anything a batching destination still holds for them
+"""
+def ack_requests(acker, dest_session):
+    acker.flush(functools.partial(flush_destination, dest_session))
+
+
+"""
+Apply a single decoded request to the destination based on its type.
+With a checkpoint journal open, requests it has seen are skipped
+"""
+def process_request(jsonData, dest_session, destBucket, requestType=None):
+    requestType = requestType or jsonData['type']
+    logging.info(f"Request type: {requestType}")
+
+    if already_applied(jsonData, requestType):
+        return
+
+    try:
+        with metrics.time('write', type=requestType):
+            if requestType == 'create':
+                create_widget(jsonData, dest_session, destBucket)
+            elif requestType == 'update':
+                update_widget(jsonData, dest_session, destBucket)
+            elif requestType == 'delete':
+                delete_widget(jsonData, dest_session, destBucket)
+            else:
+                raise ValueError(f"Unknown request type: {requestType}")
+    except Exception:
+        metrics.inc('requests', type=requestType, outcome='failed')
+        raise
+    metrics.inc('requests', type=requestType, outcome='processed')
+    if checkpoint.journal is not None and jsonData.get('requestId') is not None:
+        checkpoint.journal.record(jsonData['requestId'])
+
+
+"""
+True when the checkpoint journal has seen the request, it is skipped.
+Checked before a request is coalesced too, folded into a newer request
+it would be written again
+"""
+def already_applied(jsonData, requestType=None):
+    journal = checkpoint.journal
+    requestId = jsonData.get('requestId') if journal is not None else None
+    if requestId is None or not journal.seen(requestId):
+        return False
+    logging.info(f"Skipping request {requestId}, already applied")
+    metrics.inc('requests', type=requestType or jsonData['type'], outcome='duplicate')
+    return True
+
+
+"""
+Mark every request of a written widget as seen, with coalescing only the
+request each write carries is recorded by process_request, not the ones
+folded into it or cancelled out
+"""
+def record_applied(requestIds):
+    journal = checkpoint.journal
+    if journal is None:
+        return
+    for requestId in requestIds:
+        if not journal.seen(requestId):
+            journal.record(requestId)
+
+
+"""
+How long to wait between empty polls. empty_polls=None polls until the
+process is stopped, max_poll_interval lets the wait double on every empty
+poll up to that many seconds, None keeps it at poll_interval
+"""
+def make_poller(empty_polls=10, poll_interval=0.5, max_poll_interval=None):
+    return IdlePoller(poll_interval, max(poll_interval, max_poll_interval or poll_interval), stop_after=empty_polls)
 
 
 """
-Main loop to run the consumer
+Read ahead of the writer, the next prefetch requests are downloaded and
+decoded in the background, holding at most prefetch_bytes of requests.
+owns(key) limits the requests to the ones this consumer holds a lease on,
+the requests acker has written but not deleted yet are not read again
 """
-def run(source_session, sourceBucket, dest_session, destBucket, dynamoTable=None):
-    requestQueue =  S3Processor.getRequestQueue(source_session, sourceBucket)
-    stop_times = 10 # will retry to populate queue 10 times before stopping program 
+def make_prefetcher(source_session, sourceBucket, prefetch=8, prefetch_bytes=8 * 1024 * 1024, threads=None,
+                    owns=None, acker=None):
+    lister = RequestLister(source_session, sourceBucket, owns=owns, skip_keys=acker)
+    fetch = functools.partial(download_request, source_session, sourceBucket)
+    return RequestPrefetcher(lister, fetch, max(1, prefetch), prefetch_bytes, threads)
 
+
+"""
+Deletes the written requests from the bucket. By default every 5 seconds
+or 1000 requests, with ack_interval set only every ack_interval seconds:
+the deletes wait for a flush of the destination, and a snapshot writer
+rewrites every changed snapshot on each flush
+"""
+def make_acker(source_session, sourceBucket, dead_letter_after=None, ack_interval=None):
+    if ack_interval is None:
+        return RequestAcker(source_session, sourceBucket, max_attempts=dead_letter_after)
+    return RequestAcker(source_session, sourceBucket, flush_interval=ack_interval, max_pending=None,
+                        max_attempts=dead_letter_after)
+
+
+"""
+The next (key, request) from the prefetcher, request is None for a
+rejected one. None once the pass is over, because the listing ran out or
+a download failed. The failed request's widget is not known, so the pass
+ends there and none of the later requests can go ahead of it
+"""
+def next_request(prefetcher):
+    nextDownload = prefetcher.next()
+    if nextDownload is None:
+        return None
+    requestKey, download = nextDownload
+    try:
+        return requestKey, download.result()
+    except Exception as e:
+        # left in the bucket, picked up again by the next listing
+        logging.error(f"Error downloading request {requestKey}, ending the pass: {e}")
+        return None
+
+
+"""
+Main loop to run the consumer. Requests are applied one at a time in key
+order, the downloads of the next ones overlap the current write.
+dead_letter_after moves a request that failed that many times to the
+dead letter prefix, None keeps reading it until it is written.
+ack_interval is passed to make_acker
+"""
+def run(source_session, sourceBucket, dest_session, destBucket, dynamoTable=None,
+        workers=1, empty_polls=10, poll_interval=0.5, coalescer=None, max_workers=None,
+        max_poll_interval=None, prefetch=8, prefetch_bytes=8 * 1024 * 1024, owns=None, dead_letter_after=None,
+        ack_interval=None):
+    poller = make_poller(empty_polls, poll_interval, max_poll_interval)
+    if coalescer is not None:
+        return run_coalesced(source_session, sourceBucket, dest_session, destBucket, coalescer, poller,
+                             prefetch, prefetch_bytes, owns, dead_letter_after, ack_interval)
+    if workers > 1 or (max_workers or 0) > workers:
+        scaler = BacklogScaler(workers, max_workers) if max_workers else None
+        return run_with_workers(source_session, sourceBucket, dest_session, destBucket,
+                                workers, poller=poller, scaler=scaler, prefetch_bytes=prefetch_bytes, owns=owns,
+                                dead_letter_after=dead_letter_after, ack_interval=ack_interval)
+
+    acker = make_acker(source_session, sourceBucket, dead_letter_after, ack_interval)
+    prefetcher = make_prefetcher(source_session, sourceBucket, prefetch, prefetch_bytes, owns=owns, acker=acker)
+    metrics.gauge('queue_depth', prefetcher.__len__)
+    try:
+        run_prefetched(dest_session, destBucket, prefetcher, acker, poller)
+    finally:
+        metrics.remove_gauge('queue_depth')
+        prefetcher.close()
+        ack_requests(acker, dest_session)
+
+
+"""
+Requests are deleted from the bucket in batches once they are written,
+a failed write leaves the request in the bucket for the next pass and
+holds back the widget's later requests until then. A pass that wrote
+nothing counts as an empty poll, so a failing destination is not retried
+in a tight loop. The next pass skips the requests written but not
+deleted yet, so a pass ending does not delete them early
+"""
+def run_prefetched(dest_session, destBucket, prefetcher, acker, poller):
     while True:
+        # next request in key order, the lister fetches another page when it runs out
+        nextRequest = next_request(prefetcher)
+
         # if no more requests, check if there are more to process
-        if len(requestQueue) == 0:
+        if nextRequest is None:
+            if acker.ready():
+                ack_requests(acker, dest_session)
             logging.info("No requests to process, checking for more")
-            requestQueue = S3Processor.getRequestQueue(source_session, sourceBucket)
-            stop_times -= 1
-            time.sleep(0.5)
-            if stop_times == 0:
+            prefetcher.rewind()
+            acker.rewind()
+            if not poller.idle():
                 logging.info("Finished processing requests, Stopping")
                 break
-            else:
+            poller.wait()
+            continue
+
+        # the request from S3 bucket2, decoded into a dict in the background
+        requestKey, jsonData = nextRequest
+        if jsonData is not None and held_back(acker, requestKey, jsonData):
+            continue
+
+        try:
+            if jsonData is not None:
+                process_request(jsonData, dest_session, destBucket)
+            # invalid requests are dropped too
+            acker.add(requestKey)
+            poller.busy()
+        except Exception as e:
+            logging.error(f"Error processing request {requestKey}: {e}")
+            acker.failed(requestKey, jsonData['widgetId'])
+        if acker.ready():
+            ack_requests(acker, dest_session)
+
+
+"""
+Request bucket loop with a coalescing window. Requests are only deleted
+from the bucket once the net writes for their window have been made
+"""
+def run_coalesced(source_session, sourceBucket, dest_session, destBucket, coalescer, poller=None,
+                  prefetch=8, prefetch_bytes=8 * 1024 * 1024, owns=None, dead_letter_after=None, ack_interval=None):
+    acker = make_acker(source_session, sourceBucket, dead_letter_after, ack_interval)
+    prefetcher = make_prefetcher(source_session, sourceBucket, prefetch, prefetch_bytes, owns=owns, acker=acker)
+    poller = poller or make_poller()
+    try:
+        coalesce_prefetched(dest_session, destBucket, coalescer, prefetcher, acker, poller)
+    finally:
+        prefetcher.close()
+        ack_requests(acker, dest_session)
+
+
+def coalesce_prefetched(dest_session, destBucket, coalescer, prefetcher, acker, poller):
+    def failed(widgetId, keys):
+        for key in keys:
+            acker.failed(key, widgetId)
+
+    # a pass that wrote nothing counts as an empty poll, like run_prefetched
+    def write_window():
+        for key in apply_coalesced(coalescer, dest_session, destBucket, failed):
+            acker.add(key)
+            poller.busy()
+
+    while True:
+        nextRequest = next_request(prefetcher)
+        if nextRequest is None:
+            # nothing left to wait for, write what is buffered
+            write_window()
+            if acker.ready():
+                ack_requests(acker, dest_session)
+            logging.info("No requests to process, checking for more")
+            prefetcher.rewind()
+            acker.rewind()
+            if not poller.idle():
+                logging.info("Finished processing requests, Stopping")
+                break
+            poller.wait()
+            continue
+
+        requestKey, jsonData = nextRequest
+        if jsonData is None:
+            acker.add(requestKey)
+            poller.busy()
+            continue
+        if held_back(acker, requestKey, jsonData):
+            continue
+        if already_applied(jsonData):
+            acker.add(requestKey)
+            continue
+        try:
+            coalescer.add(jsonData, requestKey)
+        except Exception as e:
+            logging.error(f"Error processing request {requestKey}: {e}")
+            acker.failed(requestKey, jsonData['widgetId'])
+            continue
+        if coalescer.ready():
+            write_window()
+        if acker.ready():
+            ack_requests(acker, dest_session)
+
+
+"""
+Write the coalescer's net operations and return the tokens to ack, those
+of the widgets whose writes all went through. Every request of such a
+widget is recorded in the checkpoint journal. A widget whose write failed
+is logged and its remaining writes skipped, failed(widgetId, tokens) is
+called for it and its requests are not acked
+"""
+def apply_coalesced(coalescer, dest_session, destBucket, failed=None):
+    written = []
+    for widgetId, operations, tokens, requestIds in coalescer.drain_widgets():
+        try:
+            for requestType, request in operations:
+                process_request(request, dest_session, destBucket, requestType)
+        except Exception as e:
+            logging.error(f"Error writing widget {widgetId}, keeping its {len(tokens)} requests: {e}")
+            if failed is not None:
+                failed(widgetId, tokens)
+            continue
+        record_applied(requestIds)
+        written.extend(tokens)
+    try:
+        flush_destination(dest_session)
+    except Exception as e:
+        # the batching destination keeps what it could not write, the requests are acked after a later flush
+        logging.error(f"Error flushing the destination, keeping {len(written)} requests: {e}")
+        return []
+    return written
+
+
+"""
+True when an earlier request of the widget failed in this pass, the
+request is left in the bucket so the widget's requests stay in order
+"""
+def held_back(acker, requestKey, jsonData):
+    if not acker.held(jsonData['widgetId']):
+        return False
+    logging.info(f"Holding back request {requestKey} until an earlier one for widget {jsonData['widgetId']} is written")
+    metrics.inc('requests', outcome='held_back')
+    return True
+
+
+"""
+Apply a downloaded request and mark it for deletion from the source
+bucket, runs on the worker that owns the request's widgetId
+"""
+def handle_downloaded_request(requestKey, jsonData, dest_session, destBucket, acker):
+    if held_back(acker, requestKey, jsonData):
+        return
+    try:
+        process_request(jsonData, dest_session, destBucket)
+    except Exception:
+        acker.failed(requestKey, jsonData['widgetId'])
+        raise
+    acker.add(requestKey)
+
+
+"""
+Worker pool version of run. Downloads are done ahead of time by a thread pool,
+then each request is handed to the worker that owns its widgetId, so requests
+for the same widget are still applied in key order.
+
+With a scaler the number of workers follows the listing backlog. It is
+only changed when a new page has been listed, and the pool is drained
+first so a widget never has requests on two workers at once.
+"""
+def run_with_workers(source_session, sourceBucket, dest_session, destBucket,
+                     workers, empty_polls=10, poll_interval=0.5, poller=None, scaler=None,
+                     prefetch_bytes=8 * 1024 * 1024, owns=None, dead_letter_after=None, ack_interval=None):
+    poller = poller or make_poller(empty_polls, poll_interval)
+    pool = KeyedWorkerPool(workers)
+    acker = make_acker(source_session, sourceBucket, dead_letter_after, ack_interval)
+    downloads = make_prefetcher(source_session, sourceBucket, workers * 2, prefetch_bytes,
+                                threads=scaler.max_workers if scaler else workers, owns=owns, acker=acker)
+    lister = downloads.lister
+    pages = lister.pages
+    metrics.gauge('queue_depth', downloads.__len__)
+    metrics.gauge('in_flight', pool.pending)
+    metrics.gauge('workers', lambda: pool.workers)
+
+    try:
+        while True:
+            if scaler is not None and lister.pages != pages:
+                pages = lister.pages
+                target = scaler.target(lister.backlog() + len(downloads))
+                if target != pool.workers:
+                    logging.info(f"Scaling workers from {pool.workers} to {target}, backlog {lister.backlog()}")
+                    pool.resize(target)
+
+            downloads.depth = pool.workers * 2 # downloads allowed in flight at once
+            nextRequest = next_request(downloads)
+
+            if nextRequest is None:
+                # wait for the workers, the next listing skips what they finished
+                pool.join()
+                if acker.ready():
+                    ack_requests(acker, dest_session)
+                logging.info("No requests to process, checking for more")
+                downloads.rewind()
+                acker.rewind()
+                if scaler is not None:
+                    pool.resize(scaler.target(0))
+                if not poller.idle():
+                    logging.info("Finished processing requests, Stopping")
+                    break
+                poller.wait()
                 continue
+            poller.busy()
+
+            # hand downloads over in key order, so each worker sees its widgets in order
+            requestKey, jsonData = nextRequest
+            if jsonData is None:
+                acker.add(requestKey)
+            else:
+                pool.submit(jsonData.get('widgetId', requestKey), handle_downloaded_request,
+                            requestKey, jsonData, dest_session, destBucket, acker)
+            if acker.ready():
+                ack_requests(acker, dest_session)
+    finally:
+        metrics.remove_gauge('queue_depth')
+        metrics.remove_gauge('in_flight')
+        metrics.remove_gauge('workers')
+        downloads.close()
+        pool.close()
+        ack_requests(acker, dest_session)
+
 
-        # pop the first request from the queue
-        request = requestQueue.pop(0)
+"""
+Apply requests from a local source, (name, body) pairs from fileSource.
+Bodies go through the same validation and writes as the request bucket.
+With workers > 1 requests are handed to the worker that owns their
+widgetId, so each widget's requests are still applied in order. The
+destination is flushed and the checkpoint committed every commit_every
+requests, so a replay that is stopped can be run again and skips what it
+already wrote
+"""
+def run_replay(requests, dest_session, destBucket, workers=1, coalescer=None, commit_every=5000):
+    pool = KeyedWorkerPool(workers) if workers > 1 and coalescer is None else None
+    if pool is not None:
+        from shardedConsumer import widget_id_of
+    count = 0
+    try:
+        for name, body in requests:
+            count += 1
+            if pool is not None:
+                pool.submit(widget_id_of(body, name), replay_request, name, body, dest_session, destBucket)
+            elif coalescer is not None:
+                jsonData = checked_request(body, name)
+                try:
+                    if jsonData is not None and not already_applied(jsonData):
+                        coalescer.add(jsonData, name)
+                except Exception as e:
+                    logging.error(f"Error processing request {name}: {e}")
+                if coalescer.ready():
+                    apply_coalesced(coalescer, dest_session, destBucket)
+            else:
+                replay_request(name, body, dest_session, destBucket)
+
+            if count % commit_every == 0:
+                if pool is not None:
+                    pool.join()
+                try:
+                    flush_destination(dest_session)
+                except Exception as e:
+                    # tried again on the next commit, the checkpoint stays where it was
+                    logging.error(f"Error flushing the destination after {count} requests: {e}")
+                logging.info(f"Replayed {count} requests")
+        if coalescer is not None:
+            apply_coalesced(coalescer, dest_session, destBucket)
+    finally:
+        if pool is not None:
+            pool.close()
+        flush_destination(dest_session)
+    logging.info(f"Finished replaying {count} requests")
+    return count
+
+
+def replay_request(name, body, dest_session, destBucket):
+    jsonData = checked_request(body, name)
+    if jsonData is None:
+        return
+    try:
+        process_request(jsonData, dest_session, destBucket)
+    except Exception as e:
+        logging.error(f"Error processing request {name}: {e}")
 
-        # Download the request from S3 bucket2 and decode it into a dict
-        requestKey = request['Key']
-        logging.info(f"Downloading request: {requestKey}")
-        jsonData = S3Processor.downloadBucket(source_session, sourceBucket, requestKey)
 
-        # delete the request from the bucket
-        source_session.delete_object(Bucket=sourceBucket, Key=request['Key'])
+# options of the sync engine in one process, -e async and -p N would ignore them
+SYNC_ONLY_OPTIONS = {
+    'coalesce_window': '-cw', 'long_running': '-lr', 'max_workers': '-xw', 'max_poll_interval': '-pi',
+    'checkpoint_path': '-cp', 'snapshot_interval': '-si', 'snapshot_partitions': '-sp',
+    'lease_partitions': '-lp', 'write_rate': '-wr', 'unchanged_cache': '-uc', 'dead_letter_after': '-dl',
+}
 
-        # get the type of request
-        requestType = jsonData['type']
-        logging.info(f"Request type: {requestType}")
 
-        if requestType == 'create':
-            create_widget(jsonData, dest_session, destBucket, dynamoDBProcessor())
-        elif requestType == 'update':
-            update_widget(jsonData, dest_session, destBucket, dynamoDBProcessor())
-        elif requestType == 'delete':
-            delete_widget(jsonData, dest_session, destBucket)
+"""
+Check the run_consumer options work together. Returns an error message
+naming the options the chosen engine would ignore, None when they all apply
+"""
+def unsupported_options(engine='sync', processes=1, queue_url=None, from_file=None, from_dir=None, workers=1,
+                        batch_writes=False, **options):
+    replay = from_file or from_dir
+    # leases split the request bucket loops
+    if options.get('lease_partitions') and (queue_url or replay):
+        return "-lp cannot be combined with -q or a replay"
+    if engine == 'async' and not replay:
+        mode = '-e async'
+    elif processes > 1 and not queue_url and not replay:
+        mode = '-p'
+    else:
+        return None
+    ignored = [flag for name, flag in SYNC_ONLY_OPTIONS.items() if options.get(name)]
+    if workers > 1:
+        ignored.append('-w')
+    if batch_writes and mode == '-e async':
+        ignored.append('-bw')
+    if not ignored:
+        return None
+    return f"{', '.join(ignored)} cannot be combined with {mode}"
 
 
 """
 Authenticate the user, get the session, and run the consumer
 Try Catch blocks to catch errors and logs them
 """
-def run_consumer(source, destination, queue_url=None):
-    # Initialize the credentials manager
-    manager = credsManager(source, destination)
+def run_consumer(source, destination, queue_url=None, workers=1, batch_writes=False,
+                 visibility_timeout=None, engine='sync', concurrency=100, processes=1,
+                 coalesce_window=None, coalesce_max=500, kind_cache=None, long_running=False,
+                 max_workers=None, max_poll_interval=None, prefetch=8, prefetch_bytes=8 * 1024 * 1024,
+                 checkpoint_path=None, checkpoint_size=100000, from_file=None, from_dir=None,
+                 snapshot_interval=None, lease_partitions=None, write_rate=None, unchanged_cache=None,
+                 dead_letter_after=None, snapshot_partitions=None):
+    error = unsupported_options(engine=engine, processes=processes, queue_url=queue_url, from_file=from_file,
+                                from_dir=from_dir, workers=workers, batch_writes=batch_writes,
+                                coalesce_window=coalesce_window, long_running=long_running,
+                                max_workers=max_workers, max_poll_interval=max_poll_interval,
+                                checkpoint_path=checkpoint_path, snapshot_interval=snapshot_interval,
+                                snapshot_partitions=snapshot_partitions, lease_partitions=lease_partitions,
+                                write_rate=write_rate, unchanged_cache=unchanged_cache,
+                                dead_letter_after=dead_letter_after)
+    if error:
+        raise ValueError(error)
+
+    # boto3 is only imported once there is something to connect to
+    from credsManager import credsManager
+
+    # Initialize the credentials manager, with a connection for every thread that shares a client
+    pool_connections = max(10, workers, max_workers or 0, concurrency if engine == 'async' else 0)
+    manager = credsManager(source, destination, pool_connections, kind_cache)
+    dest_session = manager.dest_session
+
+    # replays read local files, the engines below only know the request bucket and SQS
+    replay_path = from_file or from_dir
+
+    if engine == 'async' and not replay_path:
+        from asyncEngine import run_async
+        try:
+            run_async(dest_session, manager.destinationBucket, manager.source_session, manager.sourceBucket,
+                      queue_url, concurrency, visibility_timeout,
+                      sqs_client=manager.client('sqs') if queue_url else None)
+        except Exception as e:
+            logging.error(f"Error, could not run consumer\n {e}")
+        return
+
+    if processes > 1 and not queue_url and not replay_path:
+        # every worker process builds its own destination client
+        from shardedConsumer import make_destination_client, run_sharded
+        try:
+            run_sharded(manager.source_session, manager.sourceBucket,
+                        functools.partial(make_destination_client, source, destination, batch_writes),
+                        manager.destinationBucket, processes)
+        except Exception as e:
+            logging.error(f"Error, could not run consumer\n {e}")
+        return
+
+    # pace the writes to what the destination takes, throttled writes are retried at a lower rate
+    if write_rate:
+        from throttle import AdaptiveLimiter, ThrottledClient
+        limiter = AdaptiveLimiter(write_rate, concurrency=max(workers, max_workers or 0, 1))
+        dest_session = ThrottledClient(dest_session, limiter)
+        metrics.gauge('write_rate', lambda: limiter.rate)
+        metrics.gauge('write_concurrency', lambda: limiter.concurrency)
+
+    # skip writes that would leave a widget as it is, remembered next to the checkpoint
+    if unchanged_cache:
+        dest_session = writeCache.open_cache(dest_session, f"{checkpoint_path}.writes" if checkpoint_path else None,
+                                             unchanged_cache)
+
+    # group DynamoDB creates and deletes into BatchWriteItem calls
+    if batch_writes and dest_session.meta.service_model.service_name == "dynamodb":
+        dest_session = DynamoBatchWriter(dest_session)
+
+    # hold S3 widget writes and write them as per owner snapshots
+    ack_interval = None
+    if snapshot_interval and dest_session.meta.service_model.service_name == "s3":
+        dest_session = S3SnapshotWriter(dest_session, snapshot_interval, partitions=snapshot_partitions)
+        # requests are deleted with the snapshots, every delete rewrites the changed ones
+        ack_interval = snapshot_interval
+
+    # fold each widget's requests into their net effect before writing
+    coalescer = None
+    if coalesce_window:
+        coalescer = RequestCoalescer(coalesce_window, coalesce_max,
+                                     merge_updates=dest_session.meta.service_model.service_name == "dynamodb")
+
+    # skip requests an earlier run or an earlier delivery already wrote
+    if checkpoint_path:
+        checkpoint.open_journal(checkpoint_path, checkpoint_size)
+
+    # a long running consumer never stops on its own, empty polls back off up to 20 seconds
+    empty_polls = None if long_running else 10
+    if long_running and max_poll_interval is None:
+        max_poll_interval = 20.0
+
+    # share the request bucket with other consumers, each works the partitions it holds a lease on
+    leases = None
+    if lease_partitions:
+        from leases import LeaseManager
+        leases = LeaseManager(manager.source_session, manager.sourceBucket, lease_partitions).start()
 
     try:
-        if queue_url:
-            run_consumer_with_sqs(queue_url, manager.dest_session, manager.destinationBucket)
+        if replay_path:
+            from fileSource import iter_requests
+            run_replay(iter_requests(replay_path), dest_session, manager.destinationBucket, workers, coalescer)
+
+        elif queue_url:
+            sqs_handler = SQSHandler(queue_url, visibility_timeout=visibility_timeout, sqs=manager.client('sqs'))
+            scaler = BacklogScaler(workers, max_workers) if max_workers and not coalescer else None
+            run_consumer_with_sqs(queue_url, dest_session, manager.destinationBucket, sqs_handler,
+                                  empty_receives=None if long_running else 3, coalescer=coalescer,
+                                  idle_interval=1.0 if max_poll_interval else 0,
+                                  max_idle_interval=max_poll_interval, scaler=scaler,
+                                  # well before the messages become visible again
+                                  ack_interval=min(ack_interval, (visibility_timeout or 30) / 2) if ack_interval else 0.0)
 
         else:
             run(manager.source_session, manager.sourceBucket, 
-            manager.dest_session, manager.destinationBucket)
+            dest_session, manager.destinationBucket, workers=workers, coalescer=coalescer,
+            empty_polls=empty_polls, max_workers=max_workers, max_poll_interval=max_poll_interval,
+            prefetch=prefetch, prefetch_bytes=prefetch_bytes, owns=leases.owns if leases else None,
+            dead_letter_after=dead_letter_after, ack_interval=ack_interval)
     except Exception as e:
         logging.error(f"Error, could not run consumer\n {e}")
+    finally:
+        flush_destination(dest_session, close=True)
+        if leases is not None:
+            leases.close()
+
+
+"""
+Write out anything a batching destination is still holding, then
+checkpoint the requests those writes belong to and the write cache
+"""
+def flush_destination(dest_session, close=False):
+    if isinstance(dest_session, (DynamoBatchWriter, S3SnapshotWriter)):
+        if close:
+            dest_session.close()
+        else:
+            dest_session.flush()
+    if close:
+        checkpoint.close_journal()
+        writeCache.close_cache()
+        return
+    if checkpoint.journal is not None:
+        checkpoint.journal.commit()
+    if writeCache.cache is not None:
+        writeCache.cache.commit()
 
 
 """
-SQS run consumer logic
+SQS run consumer logic. empty_receives long polls in a row that come back
+empty stop the loop, None keeps it running. With a scaler, the number of
+receive loops follows the queue's ApproximateNumberOfMessages. Written
+messages are deleted every ack_interval seconds, after the destination
+is flushed, 0 deletes them after every receive
 """
-def run_consumer_with_sqs(queue_url, dest_session, destBucket):
+def run_consumer_with_sqs(queue_url, dest_session, destBucket, sqs_handler=None,
+                          visibility_timeout=None, empty_receives=3, coalescer=None,
+                          idle_interval=0, max_idle_interval=None, scaler=None, check_interval=5.0,
+                          ack_interval=0.0):
     logging.info(f"Running consumer with SQS queue: {queue_url}")
-    sqs_handler = SQSHandler(queue_url)  # Pass the SQS queue URL
-    # Receive 10 messages at a time, get another 10 if the queue is still full
-    while True:
-        messages = sqs_handler.receive_messages()
-        if not messages:
-            logging.info("No messages to process, stopping")
-            break
-        process_messages_from_sqs(messages, sqs_handler, dest_session, destBucket)
+    if sqs_handler is None:
+        sqs_handler = SQSHandler(queue_url, visibility_timeout=visibility_timeout)  # Pass the SQS queue URL
 
+    make_loop_poller = functools.partial(make_poller, empty_receives, idle_interval, max_idle_interval)
+    try:
+        if scaler is not None and coalescer is None:
+            run_sqs_receivers(sqs_handler, dest_session, destBucket, scaler, make_loop_poller, check_interval,
+                              ack_interval)
+        else:
+            receive_loop(sqs_handler, dest_session, destBucket, make_loop_poller(), coalescer,
+                         ack_interval=ack_interval)
+    finally:
+        metrics.remove_gauge('in_flight')
+        metrics.remove_gauge('workers')
+
+
+"""
+One receive loop. Receives 10 messages at a time with long polling, the
+next receive is already waiting on SQS while the current messages are
+processed. Returns True when it stopped because the queue stayed empty
+"""
+def receive_loop(sqs_handler, dest_session, destBucket, poller, coalescer=None, stopped=None, ack_interval=0.0):
+    receiver = ThreadPoolExecutor(max_workers=1)
+    acker = MessageAcker(sqs_handler, ack_interval)
+    commit = functools.partial(flush_destination, dest_session)
+    next_receive = receiver.submit(sqs_handler.receive_messages)
+    if coalescer is not None:
+        metrics.gauge('queue_depth', lambda: len(coalescer.tokens))
+    try:
+        while stopped is None or not stopped.is_set():
+            messages = next_receive.result()
+            if coalescer is not None and (not messages or coalescer.ready()):
+                sqs_handler.delete_messages(apply_coalesced(coalescer, dest_session, destBucket))
+            if not messages:
+                # a long poll came back empty, the queue has been idle for a while
+                acker.flush(commit)
+                if not poller.idle():
+                    logging.info("No messages to process, stopping")
+                    next_receive = None
+                    return True
+                poller.wait()
+                next_receive = receiver.submit(sqs_handler.receive_messages)
+                continue
+
+            poller.busy()
+            next_receive = receiver.submit(sqs_handler.receive_messages)
+            metrics.add_gauge('in_flight', len(messages))
+            try:
+                process_messages_from_sqs(messages, sqs_handler, dest_session, destBucket, coalescer, acker)
+            finally:
+                metrics.add_gauge('in_flight', -len(messages))
+        return False
+    finally:
+        acker.flush(commit)
+        if coalescer is not None:
+            metrics.remove_gauge('queue_depth')
+        # hand back anything the last receive picked up so it is not stuck until the visibility timeout
+        if next_receive is not None:
+            sqs_handler.release_messages(next_receive.result())
+        receiver.shutdown()
+
+
+"""
+Run between scaler.min_workers and scaler.max_workers receive loops,
+checking the queue's backlog every check_interval seconds. Loops that are
+no longer needed finish their batch and stop. Ends once the loops stop
+on their own because the queue stayed empty.
+Messages for one widget can be handled by two loops at once, the same as
+with two consumers on a standard queue
+"""
+def run_sqs_receivers(sqs_handler, dest_session, destBucket, scaler, make_loop_poller, check_interval=5.0,
+                      ack_interval=0.0):
+    changed = threading.Event()
+    receivers = [] # [thread, stopped event, outcome]
+    drained = False
+
+    def receive(receiver):
+        try:
+            receiver[2] = receive_loop(sqs_handler, dest_session, destBucket, make_loop_poller(), stopped=receiver[1],
+                                       ack_interval=ack_interval)
+        except Exception as e:
+            logging.error(f"Error in SQS receive loop: {e}")
+        finally:
+            changed.set()
+
+    try:
+        while True:
+            alive = []
+            for receiver in receivers:
+                if receiver[0].is_alive():
+                    alive.append(receiver)
+                elif receiver[2]:
+                    # a loop saw the queue stay empty, let the rest finish and start no more
+                    drained = True
+            receivers = alive
+            if drained and not receivers:
+                break
+            target = scaler.target(sqs_handler.approximate_backlog())
+            if not drained:
+                while len(receivers) < target:
+                    receiver = [None, threading.Event(), False]
+                    receiver[0] = threading.Thread(target=receive, args=(receiver,), daemon=True)
+                    receiver[0].start()
+                    receivers.append(receiver)
+            for receiver in receivers[target:]:
+                receiver[1].set()
+            metrics.gauge('workers', len(receivers))
+            changed.wait(check_interval)
+            changed.clear()
+    finally:
+        for thread, stopped, outcome in receivers:
+            stopped.set()
+        for thread, stopped, outcome in receivers:
+            thread.join()
 
-def process_messages_from_sqs(messages, sqs_handler, dest_session, destBucket):
-    for message in messages:
-        logging.info(f"Processing message: {message['MessageId']}")
-        message_body = json.loads(message['Body'])
-        request_type = message_body['type']
 
-        dynamo_processor = dynamoDBProcessor()
-        if request_type == 'create':
-            create_widget(message_body, dest_session, destBucket, dynamo_processor)
-        elif request_type == 'update':
-            update_widget(message_body, dest_session, destBucket, dynamo_processor)
-        elif request_type == 'delete':
-            delete_widget(message_body, dest_session, destBucket)
-        sqs_handler.delete_message(message['ReceiptHandle'])
+"""
+Write a receive's messages. Without a coalescer the written ones go to
+acker and are deleted once it is ready, without an acker right away
+"""
+def process_messages_from_sqs(messages, sqs_handler, dest_session, destBucket, coalescer=None, acker=None):
+    # check the whole batch first, rejected messages are deleted without any write
+    with metrics.time('decode'):
+        checked = get_validator().validate_batch([message['Body'] for message in messages])
+    rejected = []
+    for message, (message_body, errors) in zip(messages, checked):
+        if errors:
+            metrics.inc('requests', outcome='rejected')
+            logging.error(f"Rejected message {message['MessageId']}: {'; '.join(errors)}")
+            rejected.append(message)
+
+    if coalescer is not None:
+        # messages are deleted once the window they fall in has been written
+        for message, (message_body, errors) in zip(messages, checked):
+            if errors:
+                continue
+            if already_applied(message_body):
+                # deleted with the rejected ones, nothing to write
+                rejected.append(message)
+                continue
+            try:
+                coalescer.add(WidgetRequest.from_dict(message_body), message)
+            except Exception as e:
+                # left on the queue, the same as a failed write
+                logging.error(f"Error processing message {message['MessageId']}: {e}")
+        if rejected:
+            sqs_handler.delete_messages(rejected)
+        if coalescer.ready():
+            sqs_handler.delete_messages(apply_coalesced(coalescer, dest_session, destBucket))
+        return
+
+    failed = set()
+    for message, (message_body, errors) in zip(messages, checked):
+        if errors:
+            continue
+        logging.info(f"Processing message: {message['MessageId']}")
+        try:
+            process_request(message_body, dest_session, destBucket)
+        except Exception as e:
+            # left on the queue, SQS delivers it again after the visibility timeout
+            logging.error(f"Error processing message {message['MessageId']}: {e}")
+            failed.add(message['MessageId'])
+
+    # only remove the messages once their writes are committed, a failed commit leaves them on the queue
+    if acker is None:
+        acker = MessageAcker(sqs_handler)
+    acker.add([message for message in messages if message['MessageId'] not in failed])
+    if acker.ready():
+        acker.flush(functools.partial(flush_destination, dest_session))
 
 """
 Main function and command line arguments
@@ -196,18 +930,65 @@ if __name__ == '__main__':
     parser.add_argument('-rb', '--request_bucket', type=str, help="Specify the storage strategy")
     parser.add_argument('-wb', '--widget_bucket', type=str, help="Specify the resources to use")
     parser.add_argument('-q', '--queue_url', type=str, help="Specify the SQS Queue URL")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="Number of worker threads for the request bucket")
+    parser.add_argument('-vt', '--visibility_timeout', type=int, help="Seconds received SQS messages stay hidden")
+    parser.add_argument('-e', '--engine', choices=['sync', 'async'], default='sync', help="Run the consumer loop or the asyncio engine")
+    parser.add_argument('-c', '--concurrency', type=int, default=100, help="Requests in flight with the asyncio engine")
+    parser.add_argument('-p', '--processes', type=int, default=1, help="Worker processes for the request bucket, requests are sharded by widgetId")
+    parser.add_argument('-cw', '--coalesce_window', type=float, help="Seconds to buffer requests and fold each widget's requests into one write")
+    parser.add_argument('-cm', '--coalesce_max', type=int, default=500, help="Requests buffered before the coalescing window is written early")
+    parser.add_argument('-bw', '--batch_writes', action='store_true', help="Group DynamoDB creates and deletes into batch writes")
+    parser.add_argument('-lr', '--long_running', action='store_true', help="Keep polling when the requests run out, waiting longer after every empty poll")
+    parser.add_argument('-xw', '--max_workers', type=int, help="Scale workers between --workers and this many with the backlog")
+    parser.add_argument('-pi', '--max_poll_interval', type=float, help="Longest wait in seconds between empty polls")
+    parser.add_argument('-pf', '--prefetch', type=int, default=8, help="Requests downloaded ahead of the writer")
+    parser.add_argument('-pb', '--prefetch_mb', type=float, default=8, help="Megabytes of requests held ahead of the writer")
+    parser.add_argument('-cp', '--checkpoint', type=str, help="Journal file of written request IDs, already written requests are skipped")
+    parser.add_argument('-cs', '--checkpoint_size', type=int, default=100000, help="Request IDs the checkpoint journal remembers")
+    parser.add_argument('-ff', '--from_file', type=str, help="Replay the requests of a JSONL file instead of reading the request bucket")
+    parser.add_argument('-fd', '--from_dir', type=str, help="Replay a directory of request files instead of reading the request bucket")
+    parser.add_argument('-si', '--snapshot_interval', type=float, help="Hold S3 widget writes and write per owner NDJSON snapshots every this many seconds")
+    parser.add_argument('-sp', '--snapshot_partitions', type=int, help="Hash owners into this many part-NNNNN snapshots instead of one per owner")
+    parser.add_argument('-lp', '--lease_partitions', type=int, help="Share the request bucket with other consumers, split into this many leased partitions")
+    parser.add_argument('-wr', '--write_rate', type=float, help="Start writing at this many capacity units per second and adapt to throttling")
+    parser.add_argument('-uc', '--unchanged_cache', type=int, help="Remember the last write of this many widgets and skip writes that change nothing")
+    parser.add_argument('-dl', '--dead_letter_after', type=int, help="Move a request to dead-letter/ in the request bucket after this many failed writes")
+    parser.add_argument('-kc', '--kind_cache', type=str, help="JSON file that remembers which names are tables and which are buckets")
+    parser.add_argument('-mp', '--metrics_port', type=int, help="Serve Prometheus metrics on this port at /metrics")
+    parser.add_argument('-mf', '--metrics_file', type=str, help="Write Prometheus metrics to this file every --metrics_interval seconds")
+    parser.add_argument('-mi', '--metrics_interval', type=float, default=10.0, help="Seconds between metrics file writes")
     args = parser.parse_args()
-
-    source = args.request_bucket
-    resources_to_use = args.widget_bucket
-    queue_url = args.queue_url
+    # by keyword so a new option cannot shift the others
+    options = dict(source=args.request_bucket, destination=args.widget_bucket, queue_url=args.queue_url,
+                   workers=args.workers, batch_writes=args.batch_writes,
+                   visibility_timeout=args.visibility_timeout, engine=args.engine,
+                   concurrency=args.concurrency, processes=args.processes,
+                   coalesce_window=args.coalesce_window, coalesce_max=args.coalesce_max,
+                   kind_cache=args.kind_cache, long_running=args.long_running,
+                   max_workers=args.max_workers, max_poll_interval=args.max_poll_interval,
+                   prefetch=args.prefetch, prefetch_bytes=int(args.prefetch_mb * 1024 * 1024),
+                   checkpoint_path=args.checkpoint, checkpoint_size=args.checkpoint_size,
+                   from_file=args.from_file, from_dir=args.from_dir,
+                   snapshot_interval=args.snapshot_interval, snapshot_partitions=args.snapshot_partitions,
+                   lease_partitions=args.lease_partitions, write_rate=args.write_rate,
+                   unchanged_cache=args.unchanged_cache, dead_letter_after=args.dead_letter_after)
+    error = unsupported_options(**options)
+    if error:
+        parser.error(error)
+    setup_logging()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    stop_metrics_dump = metrics.dump_every(args.metrics_file, args.metrics_interval) if args.metrics_file else None
 
     # Run consumer with args
     try:
-        run_consumer(source, resources_to_use, queue_url)
+        run_consumer(**options)
     except Exception as e:
         logging.error("Unable to run Consumer")
         logging.error(f"Error: {e}")
+    finally:
+        if stop_metrics_dump:
+            stop_metrics_dump()
 
 """
 Example command: 
@@ -1,15 +1,25 @@
-from S3Processor import S3Processor
-from dynamoDBProcessor import dynamoDBProcessor
-import boto3
+from clientRegistry import get_registry
 import os
 import logging
 
 class credsManager():
-    def __init__(self, sourceBucket, destinationBucket):
+    """
+    Sessions and clients come from the shared client registry, so a second
+    manager for the same credentials (a worker process, a Lambda invocation
+    that reuses its container) reuses the clients instead of building new ones.
+    max_pool_connections should be at least the number of threads calling a client
+    """
+    def __init__(self, sourceBucket, destinationBucket, max_pool_connections=10, kind_cache_path=None):
         self.sourceBucket = sourceBucket
         self.destinationBucket = destinationBucket 
         self.source_session = None
         self.dest_session = None
+        self.creds = None
+        self.max_pool_connections = max_pool_connections
+        options = {'max_pool_connections': max_pool_connections}
+        if kind_cache_path:
+            options['kind_cache_path'] = kind_cache_path
+        self.registry = get_registry(**options)
         try:
             self.creds = self.get_aws_creds()
         except Exception as e:
@@ -53,7 +63,9 @@ class credsManager():
 
     def connect_to_sources(self):
         try:
-            self.source_session = self.get_session(self.sourceBucket)
+            # nothing to probe when requests come from a queue
+            if self.sourceBucket:
+                self.source_session = self.get_session(self.sourceBucket)
             self.dest_session = self.get_session(self.destinationBucket)
         except Exception as e:
             logging.error(f"Error, could not get session\n {e}")
@@ -64,14 +76,14 @@ class credsManager():
     With creds, get the session and return the s3 client or dynamo client
     """ 
     def get_session(self, bucket_name: str):
-        session = boto3.Session(
-            aws_access_key_id=self.creds["aws_access_key_id"],
-            aws_secret_access_key=self.creds["aws_secret_access_key"],
-            aws_session_token=self.creds["aws_session_token"],
-            region_name='us-east-1'
-        )
-        if dynamoDBProcessor.does_dynamo_table_exist(bucket_name, 'us-east-1'):
-            return session.client('dynamodb')
-        elif S3Processor.does_s3_bucket_exist(bucket_name, 'us-east-1'):
-            return session.client('s3')
+        kind = self.registry.resource_kind(bucket_name, self.creds)
+        if kind is not None:
+            return self.client(kind)
+
+
+    """
+    Shared client for any other service, e.g. the SQS queue
+    """
+    def client(self, service):
+        return self.registry.client(service, self.creds, self.max_pool_connections)
 
@@ -0,0 +1,205 @@
+import logging
+import random
+import threading
+import time
+
+from metrics import metrics
+
+
+class DynamoBatchWriter():
+    """
+    Wraps a DynamoDB client and groups put_item and delete_item calls into
+    BatchWriteItem calls of up to 25 items. A batch is sent when it is full
+    or when its oldest item has waited flush_interval seconds.
+
+    A key is never put into a batch that already holds it, the pending batch
+    is sent first, so operations on one widget are written in the order they
+    were made. update_item cannot be batched and goes straight to the client
+    once any earlier write for the same key is done. Everything else is
+    passed through to the wrapped client.
+
+    Items of a batch that could not be written go back to the front of the
+    pending batch, ahead of anything newer for their keys. The timer sends
+    them again, and flush() only returns once every item made before it is
+    written, it raises otherwise, so the requests they belong to are not
+    acked or checkpointed.
+    """
+    def __init__(self, client, batch_size=25, flush_interval=1.0, max_retries=8,
+                 backoff=0.05, key_names=('id',)):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.key_names = key_names
+        self.cond = threading.Condition()
+        self.pending = []
+        self.pendingKeys = set()
+        self.inflight = set()
+        self.oldest = None
+        self.stopped = threading.Event()
+        self.timer = threading.Thread(target=self._flush_on_time, daemon=True)
+        self.timer.start()
+
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+    def put_item(self, TableName, Item):
+        self._add(TableName, self._key(TableName, Item), {'PutRequest': {'Item': Item}})
+
+
+    def delete_item(self, TableName, Key):
+        self._add(TableName, self._key(TableName, Key), {'DeleteRequest': {'Key': Key}})
+
+
+    def update_item(self, **kwargs):
+        self._wait_for_key(self._key(kwargs['TableName'], kwargs['Key']))
+        return self.client.update_item(**kwargs)
+
+
+    """
+    Wait for the batches other threads are sending, then send everything
+    pending, the items they could not write included. Raises if anything
+    is still not written
+    """
+    def flush(self):
+        with self.cond:
+            while self.inflight:
+                self.cond.wait()
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+
+    def close(self):
+        self.stopped.set()
+        self.timer.join()
+        self.flush()
+
+
+    def _key(self, table, item):
+        return (table,) + tuple(item[name]['S'] for name in self.key_names)
+
+
+    def _add(self, table, key, request):
+        while True:
+            added = False
+            with self.cond:
+                while key in self.inflight:
+                    self.cond.wait()
+                if key in self.pendingKeys:
+                    # the earlier operation on this key has to be written first
+                    batch = self._take()
+                else:
+                    self.pending.append((table, key, request))
+                    self.pendingKeys.add(key)
+                    if len(self.pending) == 1:
+                        self.oldest = time.monotonic()
+                    batch = self._take() if len(self.pending) >= self.batch_size else None
+                    added = True
+            if batch and added:
+                # the items stay pending when this fails, the write of this call is not lost
+                try:
+                    self._send(batch)
+                except Exception as e:
+                    logging.error(f"Error writing batch to DynamoDB, keeping its items for the next flush: {e}")
+                return
+            if batch:
+                # raises if the earlier operation could not be written, this one must not go first
+                self._send(batch)
+            if added:
+                return
+
+
+    def _wait_for_key(self, key):
+        while True:
+            with self.cond:
+                while key in self.inflight:
+                    self.cond.wait()
+                if key not in self.pendingKeys:
+                    return
+                batch = self._take()
+            self._send(batch)
+
+
+    """
+    Move the pending batch to in flight, caller must hold the lock
+    """
+    def _take(self):
+        batch = self.pending
+        self.pending = []
+        self.inflight.update(self.pendingKeys)
+        self.pendingKeys = set()
+        self.oldest = None
+        return batch
+
+
+    """
+    Write a batch, batch_size items a call, retrying UnprocessedItems with
+    jittered exponential backoff. Items that could not be written are put
+    back in front of the pending ones and the error is raised
+    """
+    def _send(self, batch):
+        unsent = batch
+        try:
+            while unsent:
+                failed = self._send_batch(unsent[:self.batch_size])
+                if failed:
+                    unsent = failed + unsent[self.batch_size:]
+                    raise Exception(f"Could not write {len(failed)} items after {self.max_retries} retries")
+                unsent = unsent[self.batch_size:]
+        finally:
+            with self.cond:
+                self.inflight.difference_update(key for table, key, request in batch)
+                if unsent:
+                    metrics.inc('batch_write_failed', len(unsent))
+                    self._requeue(unsent)
+                self.cond.notify_all()
+
+
+    """
+    Send one batch, returns the items still unprocessed after the retries
+    """
+    def _send_batch(self, batch):
+        requestItems = {}
+        for table, key, request in batch:
+            requestItems.setdefault(table, []).append(request)
+        for attempt in range(self.max_retries + 1):
+            with metrics.time('batch_write'):
+                response = self.client.batch_write_item(RequestItems=requestItems)
+            requestItems = response.get('UnprocessedItems') or {}
+            if not requestItems:
+                return []
+            # DynamoDB hands items back when the table is throttling
+            metrics.inc('unprocessed_items', sum(len(items) for items in requestItems.values()))
+            if attempt == self.max_retries:
+                break
+            logging.info(f"Retrying {sum(len(items) for items in requestItems.values())} unprocessed items")
+            time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+        return [entry for entry in batch if entry[2] in requestItems.get(entry[0], ())]
+
+
+    """
+    Put items that were not written back in front of the pending batch,
+    caller must hold the lock. Their keys were in flight, so nothing newer
+    for them can be pending
+    """
+    def _requeue(self, items):
+        self.pending[:0] = items
+        self.pendingKeys.update(key for table, key, request in items)
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+
+    def _flush_on_time(self):
+        while not self.stopped.wait(self.flush_interval / 2):
+            with self.cond:
+                due = self.oldest is not None and time.monotonic() - self.oldest >= self.flush_interval
+                batch = self._take() if due else None
+            if batch:
+                try:
+                    self._send(batch)
+                except Exception as e:
+                    logging.error(f"Error writing batch to DynamoDB: {e}")
@@ -1,6 +1,3 @@
-import boto3
-from botocore.exceptions import NoCredentialsError
-
 
 class dynamoDBProcessor():
     def __init__(self):
@@ -44,9 +41,12 @@ class dynamoDBProcessor():
         return dynamodb_data
 
 
-    def does_dynamo_table_exist(table_name, region_name):
+    def does_dynamo_table_exist(table_name, region_name, dynamodb=None):
+        from botocore.exceptions import NoCredentialsError
         try:
-            dynamodb = boto3.client('dynamodb', region_name=region_name)
+            if dynamodb is None:
+                import boto3
+                dynamodb = boto3.client('dynamodb', region_name=region_name)
             response = dynamodb.describe_table(TableName=table_name)
             response = dict(response)
             if response.items():
@@ -0,0 +1,60 @@
+"""
+Request sources on the local disk, for backfills, replays and load tests
+without uploading the requests to the request bucket first.
+
+Both yield (name, body) pairs with the raw request bytes, in order, the
+same shape the request bucket loop gets from GetObject, so the requests go
+through the same validation and create/update/delete code.
+
+    iter_jsonl      one request per line of a JSONL file. The file is
+                    memory mapped and split on newlines as it is read,
+                    only the current line is copied out
+    iter_directory  one request per file, files in name order like the
+                    keys of the request bucket
+"""
+import logging
+import mmap
+import os
+
+
+def iter_jsonl(path):
+    name = os.path.basename(path)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = 0
+            lineNumber = 0
+            end = len(data)
+            while start < end:
+                newline = data.find(b'\n', start)
+                if newline == -1:
+                    newline = end
+                lineNumber += 1
+                line = data[start:newline].strip()
+                start = newline + 1
+                if line:
+                    yield f"{name}:{lineNumber}", line
+
+
+def iter_directory(path):
+    for fileName in sorted(os.listdir(path)):
+        filePath = os.path.join(path, fileName)
+        if fileName.startswith('.') or not os.path.isfile(filePath):
+            continue
+        try:
+            with open(filePath, 'rb') as f:
+                body = f.read()
+        except OSError as e:
+            logging.error(f"Error reading request file {filePath}: {e}")
+            continue
+        yield fileName, body
+
+
+"""
+The requests of a JSONL file or a directory of request files
+"""
+def iter_requests(path):
+    if os.path.isdir(path):
+        return iter_directory(path)
+    return iter_jsonl(path)
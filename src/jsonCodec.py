@@ -0,0 +1,39 @@
+"""
+JSON on bytes. Request bodies come in as bytes (GetObject, SQS, local
+files) and widget objects go out as bytes, so both directions skip the
+str step: loads takes bytes, bytearray, memoryview or str, dumps returns
+bytes ready to be used as a put body.
+
+orjson is used when it is installed, otherwise the standard library.
+orjson writes compact JSON ({"a":1}), the standard library keeps its
+default spacing ({"a": 1}), both decode to the same values.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    BACKEND = 'orjson'
+    DecodeError = orjson.JSONDecodeError # a ValueError, like json.JSONDecodeError
+
+    loads = orjson.loads
+
+    def dumps(value):
+        return orjson.dumps(value)
+
+else:
+    BACKEND = 'json'
+    DecodeError = json.JSONDecodeError
+
+    def loads(data):
+        # json.loads would sniff the encoding of bytes first, request bodies are UTF-8
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = str(data, 'utf-8')
+        return json.loads(data)
+
+    def dumps(value):
+        return json.dumps(value).encode('utf-8')
@@ -0,0 +1,216 @@
+"""
+Split one request bucket between several consumers.
+
+Request keys are hashed into a fixed number of partitions and each
+partition is worked by one consumer at a time, the holder of its lease.
+A lease is an object {prefix}partition-NNNN in the request bucket holding
+the owner and the time it expires. Leases are taken and renewed with
+conditional writes, IfNoneMatch='*' for a partition nobody has leased yet
+and IfMatch on the ETag that was read for an expired or own lease, so two
+consumers never both win the same partition.
+
+Every consumer also keeps a member object {prefix}member-{owner} alive.
+The number of live members sets each consumer's share of the partitions,
+ceil(partitions / members): a consumer over its share lets leases go so a
+newly started one can take them, and the leases of a consumer that died
+are taken over by the others once they expire. Leases are renewed every
+duration / 3 seconds on a daemon thread.
+
+Each consumer still lists the whole bucket, one ListObjectsV2 call per
+1000 keys, but only downloads and deletes the keys of its own partitions.
+Every RequestLister skips the lease prefix, so consumers without leases
+never take these objects for requests.
+Requests for one widget can land in different partitions, the same as
+with two consumers on one bucket or one SQS queue.
+"""
+import logging
+import math
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+import zlib
+
+import jsonCodec
+from metrics import metrics
+from S3Processor import LEASE_PREFIX
+from utils import error_code
+
+LOST = ('PreconditionFailed', 'ConditionalRequestConflict', 'NoSuchKey', '404', '412', '409')
+
+
+class LeaseManager():
+    def __init__(self, session, bucket, partitions=16, owner=None, duration=30.0, prefix=LEASE_PREFIX):
+        self.session = session
+        self.bucket = bucket
+        self.partitions = partitions
+        self.owner = owner or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.duration = duration
+        self.prefix = prefix
+        self.owned = {} # partition -> ETag of our lease object, replaced whole so owns() needs no lock
+        self.renewed = None # monotonic time of the last refresh that went through
+        self.stopped = threading.Event()
+        self.thread = None
+
+
+    def partition_of(self, key):
+        return zlib.crc32(key.encode('utf-8')) % self.partitions
+
+
+    """
+    True for request keys in a partition this consumer holds, never for the lease objects
+    """
+    def owns(self, key):
+        return not key.startswith(self.prefix) and self.partition_of(key) in self.owned
+
+
+    def lease_key(self, partition):
+        return f"{self.prefix}partition-{partition:04d}"
+
+
+    """
+    Renew the leases held, then give up or take partitions until this
+    consumer holds its share. Returns the partitions now held
+    """
+    def refresh(self):
+        now = time.time()
+        self.session.put_object(Bucket=self.bucket, Key=f"{self.prefix}member-{self.owner}",
+                                Body=self._body(now + self.duration))
+        share = math.ceil(self.partitions / max(1, self._live_members(now)))
+
+        owned = {}
+        free = []
+        for partition in range(self.partitions):
+            lease, etag = self._read(self.lease_key(partition))
+            if lease is not None and lease['owner'] == self.owner and etag == self.owned.get(partition):
+                owned[partition] = etag
+            elif lease is None or lease['expires'] < now:
+                free.append((partition, etag))
+
+        # over the share, let the extra leases go for the newer consumers
+        for partition in sorted(owned)[share:]:
+            self._write(partition, owned.pop(partition), 0)
+        for partition, etag in list(owned.items()):
+            etag = self._write(partition, etag, now + self.duration)
+            if etag is None:
+                logging.info(f"Lost the lease on partition {partition}")
+                del owned[partition]
+            else:
+                owned[partition] = etag
+
+        # consumers starting together try the free partitions in different orders
+        random.shuffle(free)
+        for partition, etag in free:
+            if len(owned) >= share:
+                break
+            etag = self._write(partition, etag, now + self.duration)
+            if etag is not None:
+                logging.info(f"Took the lease on partition {partition}")
+                owned[partition] = etag
+
+        self.owned = owned
+        self.renewed = time.monotonic()
+        return set(owned)
+
+
+    def _live_members(self, now):
+        members = 0
+        for key in self._list(f"{self.prefix}member-"):
+            member, _ = self._read(key)
+            if member is None:
+                continue
+            if member['expires'] >= now:
+                members += 1
+            elif member['expires'] < now - self.duration:
+                # a consumer that died, a live one would have written it again by now
+                self.session.delete_object(Bucket=self.bucket, Key=key)
+        return members
+
+
+    def _list(self, prefix):
+        keys = []
+        params = {'Bucket': self.bucket, 'Prefix': prefix}
+        while True:
+            response = self.session.list_objects_v2(**params)
+            keys.extend(item['Key'] for item in response.get('Contents', []))
+            if not response.get('IsTruncated'):
+                return keys
+            params['ContinuationToken'] = response['NextContinuationToken']
+
+
+    """
+    A lease or member object and its ETag, (None, None) if there is none
+    """
+    def _read(self, key):
+        try:
+            response = self.session.get_object(Bucket=self.bucket, Key=key)
+        except Exception as e:
+            if error_code(e) in ('NoSuchKey', '404', 'NotFound'):
+                return None, None
+            raise
+        return jsonCodec.loads(response['Body'].read()), response.get('ETag')
+
+
+    """
+    Write a lease on the condition it still has the ETag that was read, or
+    does not exist yet. Returns the new ETag, None if another consumer got there first
+    """
+    def _write(self, partition, etag, expires):
+        condition = {'IfMatch': etag} if etag is not None else {'IfNoneMatch': '*'}
+        try:
+            response = self.session.put_object(Bucket=self.bucket, Key=self.lease_key(partition),
+                                               Body=self._body(expires), **condition)
+        except Exception as e:
+            if error_code(e) in LOST:
+                return None
+            raise
+        return response.get('ETag')
+
+
+    def _body(self, expires):
+        return jsonCodec.dumps({'owner': self.owner, 'expires': expires})
+
+
+    """
+    Take the first leases now and keep them renewed on a daemon thread
+    """
+    def start(self):
+        self.refresh()
+        metrics.gauge('leased_partitions', lambda: len(self.owned))
+        self.thread = threading.Thread(target=self._refresh_on_time, daemon=True)
+        self.thread.start()
+        return self
+
+
+    """
+    Stop renewing and hand the leases back so other consumers take them at once
+    """
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            metrics.remove_gauge('leased_partitions')
+        owned, self.owned = self.owned, {}
+        for partition, etag in owned.items():
+            try:
+                self._write(partition, etag, 0)
+            except Exception as e:
+                logging.error(f"Error releasing the lease on partition {partition}: {e}")
+        try:
+            self.session.delete_object(Bucket=self.bucket, Key=f"{self.prefix}member-{self.owner}")
+        except Exception as e:
+            logging.error(f"Error removing lease member {self.owner}: {e}")
+
+
+    def _refresh_on_time(self):
+        while not self.stopped.wait(self.duration / 3):
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(f"Error renewing leases in bucket {self.bucket}: {e}")
+                # the leases have run out by now and other consumers may hold them
+                if self.owned and time.monotonic() - self.renewed >= self.duration:
+                    logging.error("Leases expired, stopping work on their partitions")
+                    self.owned = {}
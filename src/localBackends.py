@@ -0,0 +1,488 @@
+"""
+In-process stand-ins for the S3, DynamoDB and SQS clients the consumer uses.
+They answer the same calls with the same response shapes as the boto3
+clients, and can add a fixed latency to each call to act like a network
+round trip. Used for benchmarks and tests, never for real work.
+
+Failures can be injected, either at random with fail_rate (optionally only
+for the calls named in fail_calls) or for the next few calls of a method
+with fail_next. A failed call raises LocalServiceError before doing
+anything, with a response shaped like botocore's ClientError.
+"""
+import asyncio
+import bisect
+import hashlib
+import io
+import itertools
+import math
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class _ServiceModel():
+    def __init__(self, service_name):
+        self.service_name = service_name
+
+
+class _Meta():
+    def __init__(self, service_name):
+        self.service_model = _ServiceModel(service_name)
+
+
+class LocalServiceError(Exception):
+    def __init__(self, code, operation):
+        super().__init__(code, operation)
+        self.response = {'Error': {'Code': code, 'Message': f"Injected {code}"}}
+        self.operation_name = operation
+
+
+    def __str__(self):
+        return f"An error occurred ({self.response['Error']['Code']}) when calling the {self.operation_name} operation"
+
+
+class LocalClient():
+    def __init__(self, service_name, latency=0.0, fail_rate=0.0, fail_calls=None,
+                 fail_code='InternalError', seed=None):
+        self.meta = _Meta(service_name)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.failures = {}
+        self.fail_rate = fail_rate
+        self.fail_calls = set(fail_calls) if fail_calls else None
+        self.fail_code = fail_code
+        self.failNext = {} # call name -> [count, code]
+        self.random = random.Random(seed)
+
+
+    """
+    Make the next count calls of a method fail
+    """
+    def fail_next(self, name, count=1, code=None):
+        with self.lock:
+            self.failNext[name] = [count, code or self.fail_code]
+
+
+    """
+    Count the call, wait out the simulated round trip and raise any injected failure
+    """
+    def _call(self, name):
+        code = None
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            pending = self.failNext.get(name)
+            if pending:
+                pending[0] -= 1
+                code = pending[1]
+                if pending[0] == 0:
+                    del self.failNext[name]
+            elif self.fail_rate and (self.fail_calls is None or name in self.fail_calls) \
+                    and self.random.random() < self.fail_rate:
+                code = self.fail_code
+            if code is not None:
+                self.failures[name] = self.failures.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if code is not None:
+            raise LocalServiceError(code, name)
+
+
+class LocalS3(LocalClient):
+    def __init__(self, latency=0.0, **faults):
+        super().__init__('s3', latency, **faults)
+        self.buckets = {}
+        self.sortedKeys = {}
+
+
+    def create_bucket(self, Bucket):
+        with self.lock:
+            self.buckets.setdefault(Bucket, {})
+            self.sortedKeys.setdefault(Bucket, [])
+
+
+    def head_bucket(self, Bucket):
+        self._call('head_bucket')
+        if Bucket not in self.buckets:
+            raise Exception(f"NoSuchBucket: {Bucket}")
+        return {}
+
+
+    def list_objects(self, Bucket, MaxKeys=1000):
+        self._call('list_objects')
+        with self.lock:
+            keys = self.sortedKeys[Bucket][:MaxKeys]
+        response = {'Name': Bucket, 'MaxKeys': MaxKeys}
+        if keys:
+            response['Contents'] = [{'Key': key} for key in keys]
+        return response
+
+
+    """
+    The continuation token is just the last key of the previous page
+    """
+    def list_objects_v2(self, Bucket, MaxKeys=1000, StartAfter=None, ContinuationToken=None, Prefix=''):
+        self._call('list_objects_v2')
+        after = ContinuationToken or StartAfter
+        with self.lock:
+            sortedKeys = self.sortedKeys[Bucket]
+            start = bisect.bisect_right(sortedKeys, after) if after is not None else 0
+            start = max(start, bisect.bisect_left(sortedKeys, Prefix))
+            # keys with the prefix are one run of the sorted keys
+            end = bisect.bisect_left(sortedKeys, Prefix + '\U0010ffff') if Prefix else len(sortedKeys)
+            keys = sortedKeys[start:min(end, start + MaxKeys)]
+            truncated = start + MaxKeys < end
+            objects = self.buckets[Bucket]
+            contents = [{'Key': key, 'Size': len(objects[key]), 'ETag': _etag(objects[key])} for key in keys]
+        response = {'Name': Bucket, 'MaxKeys': MaxKeys, 'KeyCount': len(keys), 'IsTruncated': truncated}
+        if keys:
+            response['Contents'] = contents
+        if truncated:
+            response['NextContinuationToken'] = keys[-1]
+        return response
+
+
+    def get_object(self, Bucket, Key):
+        self._call('get_object')
+        with self.lock:
+            body = self.buckets[Bucket].get(Key)
+        if body is None:
+            raise LocalServiceError('NoSuchKey', 'get_object')
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body), 'ETag': _etag(body)}
+
+
+    """
+    IfNoneMatch='*' only writes a new key and IfMatch only overwrites the
+    object with that ETag, like S3's conditional writes. A failed
+    condition raises PreconditionFailed, or NoSuchKey for IfMatch on a
+    missing key
+    """
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        self._call('put_object')
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        Body = bytes(Body)
+        with self.lock:
+            bucket = self.buckets.setdefault(Bucket, {})
+            current = bucket.get(Key)
+            if IfNoneMatch == '*' and current is not None:
+                raise LocalServiceError('PreconditionFailed', 'put_object')
+            if IfMatch is not None:
+                if current is None:
+                    raise LocalServiceError('NoSuchKey', 'put_object')
+                if _etag(current) != IfMatch:
+                    raise LocalServiceError('PreconditionFailed', 'put_object')
+            if current is None:
+                bisect.insort(self.sortedKeys.setdefault(Bucket, []), Key)
+            bucket[Key] = Body
+        return {'ETag': _etag(Body)}
+
+
+    def copy_object(self, Bucket, Key, CopySource):
+        self._call('copy_object')
+        with self.lock:
+            body = self.buckets.get(CopySource['Bucket'], {}).get(CopySource['Key'])
+            if body is None:
+                raise LocalServiceError('NoSuchKey', 'copy_object')
+            bucket = self.buckets.setdefault(Bucket, {})
+            if Key not in bucket:
+                bisect.insort(self.sortedKeys.setdefault(Bucket, []), Key)
+            bucket[Key] = body
+        return {'CopyObjectResult': {'ETag': _etag(body)}}
+
+
+    def delete_object(self, Bucket, Key):
+        self._call('delete_object')
+        with self.lock:
+            if self.buckets.get(Bucket, {}).pop(Key, None) is not None:
+                sortedKeys = self.sortedKeys[Bucket]
+                del sortedKeys[bisect.bisect_left(sortedKeys, Key)]
+        return {}
+
+
+    def delete_objects(self, Bucket, Delete):
+        self._call('delete_objects')
+        deleted = []
+        with self.lock:
+            objects = self.buckets.get(Bucket, {})
+            sortedKeys = self.sortedKeys.get(Bucket, [])
+            for item in Delete['Objects']:
+                if objects.pop(item['Key'], None) is not None:
+                    del sortedKeys[bisect.bisect_left(sortedKeys, item['Key'])]
+                deleted.append({'Key': item['Key']})
+        return {} if Delete.get('Quiet') else {'Deleted': deleted}
+
+
+def _etag(body):
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+
+class LocalDynamoDB(LocalClient):
+    """
+    With capacity set the table has that many write capacity units per
+    second, one per started KB of an item, with up to a second's worth
+    saved up. A single write over it raises
+    ProvisionedThroughputExceededException, a BatchWriteItem hands the
+    items over it back as UnprocessedItems. Writes report ConsumedCapacity
+    when asked to with ReturnConsumedCapacity
+    """
+    def __init__(self, latency=0.0, capacity=None, **faults):
+        super().__init__('dynamodb', latency, **faults)
+        self.tables = {}
+        self.capacity = capacity
+        self.credit = capacity or 0
+        self.refilled = time.monotonic()
+        self.consumed = 0.0
+
+
+    """
+    Take units of write capacity, False when the table has none left, caller must hold the lock
+    """
+    def _consume(self, units):
+        if self.capacity is not None:
+            now = time.monotonic()
+            self.credit = min(self.capacity, self.credit + (now - self.refilled) * self.capacity)
+            self.refilled = now
+            if self.credit < units:
+                return False
+            self.credit -= units
+        self.consumed += units
+        return True
+
+
+    def _write_units(self, name, item):
+        units = max(1, math.ceil(len(repr(item)) / 1024))
+        with self.lock:
+            if not self._consume(units):
+                self.failures[name] = self.failures.get(name, 0) + 1
+                raise LocalServiceError('ProvisionedThroughputExceededException', name)
+        return units
+
+
+    def _consumed(self, tableName, units, ReturnConsumedCapacity):
+        if ReturnConsumedCapacity in ('TOTAL', 'INDEXES'):
+            return {'ConsumedCapacity': {'TableName': tableName, 'CapacityUnits': float(units)}}
+        return {}
+
+
+    def create_table(self, TableName):
+        with self.lock:
+            self.tables.setdefault(TableName, {})
+
+
+    def describe_table(self, TableName):
+        self._call('describe_table')
+        if TableName not in self.tables:
+            raise Exception(f"ResourceNotFoundException: {TableName}")
+        return {'Table': {'TableName': TableName}}
+
+
+    def put_item(self, TableName, Item, ReturnConsumedCapacity=None):
+        self._call('put_item')
+        units = self._write_units('put_item', Item)
+        with self.lock:
+            self.tables.setdefault(TableName, {})[Item['id']['S']] = dict(Item)
+        return self._consumed(TableName, units, ReturnConsumedCapacity)
+
+
+    """
+    Only the "SET #name = :value, ..." form built by getUpdateExpression is understood
+    """
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues,
+                    ExpressionAttributeNames, ReturnConsumedCapacity=None):
+        self._call('update_item')
+        item = {}
+        for assignment in UpdateExpression[len('SET '):].split(', '):
+            name, value = assignment.split(' = ')
+            item[ExpressionAttributeNames[name]] = ExpressionAttributeValues[value]
+        units = self._write_units('update_item', item)
+        with self.lock:
+            table = self.tables.setdefault(TableName, {})
+            table.setdefault(Key['id']['S'], dict(Key)).update(item)
+        return self._consumed(TableName, units, ReturnConsumedCapacity)
+
+
+    def delete_item(self, TableName, Key, ReturnConsumedCapacity=None):
+        self._call('delete_item')
+        units = self._write_units('delete_item', Key)
+        with self.lock:
+            self.tables.get(TableName, {}).pop(Key['id']['S'], None)
+        return self._consumed(TableName, units, ReturnConsumedCapacity)
+
+
+    """
+    Applies the requests in order until the table runs out of capacity,
+    the rest come back unprocessed
+    """
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity=None):
+        self._call('batch_write_item')
+        unprocessed = {}
+        consumed = []
+        with self.lock:
+            for tableName, requests in RequestItems.items():
+                table = self.tables.setdefault(tableName, {})
+                units = 0
+                for position, request in enumerate(requests):
+                    if 'PutRequest' in request:
+                        item = request['PutRequest']['Item']
+                        cost = max(1, math.ceil(len(repr(item)) / 1024))
+                    else:
+                        cost = 1
+                    if unprocessed or not self._consume(cost):
+                        unprocessed[tableName] = requests[position:]
+                        break
+                    units += cost
+                    if 'PutRequest' in request:
+                        table[item['id']['S']] = dict(item)
+                    else:
+                        table.pop(request['DeleteRequest']['Key']['id']['S'], None)
+                consumed.append({'TableName': tableName, 'CapacityUnits': float(units)})
+        response = {'UnprocessedItems': unprocessed}
+        if ReturnConsumedCapacity in ('TOTAL', 'INDEXES'):
+            response['ConsumedCapacity'] = consumed
+        return response
+
+
+class LocalSQS(LocalClient):
+    """
+    A single in-memory queue. Received messages are hidden until they are
+    deleted or their visibility timeout runs out, like a standard queue
+    """
+    def __init__(self, latency=0.0, visibility_timeout=30, **faults):
+        super().__init__('sqs', latency, **faults)
+        self.visibility_timeout = visibility_timeout
+        self.messages = OrderedDict() # MessageId -> [body, receipt handle, visible at]
+        self.receipts = {}
+        self.ids = itertools.count()
+        self.arrived = threading.Condition(self.lock)
+
+
+    def send_message(self, QueueUrl, MessageBody):
+        self._call('send_message')
+        return {'MessageId': self._add(MessageBody)}
+
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self._call('send_message_batch')
+        successful = [{'Id': entry['Id'], 'MessageId': self._add(entry['MessageBody'])} for entry in Entries]
+        return {'Successful': successful, 'Failed': []}
+
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=None):
+        self._call('receive_message')
+        deadline = time.monotonic() + WaitTimeSeconds
+        hidden_for = self.visibility_timeout if VisibilityTimeout is None else VisibilityTimeout
+        with self.arrived:
+            while True:
+                now = time.monotonic()
+                received = []
+                for messageId, message in self.messages.items():
+                    if message[2] <= now:
+                        message[1] = str(uuid.uuid4())
+                        message[2] = now + hidden_for
+                        self.receipts[message[1]] = messageId
+                        received.append({'MessageId': messageId, 'ReceiptHandle': message[1], 'Body': message[0]})
+                        if len(received) == MaxNumberOfMessages:
+                            break
+                if received or now >= deadline:
+                    break
+                self.arrived.wait(min(deadline - now, 0.05))
+        return {'Messages': received} if received else {}
+
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self._call('delete_message')
+        with self.lock:
+            self._delete(ReceiptHandle)
+        return {}
+
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self._call('delete_message_batch')
+        successful, failed = [], []
+        with self.lock:
+            for entry in Entries:
+                if self._delete(entry['ReceiptHandle']):
+                    successful.append({'Id': entry['Id']})
+                else:
+                    failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid'})
+        return {'Successful': successful, 'Failed': failed}
+
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self._call('change_message_visibility_batch')
+        with self.arrived:
+            for entry in Entries:
+                messageId = self.receipts.get(entry['ReceiptHandle'])
+                if messageId in self.messages:
+                    self.messages[messageId][2] = time.monotonic() + entry['VisibilityTimeout']
+            self.arrived.notify_all()
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None):
+        self._call('get_queue_attributes')
+        now = time.monotonic()
+        with self.lock:
+            visible = sum(1 for message in self.messages.values() if message[2] <= now)
+            hidden = len(self.messages) - visible
+        return {'Attributes': {'ApproximateNumberOfMessages': str(visible),
+                               'ApproximateNumberOfMessagesNotVisible': str(hidden)}}
+
+
+    def _add(self, body):
+        with self.arrived:
+            messageId = str(next(self.ids))
+            self.messages[messageId] = [body, None, 0]
+            self.arrived.notify_all()
+        return messageId
+
+
+    """
+    Caller must hold the lock. A handle from an older receive is not valid any more
+    """
+    def _delete(self, receiptHandle):
+        messageId = self.receipts.pop(receiptHandle, None)
+        message = self.messages.get(messageId)
+        if message is None or message[1] != receiptHandle:
+            return False
+        del self.messages[messageId]
+        return True
+
+
+class AsyncLocalClient():
+    """
+    Async stand-in for the asyncio engine. Wraps one of the local clients
+    above, created with no latency of its own, and waits the simulated
+    round trip with asyncio.sleep so hundreds of calls can be in flight
+    """
+    def __init__(self, client, latency=0.0):
+        self.client = client
+        self.meta = client.meta
+        self.latency = latency
+
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        async def call(**params):
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return method(**params)
+        return call
+
+
+    """
+    Long poll without blocking the event loop
+    """
+    async def receive_message(self, WaitTimeSeconds=0, **params):
+        deadline = time.monotonic() + WaitTimeSeconds
+        while True:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            response = self.client.receive_message(WaitTimeSeconds=0, **params)
+            if response.get('Messages') or time.monotonic() >= deadline:
+                return response
+            await asyncio.sleep(min(0.05, max(0, deadline - time.monotonic())))
@@ -0,0 +1,256 @@
+"""
+Counters, gauges and latency histograms for the consumer, exported in the
+Prometheus text format over HTTP or dumped to a file every few seconds.
+
+Stage timings use these stage names:
+    list            ListObjectsV2 on the request bucket
+    download        GetObject of one request
+    decode          JSON decode and schema check
+    source_delete   DeleteObject of a finished request
+    write           the destination call, labelled with the request type
+    batch_write     one BatchWriteItem call of the DynamoDB batch writer
+    receive         one SQS ReceiveMessage long poll
+    ack             one DeleteMessageBatch call
+    snapshot        writing one aggregated widget snapshot and its index
+
+Recording is a lock and a few additions, cheap enough to leave on.
+"""
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+from utils import replace_file
+
+
+# seconds, wide enough for a local call and a throttled DynamoDB write
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram():
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Timer():
+    """
+    with metrics.time('download'): ... records the block's duration
+    """
+    __slots__ = ('histogram', 'lock', 'started')
+
+    def __init__(self, histogram, lock):
+        self.histogram = histogram
+        self.lock = lock
+
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        with self.lock:
+            self.histogram.observe(elapsed)
+
+
+class Metrics():
+    def __init__(self, prefix='consumer'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}   # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> Histogram
+        self.gauges = {}     # name -> value or function returning it
+        self.keys = {}       # labels in call order -> sorted key, saves sorting on every call
+        self.stages = {}     # (stage, type) -> stage_seconds Histogram
+
+
+    def _key(self, name, labels):
+        callKey = (name, tuple(labels.items()))
+        key = self.keys.get(callKey)
+        if key is None:
+            key = self.keys[callKey] = (name, tuple(sorted(labels.items())))
+        return key
+
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+
+    """
+    Time one stage, type is the request type for stages that have one
+    """
+    def time(self, stage, type=None):
+        histogram = self.stages.get((stage, type))
+        if histogram is None:
+            labels = {'stage': stage} if type is None else {'stage': stage, 'type': type}
+            key = self._key('stage_seconds', labels)
+            with self.lock:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+            self.stages[(stage, type)] = histogram
+        return Timer(histogram, self.lock)
+
+
+    """
+    Set a gauge to a value, or to a function read at export time
+    """
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+
+    """
+    Add delta to a gauge holding a number, for gauges several threads move
+    """
+    def add_gauge(self, name, delta):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+
+    def remove_gauge(self, name):
+        with self.lock:
+            self.gauges.pop(name, None)
+
+
+    def counter_value(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+
+    def histogram(self, name, **labels):
+        with self.lock:
+            return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+
+    """
+    Everything recorded so far in the Prometheus text format
+    """
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            gauges = sorted(self.gauges.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            name = f"{self.prefix}_{name}_total"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+        for name, value in gauges:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception as e:
+                    logging.error(f"Error reading gauge {name}: {e}")
+                    continue
+            name = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+
+        for (name, labels), histogram in histograms:
+            name = f"{self.prefix}_{name}"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+    """
+    Serve /metrics on a daemon thread, returns the server so it can be shut down
+    """
+    def serve(self, port, host=''):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Serving metrics on port {server.server_address[1]}")
+        return server
+
+
+    """
+    Write the metrics to path every interval seconds on a daemon thread.
+    Returns a function that stops the thread and writes a last time
+    """
+    def dump_every(self, path, interval=10.0):
+        stopped = threading.Event()
+
+        def dump_loop():
+            while not stopped.wait(interval):
+                self.dump(path)
+
+        thread = threading.Thread(target=dump_loop, daemon=True)
+        thread.start()
+
+        def stop():
+            stopped.set()
+            thread.join()
+            self.dump(path)
+        return stop
+
+
+    def dump(self, path):
+        try:
+            replace_file(path, self.render())
+        except OSError as e:
+            logging.error(f"Error writing metrics to {path}: {e}")
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+# the process wide metrics every module records to
+metrics = Metrics()
@@ -0,0 +1,115 @@
+"""
+Single pass request transformer. Turns a raw widget request straight into
+the S3 object or the DynamoDB item / update_item arguments, giving the
+same output as consumer.processData followed by dynamoDBProcessor.processData
+and getUpdateExpression, without the intermediate copies.
+
+Update expressions only depend on the attribute names, and most widgets
+share a few shapes, so they are built once per name set and cached.
+"""
+from functools import lru_cache
+
+import jsonCodec
+
+
+"""
+Same as dynamoDBProcessor.convert_dict_to_dynamodb_format for one value
+"""
+def to_dynamo_value(value):
+    if isinstance(value, int):
+        return {'N': str(value)}
+    if isinstance(value, list):
+        return {'L': value}
+    return {'S': str(value)}
+
+
+def owner_path(owner):
+    return owner.replace(" ", "-").lower()
+
+
+def s3_key(request):
+    return f"widgets/{owner_path(request['owner'])}/{request['widgetId']}"
+
+
+"""
+Key and body of the widget object written to S3
+"""
+def to_s3_object(request):
+    data = {}
+    for key, value in request.items():
+        if key == 'requestId':
+            continue
+        data[key] = owner_path(value) if key == 'owner' else value
+    data['id'] = request['widgetId']
+    return f"widgets/{data['owner']}/{data['widgetId']}", jsonCodec.dumps(data)
+
+
+"""
+DynamoDB item. Top level fields keep their order, then id, then fields
+whose names had hyphens, then otherAttributes flattened with hyphens
+turned into underscores, which is the order the old functions produced
+"""
+def to_dynamo_item(request):
+    item = {}
+    renamed = None
+    attributes = ()
+    for key, value in request.items():
+        if key == 'requestId':
+            continue
+        if key == 'otherAttributes':
+            attributes = value
+            continue
+        if key == 'owner':
+            value = owner_path(value)
+        if '-' in key:
+            if renamed is None:
+                renamed = []
+            renamed.append((key.replace('-', '_'), value))
+            continue
+        item[key] = to_dynamo_value(value)
+    item['id'] = to_dynamo_value(request['widgetId'])
+    if renamed:
+        for key, value in renamed:
+            item[key] = to_dynamo_value(value)
+    for attribute in attributes:
+        item[attribute['name'].replace('-', '_')] = to_dynamo_value(attribute['value'])
+    return item
+
+
+"""
+Update expression, names and value placeholders for a tuple of attribute names
+"""
+@lru_cache(maxsize=1024)
+def update_template(names):
+    assignments = []
+    expression_attribute_names = {}
+    placeholders = []
+    for key in names:
+        if key == 'type':
+            name, placeholder = '#widgetType', ':widgetType'
+        elif key == 'owner':
+            name, placeholder = '#widgetOwner', ':widgetOwner'
+        elif key == 'id':
+            continue
+        else:
+            name, placeholder = f"#{key}", f":{key}"
+        assignments.append(f"{name} = {placeholder}")
+        expression_attribute_names[name] = key
+        placeholders.append((placeholder, key))
+    return 'SET ' + ', '.join(assignments), expression_attribute_names, tuple(placeholders)
+
+
+"""
+Keyword arguments for update_item
+"""
+def to_dynamo_update(request, table="widgets"):
+    item = to_dynamo_item(request)
+    update_expression, expression_attribute_names, placeholders = update_template(tuple(item))
+    return {
+        'TableName': table,
+        'Key': {'id': item['id']},
+        'UpdateExpression': update_expression,
+        'ExpressionAttributeValues': {placeholder: item[key] for placeholder, key in placeholders},
+        # copied so a caller changing it cannot change the cached template
+        'ExpressionAttributeNames': dict(expression_attribute_names),
+    }
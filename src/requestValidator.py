@@ -0,0 +1,171 @@
+"""
+Widget request validator compiled from instructions/widgetRequest-schema.json.
+
+The schema is read once and turned into a flat list of field checks with
+precompiled patterns and a required field set per request type, so a
+request is checked with a few dict lookups and no re-serializing. Raw
+bodies (bytes or str) are decoded once and the decoded request is handed
+back, so callers do not parse it a second time.
+
+The schema's type pattern names WidgetCreateRequest etc. while the
+producer sends create/update/delete, both spellings are accepted. The
+short one is used for the per-type required fields, and check() hands a
+valid request back with its type in the short spelling, the only one the
+handlers know. Patterns are searched
+the same way JSON schema does, without anchoring. otherAttributes item
+rules apply to every item, not only the first.
+"""
+import json
+import os
+import re
+from functools import lru_cache
+
+import jsonCodec
+
+
+SCHEMA_FILE = 'widgetRequest-schema.json'
+SCHEMA_PATHS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), SCHEMA_FILE),
+    os.path.join(os.path.dirname(os.path.abspath(os.path.dirname(__file__))), 'instructions', SCHEMA_FILE),
+]
+
+# fields each request type needs on top of the schema's required list
+TYPE_REQUIRED = {
+    'create': ('label', 'description', 'otherAttributes'),
+    'update': ('description', 'otherAttributes'),
+    'delete': (),
+}
+
+JSON_TYPES = {
+    'string': str,
+    'array': list,
+    'object': dict,
+    'integer': int,
+    'number': (int, float),
+    'boolean': bool,
+}
+
+
+class RequestValidator():
+    """
+    validate(request) returns a list of error messages, empty when the
+    request is valid. check(body) also decodes raw bodies and returns
+    (request, errors), request is None when the body is not JSON and a
+    valid request's type is the short name, create, update or delete.
+    validate_batch(bodies) is check for a list, one result per item.
+    """
+    def __init__(self, schema, type_required=TYPE_REQUIRED):
+        properties = schema.get('properties', {})
+        self.required = tuple(schema.get('required', ()))
+        self.fields = []
+        for name, rules in properties.items():
+            if name == 'type':
+                continue
+            pattern = re.compile(rules['pattern']) if 'pattern' in rules else None
+            self.fields.append((name, JSON_TYPES.get(rules.get('type')), pattern, self._compile_items(rules)))
+
+        # request type names, both the schema's and the short ones the producer sends
+        self.types = {}
+        typePattern = properties.get('type', {}).get('pattern', '')
+        for alternative in typePattern.split('|'):
+            match = re.fullmatch(r'Widget(\w+)Request', alternative)
+            if match and match.group(1).lower() in type_required:
+                self.types[alternative] = match.group(1).lower()
+        for short in type_required:
+            self.types[short] = short
+
+        self.type_required = {}
+        for short, extra in type_required.items():
+            self.type_required[short] = self.required + tuple(name for name in extra if name not in self.required)
+
+
+    def _compile_items(self, rules):
+        items = rules.get('items')
+        if rules.get('type') != 'array' or not items:
+            return None
+        if isinstance(items, list):
+            items = items[0]
+        item_properties = items.get('properties', {})
+        return (tuple(items.get('required', ())),
+                tuple((name, JSON_TYPES.get(item_rules.get('type'))) for name, item_rules in item_properties.items()))
+
+
+    def validate(self, request):
+        if isinstance(request, (bytes, bytearray, str)):
+            return self.check(request)[1]
+        if not isinstance(request, dict):
+            return [f"request must be an object, got {type(request).__name__}"]
+
+        requestType = request.get('type')
+        short = self.types.get(requestType) if isinstance(requestType, str) else None
+        if short is None:
+            return [f"unknown request type: {requestType!r}"]
+
+        errors = []
+        for name in self.type_required[short]:
+            if name not in request:
+                errors.append(f"missing required field: {name}")
+
+        for name, expected, pattern, items in self.fields:
+            value = request.get(name)
+            if value is None:
+                continue
+            if expected is not None and not isinstance(value, expected):
+                errors.append(f"{name} must be of type {expected.__name__ if isinstance(expected, type) else 'number'}")
+                continue
+            if pattern is not None and not pattern.search(value):
+                errors.append(f"{name} does not match {pattern.pattern}")
+            if items is not None:
+                self._validate_items(name, value, items, errors)
+        return errors
+
+
+    def _validate_items(self, name, value, items, errors):
+        item_required, item_fields = items
+        for index, item in enumerate(value):
+            if not isinstance(item, dict):
+                errors.append(f"{name}[{index}] must be an object")
+                continue
+            for field in item_required:
+                if field not in item:
+                    errors.append(f"{name}[{index}] missing required field: {field}")
+            for field, expected in item_fields:
+                if field in item and expected is not None and not isinstance(item[field], expected):
+                    errors.append(f"{name}[{index}].{field} must be of type {expected.__name__}")
+
+
+    def check(self, body):
+        if isinstance(body, (bytes, bytearray, str)):
+            try:
+                request = jsonCodec.loads(body)
+            except ValueError as e:
+                return None, [f"request is not valid JSON: {e}"]
+        else:
+            request = body
+        errors = self.validate(request)
+        if not errors and request['type'] != self.types[request['type']]:
+            request = dict(request, type=self.types[request['type']])
+        return request, errors
+
+
+    def validate_batch(self, bodies):
+        return [self.check(body) for body in bodies]
+
+
+"""
+Load the schema file, from next to this module or the instructions folder
+"""
+def load_schema(path=None):
+    for candidate in ([path] if path else SCHEMA_PATHS):
+        if os.path.exists(candidate):
+            with open(candidate) as f:
+                return json.load(f)
+    raise FileNotFoundError(f"Could not find {SCHEMA_FILE}")
+
+
+"""
+Validator for the widget request schema, compiled on first use
+"""
+@lru_cache(maxsize=None)
+def get_validator():
+    return RequestValidator(load_schema())
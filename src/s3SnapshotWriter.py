@@ -0,0 +1,191 @@
+import logging
+import threading
+import zlib
+from collections import OrderedDict
+
+import jsonCodec
+from metrics import metrics
+from utils import error_code
+
+
+TOMBSTONE = {'deleted': True}
+
+
+class S3SnapshotWriter():
+    """
+    Wraps an S3 client and turns the one object per widget writes
+    (widgets/{owner}/{widgetId}) into a few large objects. put_object and
+    delete_object of widget keys are held in memory, only the latest state
+    of each widget is kept, and every flush_interval seconds (or once
+    max_pending widgets are waiting) each changed owner is written out as
+
+        {prefix}{owner}.ndjson       one widget JSON per line
+        {prefix}{owner}.index.json   {widgetId: [offset, length]} of each line
+
+    so a reader can fetch the whole owner sequentially or one widget with a
+    ranged GET. A deleted widget is written as a tombstone line
+    {"id": ..., "owner": ..., "deleted": true} by the flush that deletes it,
+    and dropped the next time its snapshot is rewritten. With partitions
+    set, owners are hashed into that many part-NNNNN snapshots instead, so
+    each flush rewrites fewer, larger objects.
+
+    A snapshot is rewritten whole, merged with what is already in the
+    bucket, so only one writer may own an owner's snapshot at a time. The
+    snapshots of recently written owners are cached, cache_owners of them.
+    Other calls and keys pass through to the wrapped client.
+    """
+    def __init__(self, client, flush_interval=30.0, max_pending=10000, prefix='widgets-aggregated/',
+                 partitions=None, cache_owners=1000):
+        self.client = client
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.prefix = prefix
+        self.partitions = partitions
+        self.cache_owners = cache_owners
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock() # one flush at a time, snapshots are read, merged and rewritten
+        self.pending = {}  # (bucket, snapshot) -> {widgetId: line}
+        self.pendingCount = 0
+        self.snapshots = OrderedDict() # (bucket, snapshot) -> {widgetId: line}, most recent last
+        self.stopped = threading.Event()
+        self.timer = threading.Thread(target=self._flush_on_time, daemon=True)
+        self.timer.start()
+
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        parts = Key.split('/', 2)
+        if kwargs or len(parts) != 3 or parts[0] != 'widgets':
+            return self.client.put_object(Bucket=Bucket, Key=Key, Body=Body, **kwargs)
+        self._add(Bucket, parts[1], parts[2], Body.encode('utf-8') if isinstance(Body, str) else bytes(Body))
+        return {}
+
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        parts = Key.split('/', 2)
+        if kwargs or len(parts) != 3 or parts[0] != 'widgets':
+            return self.client.delete_object(Bucket=Bucket, Key=Key, **kwargs)
+        owner, widgetId = parts[1], parts[2]
+        self._add(Bucket, owner, widgetId, jsonCodec.dumps(dict(id=widgetId, owner=owner, **TOMBSTONE)))
+        return {}
+
+
+    def snapshot_name(self, owner):
+        if self.partitions:
+            return f"part-{zlib.crc32(owner.encode('utf-8')) % self.partitions:05d}"
+        return owner
+
+
+    def _add(self, bucket, owner, widgetId, line):
+        with self.lock:
+            widgets = self.pending.setdefault((bucket, self.snapshot_name(owner)), {})
+            if widgetId not in widgets:
+                self.pendingCount += 1
+            widgets[widgetId] = line
+            full = self.pendingCount >= self.max_pending
+        if full:
+            self.flush()
+
+
+    """
+    Write every changed snapshot. On an error the changes are kept for the
+    next flush and the error is raised, so the requests are not acked
+    """
+    def flush(self):
+        with self.flushLock:
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+                self.pendingCount = 0
+            done = []
+            try:
+                for name, widgets in pending.items():
+                    self._write(name, widgets)
+                    done.append(name)
+            except Exception:
+                self._restore(pending, done)
+                raise
+
+
+    def _restore(self, pending, done):
+        with self.lock:
+            for name, widgets in pending.items():
+                if name in done:
+                    continue
+                # anything added since the flush started is newer
+                current = self.pending.setdefault(name, {})
+                for widgetId, line in widgets.items():
+                    if widgetId not in current:
+                        current[widgetId] = line
+                        self.pendingCount += 1
+
+
+    def _write(self, name, widgets):
+        bucket, snapshot = name
+        state = self._load(bucket, snapshot)
+        # tombstones already written once are compacted away
+        merged = {widgetId: line for widgetId, line in state.items() if not _is_tombstone(line)}
+        merged.update(widgets)
+
+        lines = []
+        index = {}
+        offset = 0
+        for widgetId, line in merged.items():
+            index[widgetId] = [offset, len(line)]
+            lines.append(line)
+            offset += len(line) + 1
+        with metrics.time('snapshot'):
+            # lines first, an index never points past the end of its snapshot
+            self.client.put_object(Bucket=bucket, Key=f"{self.prefix}{snapshot}.ndjson", Body=b'\n'.join(lines) + b'\n')
+            self.client.put_object(Bucket=bucket, Key=f"{self.prefix}{snapshot}.index.json",
+                                   Body=jsonCodec.dumps(index))
+        metrics.inc('snapshots_written')
+        self._cache(name, merged)
+
+
+    """
+    Current widgets of a snapshot, from the cache or the bucket
+    """
+    def _load(self, bucket, snapshot):
+        name = (bucket, snapshot)
+        state = self.snapshots.get(name)
+        if state is not None:
+            self.snapshots.move_to_end(name)
+            return state
+        try:
+            index = jsonCodec.loads(self.client.get_object(
+                Bucket=bucket, Key=f"{self.prefix}{snapshot}.index.json")['Body'].read())
+            data = self.client.get_object(Bucket=bucket, Key=f"{self.prefix}{snapshot}.ndjson")['Body'].read()
+        except Exception as e:
+            if error_code(e) not in ('NoSuchKey', '404', 'NotFound'):
+                raise
+            return {}
+        return {widgetId: data[offset:offset + length] for widgetId, (offset, length) in index.items()}
+
+
+    def _cache(self, name, state):
+        self.snapshots[name] = state
+        self.snapshots.move_to_end(name)
+        while len(self.snapshots) > self.cache_owners:
+            self.snapshots.popitem(last=False)
+
+
+    def close(self):
+        self.stopped.set()
+        self.timer.join()
+        self.flush()
+
+
+    def _flush_on_time(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error writing widget snapshots to S3: {e}")
+
+
+def _is_tombstone(line):
+    return b'"deleted"' in line and jsonCodec.loads(line).get('deleted') is True
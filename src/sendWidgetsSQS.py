@@ -1,48 +1,231 @@
-import boto3
+"""
+Re-queue the requests of a request bucket into an SQS queue, e.g. to seed
+a queue with a backlog for the SQS consumer.
+
+The bucket is listed page by page in key order, objects are downloaded on
+a thread pool and their bodies are sent unchanged with SendMessageBatch,
+10 messages and at most 256 KB per call, several calls in flight. Entries
+SQS fails on its side are retried with backoff, entries it rejects are
+logged and counted. With a progress file the last key the listing got
+to is saved as the run goes, with the keys before it that could not be
+downloaded or sent, and a run that is started again sends those keys
+first and then continues after the last one.
+
+Example:
+    python3 sendWidgetsSQS.py -rb usu-cs5250-quartz-requests -q https://sqs.us-east-1.amazonaws.com/850320733371/cs5260-requests -pp /tmp/requeue.json
+"""
+import argparse
 import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from S3Processor import RequestLister, RequestPrefetcher
+from utils import error_code, replace_file
+
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 256 * 1024
+
+
+class SQSRequeuer():
+    def __init__(self, s3, sqs, bucket, queue_url, threads=16, progress_path=None,
+                 retries=3, backoff=0.1, report_interval=10.0):
+        self.s3 = s3
+        self.sqs = sqs
+        self.bucket = bucket
+        self.queue_url = queue_url
+        self.threads = threads
+        self.progress_path = progress_path
+        self.retries = retries
+        self.backoff = backoff
+        self.report_interval = report_interval
+        self.sent = 0
+        self.failed = 0
+        self.lastKey = None # every key up to this one has been sent, apart from retryKeys
+        self.retryKeys = set() # keys that failed for a reason that can go away, sent again on the next run
+
+
+    """
+    Send the keys that failed last time, then every request after the
+    saved progress. Returns the number of messages sent and failed and the
+    messages per second
+    """
+    def run(self):
+        self._load_progress()
+        started = time.monotonic()
+        if self.retryKeys:
+            logging.info(f"Sending {len(self.retryKeys)} requests that failed on the last run again")
+            self._requeue(KeyList(sorted(self.retryKeys)), started, advance=False)
+        lister = RequestLister(self.s3, self.bucket)
+        lister.lastKey = self.lastKey
+        self._requeue(lister, started, advance=True)
+
+        elapsed = time.monotonic() - started
+        rate = self.sent / elapsed if elapsed else 0.0
+        logging.info(f"Sent {self.sent} messages, {self.failed} failed, {elapsed:.1f} s, {rate:.0f} msg/s")
+        return {'sent': self.sent, 'failed': self.failed, 'seconds': elapsed, 'messages_per_second': rate}
+
+
+    """
+    Send the requests of a lister. advance moves lastKey past the batches
+    that finished, the keys that failed in them are kept in retryKeys
+    """
+    def _requeue(self, lister, started, advance):
+        downloads = RequestPrefetcher(lister, self._download, depth=self.threads * 4, threads=self.threads)
+        senders = ThreadPoolExecutor(max_workers=self.threads)
+        sending = deque() # (keys of the batch, future) in key order
+        lastReport = time.monotonic()
+        batch, batchBytes = [], 0
+        try:
+            while True:
+                nextDownload = downloads.next()
+                if nextDownload is not None:
+                    key, download = nextDownload
+                    try:
+                        body = download.result()
+                    except Exception as e:
+                        self.failed += 1
+                        if error_code(e) in ('NoSuchKey', '404'):
+                            logging.error(f"Request {key} is no longer in the bucket")
+                            self.retryKeys.discard(key)
+                        else:
+                            logging.error(f"Error downloading request {key}: {e}")
+                            self.retryKeys.add(key)
+                        continue
+                    if len(body) > MAX_BATCH_BYTES:
+                        logging.error(f"Request {key} is {len(body)} bytes, over the SQS message limit")
+                        self.failed += 1
+                        self.retryKeys.discard(key)
+                        continue
+                    if len(batch) == MAX_BATCH_ENTRIES or batchBytes + len(body) > MAX_BATCH_BYTES:
+                        sending.append(([key for key, body in batch], senders.submit(self._send_batch, batch)))
+                        batch, batchBytes = [], 0
+                    batch.append((key, body))
+                    batchBytes += len(body)
+                elif batch:
+                    sending.append(([key for key, body in batch], senders.submit(self._send_batch, batch)))
+                    batch = []
+
+                # keep a bounded number of batches in flight, and move the progress past finished ones
+                while sending and (sending[0][1].done() or len(sending) > self.threads * 2 or nextDownload is None):
+                    keys, future = sending.popleft()
+                    sent, rejected, unsent = future.result()
+                    self.sent += sent
+                    self.failed += rejected + len(unsent)
+                    self.retryKeys.difference_update(keys)
+                    self.retryKeys.update(unsent)
+                    if advance:
+                        self.lastKey = keys[-1]
+
+                now = time.monotonic()
+                if now - lastReport >= self.report_interval:
+                    lastReport = now
+                    self._save_progress()
+                    logging.info(f"Sent {self.sent} messages, {self.sent / (now - started):.0f} msg/s")
+                if nextDownload is None and not sending:
+                    break
+        finally:
+            downloads.close()
+            senders.shutdown()
+            self._save_progress()
+
+
+    def _download(self, key):
+        return self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+
+    """
+    Send one batch, retrying the entries SQS failed on its side. Returns
+    the number of entries sent, the number SQS rejected and the keys that
+    were still not sent after the retries
+    """
+    def _send_batch(self, batch):
+        entries = {str(i): (key, body) for i, (key, body) in enumerate(batch)}
+        failed = 0
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=[
+                    {'Id': entryId, 'MessageBody': body.decode('utf-8')} for entryId, (key, body) in entries.items()])
+            except Exception as e:
+                logging.error(f"Error sending {len(entries)} messages to SQS: {e}")
+                response = {'Failed': [{'Id': entryId} for entryId in entries]}
+
+            retry = {}
+            for failure in response.get('Failed', []):
+                key, body = entries[failure['Id']]
+                if failure.get('SenderFault'):
+                    # a message SQS rejects will not be accepted on a retry
+                    logging.error(f"SQS rejected request {key}: {failure.get('Code')} {failure.get('Message')}")
+                    failed += 1
+                else:
+                    retry[failure['Id']] = (key, body)
+            if not retry:
+                return len(batch) - failed, failed, []
+            entries = retry
+            if attempt < self.retries:
+                time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+        unsent = [key for key, body in entries.values()]
+        for key in unsent:
+            logging.error(f"Could not send request {key} after {self.retries} retries")
+        return len(batch) - failed - len(unsent), failed, unsent
+
+
+    def _load_progress(self):
+        if not self.progress_path or not os.path.exists(self.progress_path):
+            return
+        with open(self.progress_path) as f:
+            progress = json.load(f)
+        if progress.get('bucket') == self.bucket and progress.get('queue_url') == self.queue_url:
+            self.lastKey = progress.get('lastKey')
+            self.retryKeys = set(progress.get('retryKeys', []))
+            logging.info(f"Continuing after {self.lastKey}")
+
+
+    def _save_progress(self):
+        if not self.progress_path:
+            return
+        replace_file(self.progress_path, json.dumps({
+            'bucket': self.bucket, 'queue_url': self.queue_url, 'lastKey': self.lastKey,
+            'retryKeys': sorted(self.retryKeys), 'sent': self.sent, 'failed': self.failed}))
+
+
+class KeyList():
+    """
+    Hands out a fixed list of keys the way RequestLister hands out a listing
+    """
+    def __init__(self, keys):
+        self.keys = deque(keys)
+        self.lastSize = 0
+
+
+    def next_key(self):
+        return self.keys.popleft() if self.keys else None
+
+
+    def rewind(self):
+        pass
+
+
+"""
+Main function and command line arguments
+"""
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Send the requests of a bucket to an SQS queue")
+    parser.add_argument('-rb', '--request_bucket', type=str, required=True, help="Bucket to read the requests from")
+    parser.add_argument('-q', '--queue_url', type=str, required=True, help="SQS Queue URL to send the requests to")
+    parser.add_argument('-t', '--threads', type=int, default=16, help="Downloads and SendMessageBatch calls in flight")
+    parser.add_argument('-pp', '--progress_file', type=str, help="Save progress here and continue from it when started again")
+    parser.add_argument('-r', '--retries', type=int, default=3, help="Retries for messages SQS failed to take")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def send_widgets_to_sqs(s3_bucket, queue_url):
-    sqs = boto3.client('sqs')
-    s3 = boto3.client('s3')
-
-    response = s3.list_objects_v2(Bucket=s3_bucket)
-
-    if 'Contents' in response:
-        for obj in response['Contents']:
-            widget_object = s3.get_object(Bucket=s3_bucket, Key=obj['Key'])
-            widget_data = widget_object['Body'].read().decode('utf-8')
-            widget_data_json = json.loads(widget_data)
-
-            print(f"Sending message to SQS queue, ID: {obj['Key']}")
-            print(f"Widget data: {widget_data_json.keys()}")
-            # Prepare the message body for the SQS queue
-
-            type = widget_data_json['type']
-            
-            message_body = {
-                'type': widget_data_json['type'],
-                'requestId': widget_data_json['requestId'],  
-                'widgetId': obj['Key'], 
-                'owner': widget_data_json['owner'], 
-            }
-
-            if type == 'create':
-                message_body['description'] = widget_data_json['description']
-                message_body['label'] =  widget_data_json['label']
-                message_body['otherAttributes'] = widget_data_json['otherAttributes']
-            elif type == 'update':
-                message_body['description'] = widget_data_json['description']
-                message_body['otherAttributes'] = widget_data_json['otherAttributes']
-            elif type == 'delete':
-                pass
-            # Send the message to the SQS queue
-            sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(message_body))
-
-
-s3_bucket_name = 'usu-cs5250-quartz-requests'
-sqs_queue_url = 'https://sqs.us-east-1.amazonaws.com/850320733371/cs5260-requests'
-send_widgets_to_sqs(s3_bucket_name, sqs_queue_url)
-
-# {"type":"delete","requestId":"21cf74b2-dbf2-46bb-a274-b8e3eac679bf","widgetId":"e50b4381-4332-438f-bcec-bd2b8c0fa5ed","owner":"Sue Smith"}
-# {"type":"update","requestId":"a606601e-4861-4cf8-b948-f534505c24d0","widgetId":"0510d371-0191-43d9-81d5-5a163659ae6f","owner":"Mary Matthews","description":"LJEQMYCCJRZDQFJETHKWYRMWTOPRQYEBWFWQHQUPVTGRXURPPKEYAPEEYAAV","otherAttributes":[{"name":"color","value":"blue"},{"name":"size","value":"360"},{"name":"size-unit","value":"cm"},{"name":"height","value":"920"},{"name":"width","value":"103"},{"name":"width-unit","value":"cm"},{"name":"rating","value":"3.6255655"},{"name":"price","value":"98.76"},{"name":"note","value":"YZAVYFSDXEPIARJWLVFLBMSADGGIVUVSTFHUCKOSWFVKWODINGKECEZFKHVLGWFKYHYVQZVHTMROSVTXMSWQGUMHFORJIZYOXPNOZLFPMCFQPKNRWMWUBTTPOVYPZWODIGBDCKZTBBNICWTPRONOMCCBZUJAYCRHFOJLPKHHELORIRLPLZGUQQHPBTRYZCJKZHMDUSFTXXGFTQHALLTPFIESBIUTKNNBYNDYROAEYQUNUFMZDYDKMVTMRPJMSBPLQVYZNEYAEUXIAQOJEXTLISTXIEESSTZYQDSQKLNGSJYMVGDZSSNHLFAIJWEVTRNQAYQPEITGNZSLERCGJIEVCVMB"}]}
-# {"type":"create","requestId":"8709c06d-9d32-464a-a015-48495781c455","widgetId":"5c94f104-a9b3-4fed-a039-2cc4c631d042","owner":"John Jones","label":"GEDOQ","description":"KCBCDPEATHQBDXJFSQNGRDTKHGFUUTPXRMQFWALYJPYIUBRGOMQCRVCLKJTKRXTDLCQKCHZCIIZVJQVUZYPTZMDHV","otherAttributes":[{"name":"size","value":"777"},{"name":"height","value":"129"},{"name":"width","value":"772"},{"name":"length","value":"46"},{"name":"rating","value":"1.6434183"},{"name":"note","value":"AZOALXMZWOXIXSAKHWPRGTDVRMFUQGIYTLYISZRVRIWQXIBZEBZNEOJBEKOQHCHRCNRBFGMYAPYOHZDIZOTMQJYPUULPVELSVVYVCYBTFWAEZASLGIKCISEDATXIZZYFQCWUMUOMMLXLEPCQFPIKHOCMHGIFMLIBEUYZCWEHOBTXSMTGXOCHHKKWXRXKGFLUTCRMFVHSLLYSCPMOBXFFDWELHLQWSTAPWMNJMPBIBJVOGOFKPAWLUCGBCVHYBKZIFXZYNDIKNDWKRYGCCGIMCXOSEFNGXRCLONQWFYIKZVMVGFDDXHBCWGS"}]}
\ No newline at end of file
+    from clientRegistry import get_registry
+    registry = get_registry(max_pool_connections=args.threads)
+    requeuer = SQSRequeuer(registry.client('s3'), registry.client('sqs'), args.request_bucket, args.queue_url,
+                           args.threads, args.progress_file, args.retries)
+    stats = requeuer.run()
+    print(f"Sent {stats['sent']} messages, {stats['failed']} failed, {stats['messages_per_second']:.0f} msg/s")
@@ -0,0 +1,226 @@
+"""
+Multi-process version of the request bucket consumer.
+
+A dispatcher process lists and downloads requests and hashes each one by
+its widgetId to one of N worker processes, so every widget is handled by a
+single process and its requests stay in key order. The workers do the CPU
+bound part (JSON decode, processData, the DynamoDB conversion) and the
+destination writes with their own boto3 clients, then report the keys they
+finished back to the dispatcher, which deletes them from the request bucket.
+"""
+import logging
+import multiprocessing
+import queue
+import re
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from S3Processor import RequestAcker, RequestLister
+
+
+WIDGET_ID = re.compile(rb'"widgetId"\s*:\s*"([^"]*)"')
+
+
+"""
+Pull the widgetId out of the raw body without decoding the whole request
+"""
+def widget_id_of(body, default):
+    match = WIDGET_ID.search(body)
+    return match.group(1) if match else default.encode('utf-8')
+
+
+"""
+Destination client factory for real runs, called once inside each worker
+"""
+def make_destination_client(source, destination, batch_writes=False):
+    from credsManager import credsManager
+    from dynamoBatchWriter import DynamoBatchWriter
+    dest_session = credsManager(source, destination).dest_session
+    if batch_writes and dest_session.meta.service_model.service_name == "dynamodb":
+        dest_session = DynamoBatchWriter(dest_session)
+    return dest_session
+
+
+"""
+Worker process, applies chunks of (key, body) and reports what it finished.
+Once a widget's request fails its later ones are held back, reported
+without a write, until an empty chunk says the dispatcher starts a new pass
+"""
+def shard_worker(index, inbox, progress, dest_factory, destBucket):
+    from consumer import checked_request, flush_destination, process_request
+    dest_session = dest_factory()
+    heldWidgets = set()
+    while True:
+        chunk = inbox.get()
+        if chunk is None:
+            break
+        if not chunk:
+            heldWidgets.clear()
+            continue
+        done, failed, held = [], [], []
+        for requestKey, body in chunk:
+            request = None
+            try:
+                request = checked_request(body, requestKey)
+                if request is None:
+                    # rejected requests are dropped, the same as in the other loops
+                    done.append(requestKey)
+                    continue
+                if request['widgetId'] in heldWidgets:
+                    held.append(requestKey)
+                    continue
+                process_request(request, dest_session, destBucket)
+                done.append(requestKey)
+            except Exception as e:
+                logging.error(f"Error processing request {requestKey}: {e}")
+                failed.append(requestKey)
+                if request is not None:
+                    heldWidgets.add(request['widgetId'])
+        flush_destination(dest_session)
+        progress.put((index, done, failed, held))
+    flush_destination(dest_session, close=True)
+
+
+class ShardedConsumer():
+    def __init__(self, source_session, sourceBucket, dest_factory, destBucket, processes,
+                 chunk_size=50, download_threads=16, empty_polls=10, poll_interval=0.5):
+        self.source_session = source_session
+        self.sourceBucket = sourceBucket
+        self.dest_factory = dest_factory
+        self.destBucket = destBucket
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.download_threads = download_threads
+        self.empty_polls = empty_polls
+        self.poll_interval = poll_interval
+        self.dispatched = 0
+        self.done = 0
+        self.errors = 0
+        self.held = 0
+        self.per_worker = [0] * processes
+
+
+    def run(self):
+        self.progress = multiprocessing.Queue()
+        self.inboxes = [multiprocessing.Queue(maxsize=4) for _ in range(self.processes)]
+        # start the workers before any threads exist in this process
+        self.workers = [multiprocessing.Process(target=shard_worker, daemon=True,
+                                                args=(i, inbox, self.progress, self.dest_factory, self.destBucket))
+                        for i, inbox in enumerate(self.inboxes)]
+        for worker in self.workers:
+            worker.start()
+
+        self.io = ThreadPoolExecutor(max_workers=self.download_threads)
+        self.acker = RequestAcker(self.source_session, self.sourceBucket)
+        try:
+            self._dispatch()
+        finally:
+            for inbox in self.inboxes:
+                inbox.put(None)
+            for worker in self.workers:
+                worker.join()
+            self._collect()
+            self.acker.flush()
+            self.io.shutdown()
+        logging.info(f"Processed {self.done} requests, {self.errors} errors, per worker {self.per_worker}")
+
+
+    def _dispatch(self):
+        lister = RequestLister(self.source_session, self.sourceBucket)
+        chunks = [[] for _ in range(self.processes)]
+        downloads = deque()
+        window = self.download_threads * 2
+        listed_out = False
+        stop_times = self.empty_polls
+
+        while True:
+            while not listed_out and len(downloads) < window:
+                requestKey = lister.next_key()
+                if requestKey is None:
+                    listed_out = True
+                    break
+                downloads.append((requestKey, self.io.submit(self._download, requestKey)))
+
+            if not downloads:
+                # send what is buffered and wait for it before listing from the start again
+                for index, chunk in enumerate(chunks):
+                    if chunk:
+                        self.inboxes[index].put(chunk)
+                        chunks[index] = []
+                while self.done + self.errors + self.held < self.dispatched:
+                    if not all(worker.is_alive() for worker in self.workers):
+                        raise Exception("A worker process stopped before finishing its requests")
+                    self._collect(block=True)
+                self.acker.flush()
+
+                logging.info("No requests to process, checking for more")
+                lister.rewind()
+                for inbox in self.inboxes:
+                    # the held back widgets get their failed requests first on the next pass
+                    inbox.put([])
+                listed_out = False
+                stop_times -= 1
+                time.sleep(self.poll_interval)
+                if stop_times == 0:
+                    logging.info("Finished processing requests, Stopping")
+                    return
+                continue
+
+            # hand requests over in key order so each worker sees its widgets in order
+            requestKey, download = downloads.popleft()
+            try:
+                body = download.result()
+            except Exception as e:
+                # the widget is not known, end the pass so none of the later requests go ahead of it
+                logging.error(f"Error downloading request {requestKey}, ending the pass: {e}")
+                for requestKey, download in downloads:
+                    download.cancel()
+                downloads.clear()
+                listed_out = True
+                continue
+            index = zlib.crc32(widget_id_of(body, requestKey)) % self.processes
+            chunks[index].append((requestKey, body))
+            self.dispatched += 1
+            if len(chunks[index]) >= self.chunk_size:
+                self.inboxes[index].put(chunks[index])
+                chunks[index] = []
+                self._collect()
+
+
+    def _download(self, requestKey):
+        return self.source_session.get_object(Bucket=self.sourceBucket, Key=requestKey)['Body'].read()
+
+
+    """
+    Read progress reports and delete finished requests from the bucket in
+    batches. Failed and held back requests stay in the bucket and are read
+    again on the next pass, the same as the single process loop
+    """
+    def _collect(self, block=False):
+        while True:
+            try:
+                index, done, failed, held = self.progress.get(block=block, timeout=1 if block else None)
+            except queue.Empty:
+                return
+            block = False
+            self.done += len(done)
+            self.errors += len(failed)
+            self.held += len(held)
+            self.per_worker[index] += len(done)
+            for requestKey in done:
+                self.acker.add(requestKey)
+            for requestKey in failed:
+                self.acker.failed(requestKey)
+            if self.acker.ready():
+                self.acker.flush()
+
+
+"""
+Run the sharded consumer, used by consumer.py --processes
+"""
+def run_sharded(source_session, sourceBucket, dest_factory, destBucket, processes, **options):
+    consumer = ShardedConsumer(source_session, sourceBucket, dest_factory, destBucket, processes, **options)
+    consumer.run()
+    return consumer
@@ -0,0 +1,176 @@
+import json
+import time
+import unittest
+
+from localBackends import LocalS3
+from S3Processor import S3Processor, RequestAcker, RequestLister, RequestPrefetcher
+
+"""
+Tests for reading requests out of the source bucket
+"""
+class TestRequestLister(unittest.TestCase):
+    def setUp(self):
+        self.s3 = LocalS3()
+        self.s3.create_bucket(Bucket='requests')
+        for i in range(25):
+            self.s3.put_object(Bucket='requests', Key=f"{1000 + i}", Body=json.dumps({'n': i}))
+
+
+    def test_follows_continuation_tokens_in_order(self):
+        lister = RequestLister(self.s3, 'requests', page_size=10)
+        keys = []
+        key = lister.next_key()
+        while key is not None:
+            keys.append(key)
+            key = lister.next_key()
+        self.assertEqual(keys, [f"{1000 + i}" for i in range(25)])
+        # three pages plus the empty listing at the end
+        self.assertEqual(self.s3.calls['list_objects_v2'], 4)
+        self.assertLessEqual(len(lister.keys), 10)
+
+
+    def test_resumes_after_last_key(self):
+        lister = RequestLister(self.s3, 'requests', page_size=100)
+        for _ in range(25):
+            lister.next_key()
+        self.assertIsNone(lister.next_key())
+
+        # keys handed out are still in the bucket, only new ones are listed
+        self.s3.put_object(Bucket='requests', Key='1030', Body='{}')
+        self.assertEqual(lister.next_key(), '1030')
+
+
+    def test_rewind_lists_from_the_start(self):
+        lister = RequestLister(self.s3, 'requests', page_size=100)
+        self.assertEqual(lister.next_key(), '1000')
+        lister.rewind()
+        self.assertEqual(lister.next_key(), '1000')
+
+
+    def test_skips_keys_it_does_not_own(self):
+        lister = RequestLister(self.s3, 'requests', page_size=5, owns=lambda key: key in ('1003', '1022'))
+        self.assertEqual(lister.next_key(), '1003')
+        # the pages in between hold none of its keys
+        self.assertEqual(lister.next_key(), '1022')
+        self.assertIsNone(lister.next_key())
+
+
+    def test_download_bucket(self):
+        self.assertEqual(S3Processor.downloadBucket(self.s3, 'requests', '1003'), {'n': 3})
+
+
+
+class TestRequestPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.s3 = LocalS3(latency=0.01)
+        self.s3.create_bucket(Bucket='requests')
+        for i in range(20):
+            self.s3.put_object(Bucket='requests', Key=f"{1000 + i}", Body=json.dumps({'n': i}))
+        self.lister = RequestLister(self.s3, 'requests', page_size=7)
+
+
+    def fetch(self, key):
+        return json.loads(self.s3.get_object(Bucket='requests', Key=key)['Body'].read())
+
+
+    def test_hands_out_requests_in_key_order(self):
+        prefetcher = RequestPrefetcher(self.lister, self.fetch, depth=4)
+        seen = []
+        while (nextDownload := prefetcher.next()) is not None:
+            self.assertLessEqual(len(prefetcher), 4)
+            seen.append(nextDownload[1].result()['n'])
+        prefetcher.close()
+        self.assertEqual(seen, list(range(20)))
+
+
+    def test_byte_cap_limits_read_ahead(self):
+        size = len(json.dumps({'n': 10}))
+        prefetcher = RequestPrefetcher(self.lister, self.fetch, depth=8, max_bytes=size * 2)
+        prefetcher.next()
+        self.assertEqual(len(prefetcher), 2)
+        self.assertLessEqual(prefetcher.bytes, size * 2)
+        # one request is always allowed however large it is
+        prefetcher.max_bytes = 0
+        prefetcher.next()
+        prefetcher.next()
+        self.assertEqual(len(prefetcher), 1)
+        prefetcher.close()
+
+
+    def test_downloads_overlap_the_writer(self):
+        prefetcher = RequestPrefetcher(self.lister, self.fetch, depth=8)
+        started = time.monotonic()
+        while (nextDownload := prefetcher.next()) is not None:
+            nextDownload[1].result()
+            time.sleep(0.01) # the write
+        prefetcher.close()
+        # serial would be 20 downloads plus 20 writes, about 0.4 seconds
+        self.assertLess(time.monotonic() - started, 0.35)
+
+
+
+class TestRequestAcker(unittest.TestCase):
+    def setUp(self):
+        self.s3 = LocalS3()
+        self.s3.create_bucket(Bucket='requests')
+        for i in range(2500):
+            self.s3.put_object(Bucket='requests', Key=f"{10000 + i}", Body='{}')
+
+
+    def test_deletes_in_batches_after_commit(self):
+        acker = RequestAcker(self.s3, 'requests')
+        for i in range(2500):
+            acker.add(f"{10000 + i}")
+        self.assertFalse(self.s3.calls.get('delete_objects'))
+        committed = []
+        acker.flush(lambda: committed.append(len(self.s3.buckets['requests'])))
+        self.assertEqual(committed, [2500])
+        self.assertEqual(self.s3.calls['delete_objects'], 3)
+        self.assertEqual(self.s3.buckets['requests'], {})
+
+
+    def test_written_keys_are_not_listed_until_deleted(self):
+        acker = RequestAcker(self.s3, 'requests', flush_interval=60, max_pending=None)
+        for i in range(1500):
+            acker.add(f"{10000 + i}")
+        self.assertFalse(acker.ready())
+        self.assertIn('10000', acker)
+        lister = RequestLister(self.s3, 'requests', skip_keys=acker)
+        self.assertEqual(lister.next_key(), '11500')
+        acker.flush()
+        self.assertNotIn('10000', acker)
+
+
+    def test_failed_deletes_are_kept(self):
+        acker = RequestAcker(self.s3, 'requests')
+        acker.add('10000')
+        self.s3.fail_next('delete_objects')
+        acker.flush()
+        self.assertEqual(acker.keys, ['10000'])
+        acker.flush()
+        self.assertNotIn('10000', self.s3.buckets['requests'])
+
+
+    def test_failed_requests_are_kept(self):
+        acker = RequestAcker(self.s3, 'requests')
+        for _ in range(5):
+            self.assertFalse(acker.failed('10000', 'w0'))
+        self.assertTrue(acker.held('w0'))
+        acker.flush()
+        self.assertIn('10000', self.s3.buckets['requests'])
+        acker.rewind()
+        self.assertFalse(acker.held('w0'))
+
+
+    def test_moves_to_dead_letter_after_max_attempts(self):
+        acker = RequestAcker(self.s3, 'requests', max_attempts=2)
+        self.assertFalse(acker.failed('10000'))
+        self.assertTrue(acker.failed('10000'))
+        acker.flush()
+        self.assertNotIn('10000', self.s3.buckets['requests'])
+        self.assertIn('dead-letter/10000', self.s3.buckets['requests'])
+        lister = RequestLister(self.s3, 'requests')
+        self.assertNotIn('dead-letter/10000', iter(lister.next_key, None))
+
+if __name__ == '__main__':
+    unittest.main()
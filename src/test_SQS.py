@@ -0,0 +1,64 @@
+import json
+import unittest
+
+import consumer
+from localBackends import LocalDynamoDB, LocalSQS
+from SQS import SQSHandler
+
+"""
+Tests for the SQS handler and the SQS receive loop
+"""
+class TestSQSHandler(unittest.TestCase):
+    def setUp(self):
+        self.sqs = LocalSQS()
+        self.handler = SQSHandler('local', wait_time=0, sqs=self.sqs)
+
+
+    def test_delete_messages_uses_batches(self):
+        for i in range(25):
+            self.sqs.send_message(QueueUrl='local', MessageBody=str(i))
+        messages = []
+        for _ in range(3):
+            messages += self.handler.receive_messages()
+        self.assertEqual(self.handler.delete_messages(messages), [])
+        self.assertEqual(self.sqs.calls['delete_message_batch'], 3)
+        self.assertEqual(len(self.sqs.messages), 0)
+
+
+    def test_delete_messages_returns_rejected_entries(self):
+        self.sqs.send_message(QueueUrl='local', MessageBody='a')
+        message = self.handler.receive_messages()[0]
+        stale = dict(message, ReceiptHandle='not-a-handle')
+        self.assertEqual(self.handler.delete_messages([message, stale]), [stale])
+
+
+    def test_release_messages_makes_them_visible(self):
+        self.sqs.send_message(QueueUrl='local', MessageBody='a')
+        self.handler.release_messages(self.handler.receive_messages())
+        self.assertEqual(len(self.handler.receive_messages()), 1)
+
+
+    def test_receive_loop_drains_queue_and_releases_prefetch(self):
+        for i in range(35):
+            request = {'type': 'create', 'requestId': str(i), 'widgetId': str(i), 'owner': 'Sue Smith',
+                       'label': 'L', 'description': 'D', 'otherAttributes': []}
+            self.sqs.send_message(QueueUrl='local', MessageBody=json.dumps(request))
+        dynamo = LocalDynamoDB()
+        consumer.run_consumer_with_sqs('local', dynamo, 'widgets', sqs_handler=self.handler, empty_receives=2)
+        self.assertEqual(len(dynamo.tables['widgets']), 35)
+        self.assertEqual(len(self.sqs.messages), 0)
+        self.assertNotIn('delete_message', self.sqs.calls)
+
+
+    def test_invalid_messages_are_deleted_without_a_write(self):
+        good = {'type': 'delete', 'requestId': '1', 'widgetId': '1', 'owner': 'Sue Smith'}
+        for body in [json.dumps(good), '{not json', json.dumps(dict(good, type='bad')), json.dumps(dict(good, owner='123'))]:
+            self.sqs.send_message(QueueUrl='local', MessageBody=body)
+        dynamo = LocalDynamoDB()
+        consumer.run_consumer_with_sqs('local', dynamo, 'widgets', sqs_handler=self.handler, empty_receives=1)
+        self.assertEqual(dynamo.calls.get('delete_item'), 1)
+        self.assertEqual(len(self.sqs.messages), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import asyncio
+import json
+import unittest
+
+import consumer
+from asyncEngine import make_engine
+from benchmark import seed_bucket, synthetic_requests
+from localBackends import AsyncLocalClient, LocalDynamoDB, LocalS3, LocalSQS
+
+"""
+Tests for the asyncio engine against the async stand-ins
+"""
+class TestAsyncEngine(unittest.TestCase):
+    def test_bucket_source_matches_sync_run(self):
+        requests = synthetic_requests(300, widgets=20)
+
+        source = LocalS3()
+        seed_bucket(source, 'requests', requests)
+        expected = LocalDynamoDB()
+        consumer.run(source, 'requests', expected, 'widgets', empty_polls=1, poll_interval=0)
+
+        source = LocalS3()
+        seed_bucket(source, 'requests', requests)
+        dest = LocalDynamoDB()
+        engine = make_engine(AsyncLocalClient(dest, 0.001), 'widgets',
+                             source=AsyncLocalClient(source, 0.001), sourceBucket='requests',
+                             concurrency=50, empty_polls=1, poll_interval=0)
+        asyncio.run(engine.run())
+
+        self.assertEqual(engine.processed, 300)
+        self.assertEqual(source.buckets['requests'], {})
+        self.assertEqual(dest.tables['widgets'], expected.tables['widgets'])
+
+
+    def test_sqs_source_to_s3(self):
+        sqs = LocalSQS()
+        for request in synthetic_requests(45, widgets=45):
+            sqs.send_message(QueueUrl='local', MessageBody=json.dumps(request))
+        dest = LocalS3()
+        engine = make_engine(AsyncLocalClient(dest), 'widget-bucket', sqs=AsyncLocalClient(sqs),
+                             queue_url='local', concurrency=8, wait_time=0, empty_receives=1)
+        asyncio.run(engine.run())
+
+        self.assertEqual(len(dest.buckets['widget-bucket']), 45)
+        self.assertEqual(len(sqs.messages), 0)
+        # 10 a call, the empty receive at the end can split one batch in two
+        self.assertLessEqual(sqs.calls['delete_message_batch'], 6)
+
+
+    def test_sqs_acks_are_deleted_before_the_messages_come_back(self):
+        sqs = LocalSQS(visibility_timeout=0.2)
+        for request in synthetic_requests(5, widgets=5):
+            sqs.send_message(QueueUrl='local', MessageBody=json.dumps(request))
+        dest = LocalS3()
+        engine = make_engine(AsyncLocalClient(dest), 'widget-bucket', sqs=AsyncLocalClient(sqs),
+                             queue_url='local', concurrency=8, wait_time=0.5, empty_receives=2, ack_interval=0.05)
+        asyncio.run(engine.run())
+
+        self.assertEqual(len(sqs.messages), 0)
+        self.assertEqual(dest.calls['put_object'], 5)
+
+
+    def test_bad_request_is_skipped(self):
+        source = LocalS3()
+        source.create_bucket(Bucket='requests')
+        source.put_object(Bucket='requests', Key='1', Body='not json')
+        engine = make_engine(AsyncLocalClient(LocalDynamoDB()), 'widgets', source=AsyncLocalClient(source),
+                             sourceBucket='requests', concurrency=4, empty_polls=1, poll_interval=0)
+        asyncio.run(engine.run())
+        self.assertEqual(engine.errors, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import json
+import unittest
+from unittest.mock import patch
+
+import consumer
+from autoscale import BacklogScaler, IdlePoller
+from benchmark import seed_bucket, synthetic_requests
+from localBackends import LocalDynamoDB, LocalS3, LocalSQS
+from SQS import SQSHandler
+from workerPool import KeyedWorkerPool
+
+"""
+Tests for idle polling back off and backlog driven scaling
+"""
+class TestIdlePoller(unittest.TestCase):
+    def test_wait_backs_off_and_resets(self):
+        poller = IdlePoller(0.5, 4.0, stop_after=None)
+        waits = []
+        for _ in range(6):
+            self.assertTrue(poller.idle())
+            waits.append(poller.wait_time())
+        self.assertEqual(waits, [0.5, 1.0, 2.0, 4.0, 4.0, 4.0])
+        poller.busy()
+        self.assertEqual(poller.wait_time(), 0)
+        poller.idle()
+        self.assertEqual(poller.wait_time(), 0.5)
+
+
+    def test_stops_after_empty_polls(self):
+        poller = IdlePoller(0, stop_after=3)
+        self.assertEqual([poller.idle() for _ in range(3)], [True, True, False])
+
+
+class TestBacklogScaler(unittest.TestCase):
+    def test_scales_up_at_once_and_down_after_cooldown(self):
+        scaler = BacklogScaler(1, 8, per_worker=10, cooldown=60)
+        self.assertEqual(scaler.target(35), 4)
+        self.assertEqual(scaler.target(500), 8)
+        self.assertEqual(scaler.target(0), 8)
+        with patch('autoscale.time.monotonic', return_value=scaler.lastDown + 61):
+            self.assertEqual(scaler.target(0), 4)
+            self.assertEqual(scaler.target(0), 4)
+
+
+    def test_pool_resize_keeps_key_order(self):
+        pool = KeyedWorkerPool(2)
+        seen = []
+        for i in range(20):
+            pool.submit('w', seen.append, i)
+            if i == 9:
+                pool.resize(5)
+        pool.resize(1)
+        pool.submit('w', seen.append, 20)
+        pool.join()
+        pool.close()
+        self.assertEqual(seen, list(range(21)))
+        self.assertEqual(len(pool.threads), 1)
+
+
+    def test_run_scales_workers_with_backlog(self):
+        source = LocalS3()
+        seed_bucket(source, 'requests', synthetic_requests(2500, widgets=50))
+        dest = LocalDynamoDB()
+        dest.create_table(TableName='widgets')
+        sizes = []
+        resize = KeyedWorkerPool.resize
+
+        def record(pool, workers):
+            sizes.append(workers)
+            resize(pool, workers)
+
+        with patch.object(KeyedWorkerPool, 'resize', record):
+            consumer.run(source, 'requests', dest, 'widgets', workers=1, max_workers=6,
+                         empty_polls=1, poll_interval=0)
+        self.assertEqual(source.buckets['requests'], {})
+        self.assertEqual(max(sizes), 6)
+
+
+    def test_sqs_receivers_follow_queue_backlog(self):
+        sqs = LocalSQS()
+        for request in synthetic_requests(300, widgets=300):
+            sqs.send_message(QueueUrl='local', MessageBody=json.dumps(request))
+        handler = SQSHandler('local', wait_time=0, sqs=sqs)
+        self.assertEqual(handler.approximate_backlog(), 300)
+        dest = LocalDynamoDB()
+        dest.create_table(TableName='widgets')
+        scaler = BacklogScaler(1, 4, per_worker=10)
+        consumer.run_consumer_with_sqs('local', dest, 'widgets', sqs_handler=handler,
+                                       empty_receives=2, scaler=scaler, check_interval=0.01)
+        self.assertEqual(len(sqs.messages), 0)
+        self.assertEqual(handler.approximate_backlog(), 0)
+        self.assertEqual(scaler.workers, 4)
+        self.assertGreater(len(dest.tables['widgets']), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import json
+import os
+import tempfile
+import unittest
+
+import checkpoint
+import consumer
+from checkpoint import CheckpointJournal
+from coalescer import RequestCoalescer
+from localBackends import LocalDynamoDB, LocalS3, LocalSQS
+from SQS import SQSHandler
+
+"""
+Tests for the checkpoint journal and skipping requests it has seen
+"""
+class TestCheckpointJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'journal')
+
+
+    def tearDown(self):
+        checkpoint.close_journal()
+        self.tmp.cleanup()
+
+
+    def requests(self, n):
+        return [{'type': 'create', 'requestId': f"r{i}", 'widgetId': f"w{i}", 'owner': 'Sue Smith',
+                 'label': 'L', 'description': 'D', 'otherAttributes': []} for i in range(n)]
+
+
+    def test_only_committed_ids_survive_a_restart(self):
+        journal = CheckpointJournal(self.path, sync=False)
+        journal.record('a')
+        journal.commit()
+        journal.record('b')
+        self.assertTrue(journal.seen('b'))
+        # crash before the next commit
+        journal.file.close()
+        journal = CheckpointJournal(self.path, sync=False)
+        self.assertTrue(journal.seen('a'))
+        self.assertFalse(journal.seen('b'))
+        journal.close()
+
+
+    def test_torn_last_line_is_dropped(self):
+        with open(self.path, 'w') as f:
+            f.write('a\nb\nc')
+        journal = CheckpointJournal(self.path, sync=False)
+        self.assertFalse(journal.seen('c'))
+        journal.record('d')
+        journal.close()
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'a\nb\nd\n')
+
+
+    def test_memory_is_bounded_and_file_compacted(self):
+        journal = CheckpointJournal(self.path, capacity=10, sync=False)
+        for i in range(25):
+            journal.record(str(i))
+            journal.commit()
+        self.assertEqual(len(journal.recent), 10)
+        self.assertFalse(journal.seen('0'))
+        self.assertTrue(journal.seen('24'))
+        journal.close()
+        with open(self.path) as f:
+            self.assertLessEqual(len(f.read().split()), 20)
+
+
+    def test_values_survive_a_restart_and_compaction(self):
+        journal = CheckpointJournal(self.path, capacity=3, sync=False)
+        for i in range(8):
+            journal.record(f"w{i % 4}", f"d{i}")
+            journal.commit()
+        journal.close()
+        journal = CheckpointJournal(self.path, capacity=3, sync=False)
+        self.assertEqual([journal.get(f"w{i}") for i in range(4)], [None, 'd5', 'd6', 'd7'])
+        journal.close()
+
+
+    def test_restart_skips_written_requests(self):
+        source = LocalS3()
+        source.create_bucket(Bucket='requests')
+        for i, request in enumerate(self.requests(10)):
+            source.put_object(Bucket='requests', Key=str(1000 + i), Body=json.dumps(request))
+        dynamo = LocalDynamoDB()
+        checkpoint.open_journal(self.path)
+        consumer.run(source, 'requests', dynamo, 'widgets', empty_polls=1, poll_interval=0)
+        checkpoint.close_journal()
+
+        # the same requests again, as if the deletes had been lost in a crash
+        for i, request in enumerate(self.requests(10)):
+            source.put_object(Bucket='requests', Key=str(2000 + i), Body=json.dumps(request))
+        checkpoint.open_journal(self.path)
+        consumer.run(source, 'requests', dynamo, 'widgets', empty_polls=1, poll_interval=0)
+        self.assertEqual(dynamo.calls['put_item'], 10)
+        self.assertEqual(source.buckets['requests'], {})
+
+
+    def test_coalesced_requests_are_all_recorded(self):
+        create = self.requests(2)
+        update = dict(create[0], type='update', requestId='u0', description='updated')
+        delete = dict(create[1], type='delete', requestId='d1')
+        source = LocalS3()
+        source.create_bucket(Bucket='requests')
+        for i, request in enumerate([create[0], update, create[1], delete]):
+            source.put_object(Bucket='requests', Key=str(1000 + i), Body=json.dumps(request))
+        dynamo = LocalDynamoDB()
+        journal = checkpoint.open_journal(self.path)
+        consumer.run(source, 'requests', dynamo, 'widgets', empty_polls=1, poll_interval=0,
+                     coalescer=RequestCoalescer(window=60))
+        self.assertTrue(all(journal.seen(requestId) for requestId in ('r0', 'u0', 'r1', 'd1')))
+
+        # the folded away create and the cancelled out one delivered again
+        source.put_object(Bucket='requests', Key='2000', Body=json.dumps(create[0]))
+        source.put_object(Bucket='requests', Key='2001', Body=json.dumps(create[1]))
+        consumer.run(source, 'requests', dynamo, 'widgets', empty_polls=1, poll_interval=0,
+                     coalescer=RequestCoalescer(window=60))
+        self.assertEqual(source.buckets['requests'], {})
+        self.assertEqual(dynamo.tables['widgets']['w0']['description'], {'S': 'updated'})
+        self.assertNotIn('w1', dynamo.tables['widgets'])
+        self.assertEqual(dynamo.calls['put_item'], 1)
+
+
+    def test_duplicate_sqs_delivery_is_not_written(self):
+        sqs = LocalSQS()
+        for request in self.requests(5) + self.requests(5):
+            sqs.send_message(QueueUrl='local', MessageBody=json.dumps(request))
+        dynamo = LocalDynamoDB()
+        checkpoint.open_journal(self.path)
+        handler = SQSHandler('local', wait_time=0, sqs=sqs)
+        consumer.run_consumer_with_sqs('local', dynamo, 'widgets', sqs_handler=handler, empty_receives=1)
+        self.assertEqual(dynamo.calls['put_item'], 5)
+        self.assertEqual(len(sqs.messages), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
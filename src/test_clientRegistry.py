@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+from clientRegistry import ClientRegistry
+from localBackends import LocalDynamoDB, LocalS3
+
+CREDS = {'aws_access_key_id': 'a', 'aws_secret_access_key': 'b', 'aws_session_token': 'c'}
+
+"""
+Tests for the shared session and client registry
+"""
+class TestClientRegistry(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.tmp.name, 'kinds.json')
+
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+    def local_registry(self, **options):
+        registry = ClientRegistry(**options)
+        registry.local = {'s3': LocalS3(), 'dynamodb': LocalDynamoDB()}
+        registry.local['s3'].create_bucket(Bucket='widgets-bucket')
+        registry.local['dynamodb'].create_table(TableName='widgets')
+        registry.client = lambda service, creds=None, max_pool_connections=None: registry.local[service]
+        return registry
+
+
+    def test_clients_are_shared_per_credentials(self):
+        registry = ClientRegistry(max_pool_connections=32)
+        s3 = registry.client('s3', CREDS)
+        self.assertIs(registry.client('s3', dict(CREDS)), s3)
+        self.assertIs(registry.session(CREDS), registry.session(dict(CREDS)))
+        self.assertEqual(s3.meta.config.max_pool_connections, 32)
+        self.assertIsNot(registry.client('s3', dict(CREDS, aws_session_token='d')), s3)
+        self.assertIsNot(registry.client('s3', CREDS, 64), s3)
+
+
+    def test_resource_kind_is_cached(self):
+        registry = self.local_registry()
+        self.assertEqual(registry.resource_kind('widgets'), 'dynamodb')
+        self.assertEqual(registry.resource_kind('widgets-bucket'), 's3')
+        self.assertIsNone(registry.resource_kind('missing'))
+        registry.resource_kind('widgets')
+        registry.resource_kind('widgets-bucket')
+        self.assertEqual(registry.local['dynamodb'].calls['describe_table'], 3)
+        self.assertEqual(registry.local['s3'].calls['head_bucket'], 2)
+
+
+    def test_resource_kind_expires(self):
+        registry = self.local_registry(kind_ttl=0)
+        registry.resource_kind('widgets')
+        registry.resource_kind('widgets')
+        self.assertEqual(registry.local['dynamodb'].calls['describe_table'], 2)
+
+
+    def test_resource_kind_disk_cache(self):
+        self.local_registry(kind_cache_path=self.cache_path).resource_kind('widgets-bucket')
+        registry = self.local_registry(kind_cache_path=self.cache_path)
+        self.assertEqual(registry.resource_kind('widgets-bucket'), 's3')
+        self.assertEqual(registry.local['s3'].calls, {})
+        self.assertEqual(registry.local['dynamodb'].calls, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
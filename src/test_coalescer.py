@@ -0,0 +1,133 @@
+import copy
+import random
+import unittest
+
+import consumer
+from benchmark import seed_bucket
+from coalescer import RequestCoalescer
+from localBackends import LocalDynamoDB, LocalS3
+
+
+def request(requestType, widgetId, n, **attributes):
+    data = {'type': requestType, 'requestId': str(n), 'widgetId': widgetId, 'owner': 'Sue Smith'}
+    if requestType != 'delete':
+        data['description'] = f"description {n}"
+        data['otherAttributes'] = [{'name': name, 'value': value} for name, value in attributes.items()]
+    if requestType == 'create':
+        data['label'] = f"label {n}"
+    return data
+
+
+"""
+Random create/update/delete chains, always valid for the widget's state
+"""
+def random_chains(widgets, length, seed=7):
+    rng = random.Random(seed)
+    exists = {}
+    requests = []
+    for n in range(length):
+        widgetId = f"w{rng.randrange(widgets)}"
+        if not exists.get(widgetId):
+            requestType = 'create'
+        else:
+            requestType = rng.choice(['update', 'update', 'delete'])
+        exists[widgetId] = requestType != 'delete'
+        attributes = {name: str(n) for name in rng.sample(['size', 'color', 'size-unit', 'price'], 2)}
+        requests.append(request(requestType, widgetId, n, **attributes))
+    return requests
+
+"""
+Tests for folding widget requests into their net effect
+"""
+class TestRequestCoalescer(unittest.TestCase):
+    def test_create_and_updates_become_one_put(self):
+        coalescer = RequestCoalescer()
+        coalescer.add(request('create', 'a', 1, size='1'), 1)
+        coalescer.add(request('update', 'a', 2, color='red'), 2)
+        coalescer.add(request('update', 'a', 3, size='3'), 3)
+        [(widgetId, operations, tokens, requestIds)] = coalescer.drain_widgets()
+        self.assertEqual(tokens, [1, 2, 3])
+        self.assertEqual(len(operations), 1)
+        requestType, data = operations[0]
+        self.assertEqual(requestType, 'create')
+        self.assertEqual(data['label'], 'label 1')
+        self.assertEqual(data['otherAttributes'], [{'name': 'size', 'value': '3'}, {'name': 'color', 'value': 'red'}])
+
+
+    def test_created_then_deleted_is_nothing(self):
+        coalescer = RequestCoalescer()
+        for n, requestType in enumerate(['create', 'update', 'delete']):
+            coalescer.add(request(requestType, 'a', n), n)
+        self.assertEqual(coalescer.drain_widgets(), [('a', [], [0, 1, 2], ['0', '1', '2'])])
+
+
+    def test_updated_then_deleted_is_a_delete(self):
+        coalescer = RequestCoalescer()
+        coalescer.add(request('update', 'a', 1), 1)
+        coalescer.add(request('delete', 'a', 2), 2)
+        [(widgetId, operations, tokens, requestIds)] = coalescer.drain_widgets()
+        self.assertEqual([requestType for requestType, data in operations], ['delete'])
+
+
+    def test_unknown_type_is_not_added(self):
+        coalescer = RequestCoalescer()
+        self.assertRaises(ValueError, coalescer.add, request('WidgetCreateRequest', 'a', 1), 1)
+        self.assertFalse(coalescer.ready())
+        self.assertEqual(coalescer.drain_widgets(), [])
+
+
+    def test_ready_on_count(self):
+        coalescer = RequestCoalescer(window=60, max_requests=2)
+        coalescer.add(request('create', 'a', 1))
+        self.assertFalse(coalescer.ready())
+        coalescer.add(request('create', 'b', 2))
+        self.assertTrue(coalescer.ready())
+
+
+    def test_coalesced_run_matches_plain_run(self):
+        requests = random_chains(widgets=15, length=400)
+        for make_dest, merge_updates in ((LocalDynamoDB, True), (LocalS3, False)):
+            results = []
+            for coalescer in (None, RequestCoalescer(window=60, max_requests=50, merge_updates=merge_updates)):
+                source = LocalS3()
+                seed_bucket(source, 'requests', copy.deepcopy(requests))
+                dest = make_dest()
+                consumer.run(source, 'requests', dest, 'widgets', empty_polls=1, poll_interval=0, coalescer=coalescer)
+                self.assertEqual(source.buckets['requests'], {})
+                results.append((dest.tables if merge_updates else dest.buckets, dest.calls))
+            self.assertEqual(results[0][0], results[1][0])
+            self.assertLess(sum(results[1][1].values()), sum(results[0][1].values()))
+
+
+
+    def test_drain_widgets_groups_tokens(self):
+        coalescer = RequestCoalescer()
+        coalescer.add(request('create', 'a', 1), 1)
+        coalescer.add(request('create', 'b', 2), 2)
+        coalescer.add(request('update', 'a', 3), 3)
+        widgets = coalescer.drain_widgets()
+        self.assertEqual([(widgetId, tokens, requestIds) for widgetId, operations, tokens, requestIds in widgets],
+                         [('a', [1, 3], ['1', '3']), ('b', [2], ['2'])])
+        self.assertEqual(coalescer.drain_widgets(), [])
+
+
+    def test_failed_write_keeps_only_its_widget(self):
+        requests = random_chains(widgets=15, length=400)
+        expected = LocalDynamoDB()
+        plain = LocalS3()
+        seed_bucket(plain, 'requests', copy.deepcopy(requests))
+        consumer.run(plain, 'requests', expected, 'widgets', empty_polls=1, poll_interval=0)
+
+        source = LocalS3()
+        seed_bucket(source, 'requests', copy.deepcopy(requests))
+        dest = LocalDynamoDB()
+        dest.fail_next('put_item')
+        consumer.run(source, 'requests', dest, 'widgets', empty_polls=3, poll_interval=0,
+                     coalescer=RequestCoalescer(window=60, max_requests=50))
+        self.assertEqual(dest.failures, {'put_item': 1})
+        self.assertEqual(source.buckets['requests'], {})
+        self.assertEqual(dest.tables, expected.tables)
+
+
+if __name__ == '__main__':
+    unittest.main()
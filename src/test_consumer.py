@@ -1,16 +1,19 @@
+import json
 import unittest
 from unittest.mock import MagicMock, patch
-from src.consumer import (
-    convert_dict_to_dynamodb_format,
-    does_s3_bucket_exist,
-    does_dynamo_table_exist,
-    get_session,
-    processData,
-    processDynamoData,
-)
+
+import consumer
+from clientRegistry import ClientRegistry
+from coalescer import RequestCoalescer
+from consumer import processData
+from credsManager import credsManager
+from dynamoDBProcessor import dynamoDBProcessor
+from localBackends import LocalDynamoDB, LocalS3, LocalServiceError, LocalSQS
+from S3Processor import S3Processor
+from SQS import SQSHandler
 
 """
-Various Simple Units tests to make sure the 
+Various Simple Units tests to make sure the
 functions in consumer.py are working properly
 """
 class TestConsumerFunctions(unittest.TestCase):
@@ -25,24 +28,17 @@ class TestConsumerFunctions(unittest.TestCase):
             'name': {'S': 'John'},
             'tags': {'L': ['tag1', 'tag2']}
         }
-        self.assertEqual(convert_dict_to_dynamodb_format(input_data), expected_output)
+        self.assertEqual(dynamoDBProcessor().convert_dict_to_dynamodb_format(input_data), expected_output)
 
 
-    @patch('consumer.convert_dict_to_dynamodb_format')
-    def test_processDynamoData(self, mock_convert):
+    def test_processDynamoData(self):
         json_data = {
             "id": 1,
             "owner": "john-smith",
             "description": "Sample Widget",
             "otherAttributes": [{"name": "color", "value": "red"}],
         }
-        mock_convert.return_value = {
-            "id": {"N": "1"},
-            "owner": {"S": "john-smith"},
-            "description": {"S": "Sample Widget"},
-            "color": {"S": "red"},
-        }
-        dynamo_data = processDynamoData(json_data)
+        dynamo_data = dynamoDBProcessor().processData(json_data)
         expected_result = {
             "id": {"N": "1"},
             "owner": {"S": "john-smith"},
@@ -52,44 +48,45 @@ class TestConsumerFunctions(unittest.TestCase):
         self.assertEqual(dynamo_data, expected_result)
 
 
-
     def test_does_s3_bucket_exist(self):
-        with patch('consumer.boto3.client') as mock_client:
+        with patch('boto3.client') as mock_client:
             mock_s3 = MagicMock()
             mock_client.return_value = mock_s3
 
             # Bucket exists
             mock_s3.head_bucket.return_value = None
-            self.assertTrue(does_s3_bucket_exist('existing-bucket', 'us-east-1'))
+            self.assertTrue(S3Processor.does_s3_bucket_exist('existing-bucket', 'us-east-1'))
 
             # Bucket does not exist
             mock_s3.head_bucket.side_effect = Exception('Bucket not found')
-            self.assertFalse(does_s3_bucket_exist('non-existing-bucket', 'us-east-1'))
+            self.assertFalse(S3Processor.does_s3_bucket_exist('non-existing-bucket', 'us-east-1'))
 
 
     def test_does_dynamo_table_exist(self):
-        with patch('consumer.boto3.client') as mock_client:
+        with patch('boto3.client') as mock_client:
             mock_dynamo = MagicMock()
             mock_client.return_value = mock_dynamo
 
             # Table exists
             mock_dynamo.describe_table.return_value = {'Table': {'TableName': 'existing-table'}}
-            self.assertTrue(does_dynamo_table_exist('existing-table', 'us-east-1'))
+            self.assertTrue(dynamoDBProcessor.does_dynamo_table_exist('existing-table', 'us-east-1'))
 
             # Table does not exist
-            mock_dynamo.describe_table.side_effect = mock_dynamo.exceptions.ResourceNotFoundException({'Error': {}}, 'DescribeTable')
-            self.assertFalse(does_dynamo_table_exist('non-existing-table', 'us-east-1'))
+            mock_dynamo.describe_table.side_effect = Exception('ResourceNotFoundException')
+            self.assertFalse(dynamoDBProcessor.does_dynamo_table_exist('non-existing-table', 'us-east-1'))
 
 
     def test_processData(self):
         sample_data = {
             "widgetId": 1,
+            "requestId": "r1",
             "owner": "John",
             "description": "Sample",
             "otherAttributes": [{"name": "attr1", "value": "value1"}]
         }
         processed_data = processData(sample_data)
         expected_data = {
+            "widgetId": 1,
             "id": 1,
             "owner": "john",
             "description": "Sample",
@@ -106,16 +103,172 @@ class TestConsumerFunctions(unittest.TestCase):
             "aws_session_token": "fake_session_token",
         }
         source_bucket = 'my-bucket'
+        manager = credsManager.__new__(credsManager)
+        manager.creds = aws_creds
+        manager.max_pool_connections = 10
+        manager.registry = ClientRegistry()
 
         # Simulate a DynamoDB session
-        mock_session_client.return_value.meta.service_model.service_name = 'dynamodb'
-        session = get_session(aws_creds, source_bucket)
-        self.assertEqual(session.meta.service_model.service_name, 'dynamodb')
+        with patch.object(manager.registry, 'resource_kind', return_value='dynamodb'):
+            mock_session_client.return_value.meta.service_model.service_name = 'dynamodb'
+            session = manager.get_session(source_bucket)
+            self.assertEqual(session.meta.service_model.service_name, 'dynamodb')
+            self.assertEqual(mock_session_client.call_args.args, ('dynamodb',))
 
         # Simulate an S3 session
-        mock_session_client.return_value.meta.service_model.service_name = 's3'
-        session = get_session(aws_creds, source_bucket)
-        self.assertEqual(session.meta.service_model.service_name, 's3')
+        with patch.object(manager.registry, 'resource_kind', return_value='s3'):
+            session = manager.get_session(source_bucket)
+            self.assertEqual(mock_session_client.call_args.args, ('s3',))
+
+        # Neither a table nor a bucket
+        with patch.object(manager.registry, 'resource_kind', return_value=None):
+            self.assertIsNone(manager.get_session(source_bucket))
+
+
+"""
+End to end runs against the local stand-ins, with injected failures
+"""
+class TestConsumerRuns(unittest.TestCase):
+    def requests(self, n):
+        return [{'type': 'create', 'requestId': str(i), 'widgetId': f"w{i}", 'owner': 'Sue Smith',
+                 'label': 'L', 'description': 'D', 'otherAttributes': []} for i in range(n)]
+
+
+    def test_injected_failures(self):
+        s3 = LocalS3(fail_calls=['get_object'], fail_rate=1.0)
+        s3.create_bucket(Bucket='b')
+        self.assertRaises(LocalServiceError, s3.get_object, Bucket='b', Key='k')
+        s3.fail_next('put_object', 2, code='SlowDown')
+        with self.assertRaises(LocalServiceError) as raised:
+            s3.put_object(Bucket='b', Key='k', Body='x')
+        self.assertEqual(raised.exception.response['Error']['Code'], 'SlowDown')
+        self.assertRaises(LocalServiceError, s3.put_object, Bucket='b', Key='k', Body='x')
+        s3.put_object(Bucket='b', Key='k', Body='x')
+        self.assertEqual(s3.failures, {'get_object': 1, 'put_object': 2})
+
+
+    def test_run_survives_failed_calls(self):
+        source = LocalS3()
+        source.create_bucket(Bucket='requests')
+        for i, request in enumerate(self.requests(20)):
+            source.put_object(Bucket='requests', Key=str(1000 + i), Body=json.dumps(request))
+        source.fail_next('get_object', 3)
+        source.fail_next('list_objects_v2', 1)
+        dynamo = LocalDynamoDB()
+        consumer.run(source, 'requests', dynamo, 'widgets', empty_polls=3, poll_interval=0)
+        # failed downloads stay in the bucket and are read on the next listing
+        self.assertEqual(len(dynamo.tables['widgets']), 20)
+        self.assertEqual(source.buckets['requests'], {})
+
+
+    def test_requests_are_deleted_after_their_write(self):
+        source = LocalS3()
+        source.create_bucket(Bucket='requests')
+        for i, request in enumerate(self.requests(20)):
+            source.put_object(Bucket='requests', Key=str(1000 + i), Body=json.dumps(request))
+        dynamo = LocalDynamoDB()
+        dynamo.fail_next('put_item', 2)
+        consumer.run(source, 'requests', dynamo, 'widgets', empty_polls=2, poll_interval=0)
+        # the two failed writes stayed in the bucket and were written on the next listing
+        self.assertEqual(len(dynamo.tables['widgets']), 20)
+        self.assertEqual(source.buckets['requests'], {})
+        self.assertEqual(source.calls.get('delete_object', 0), 0)
+        self.assertLessEqual(source.calls['delete_objects'], 3)
+
+
+    def test_failed_requests_are_never_deleted(self):
+        source = LocalS3()
+        source.create_bucket(Bucket='requests')
+        source.put_object(Bucket='requests', Key='1000', Body=json.dumps(self.requests(1)[0]))
+        dynamo = LocalDynamoDB()
+        dynamo.fail_next('put_item', 3, code='ServiceUnavailable')
+        consumer.run(source, 'requests', dynamo, 'widgets', empty_polls=2, poll_interval=0)
+        self.assertIn('1000', source.buckets['requests'])
+        consumer.run(source, 'requests', dynamo, 'widgets', empty_polls=2, poll_interval=0)
+        self.assertEqual(source.buckets['requests'], {})
+        self.assertIn('w0', dynamo.tables['widgets'])
+
+
+    def test_later_requests_wait_for_a_failed_one(self):
+        for workers in (1, 2):
+            source = LocalS3()
+            source.create_bucket(Bucket='requests')
+            create = self.requests(1)[0]
+            delete = dict(create, type='delete', requestId='d')
+            source.put_object(Bucket='requests', Key='1000', Body=json.dumps(create))
+            source.put_object(Bucket='requests', Key='1001', Body=json.dumps(delete))
+            dynamo = LocalDynamoDB()
+            dynamo.create_table(TableName='widgets')
+            dynamo.fail_next('put_item')
+            consumer.run(source, 'requests', dynamo, 'widgets', workers=workers, empty_polls=3, poll_interval=0)
+            self.assertEqual(source.buckets['requests'], {})
+            self.assertNotIn('w0', dynamo.tables['widgets'])
+
+
+    def test_failed_download_holds_back_later_requests(self):
+        class FirstGetFails(LocalS3):
+            def get_object(self, Bucket, Key):
+                if Key == '1000' and not self.failures:
+                    self.failures['get_object'] = 1
+                    raise LocalServiceError('InternalError', 'get_object')
+                return super().get_object(Bucket=Bucket, Key=Key)
+
+        create = self.requests(1)[0]
+        for options in ({'workers': 1}, {'workers': 2}, {'coalescer': RequestCoalescer(window=60)}):
+            source = FirstGetFails()
+            source.create_bucket(Bucket='requests')
+            source.put_object(Bucket='requests', Key='1000', Body=json.dumps(create))
+            source.put_object(Bucket='requests', Key='1001', Body=json.dumps(dict(create, type='delete', requestId='d')))
+            dynamo = LocalDynamoDB()
+            dynamo.create_table(TableName='widgets')
+            consumer.run(source, 'requests', dynamo, 'widgets', empty_polls=3, poll_interval=0, **options)
+            self.assertEqual(source.failures, {'get_object': 1})
+            self.assertEqual(source.buckets['requests'], {})
+            self.assertNotIn('w0', dynamo.tables['widgets'])
+
+
+    def test_options_other_engines_ignore_are_rejected(self):
+        self.assertEqual(consumer.unsupported_options(processes=4, long_running=True, dead_letter_after=3),
+                         "-lr, -dl cannot be combined with -p")
+        self.assertEqual(consumer.unsupported_options(engine='async', workers=2, batch_writes=True),
+                         "-w, -bw cannot be combined with -e async")
+        self.assertIsNone(consumer.unsupported_options(processes=4, batch_writes=True))
+        # a replay and SQS run the sync loops whatever the engine
+        self.assertIsNone(consumer.unsupported_options(engine='async', from_file='requests.jsonl', long_running=True))
+        self.assertIsNone(consumer.unsupported_options(processes=4, queue_url='local', checkpoint_path='journal'))
+        self.assertRaises(ValueError, consumer.run_consumer, 'requests', 'widgets', processes=4, write_rate=100)
+
+
+    def test_schema_type_names_are_written(self):
+        source = LocalS3()
+        source.create_bucket(Bucket='requests')
+        source.put_object(Bucket='requests', Key='1000', Body=json.dumps(dict(self.requests(1)[0], type='WidgetCreateRequest')))
+        dynamo = LocalDynamoDB()
+        consumer.run(source, 'requests', dynamo, 'widgets', empty_polls=1, poll_interval=0)
+        self.assertEqual(source.buckets['requests'], {})
+        self.assertIn('w0', dynamo.tables['widgets'])
+
+
+    def test_unknown_request_type_fails(self):
+        dynamo = LocalDynamoDB()
+        self.assertRaises(ValueError, consumer.process_request, dict(self.requests(1)[0], type='WidgetCreateRequest'),
+                          dynamo, 'widgets')
+        self.assertEqual(dynamo.calls, {})
+
+
+    def test_sqs_keeps_messages_that_failed(self):
+        sqs = LocalSQS(visibility_timeout=0)
+        for request in self.requests(10):
+            sqs.send_message(QueueUrl='local', MessageBody=json.dumps(request))
+        dynamo = LocalDynamoDB()
+        dynamo.fail_next('put_item', 2)
+        handler = SQSHandler('local', wait_time=0, sqs=sqs)
+        consumer.process_messages_from_sqs(handler.receive_messages(), handler, dynamo, 'widgets')
+        self.assertEqual(len(dynamo.tables['widgets']), 8)
+        self.assertEqual(len(sqs.messages), 2)
+        consumer.run_consumer_with_sqs('local', dynamo, 'widgets', sqs_handler=handler, empty_receives=1)
+        self.assertEqual(len(dynamo.tables['widgets']), 10)
+        self.assertEqual(len(sqs.messages), 0)
 
 
 if __name__ == '__main__':
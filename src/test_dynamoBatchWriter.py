@@ -0,0 +1,126 @@
+import unittest
+
+from dynamoBatchWriter import DynamoBatchWriter
+from localBackends import LocalDynamoDB
+
+
+class FlakyDynamoDB(LocalDynamoDB):
+    """
+    Leaves the last item of the first few batches unprocessed
+    """
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self.batches = []
+
+    def batch_write_item(self, RequestItems):
+        self.batches.append(RequestItems)
+        if self.failures:
+            self.failures -= 1
+            processed = {table: requests[:-1] for table, requests in RequestItems.items()}
+            unprocessed = {table: requests[-1:] for table, requests in RequestItems.items()}
+            super().batch_write_item(processed)
+            return {'UnprocessedItems': unprocessed}
+        return super().batch_write_item(RequestItems)
+
+
+def item(widgetId, label='A'):
+    return {'id': {'S': widgetId}, 'label': {'S': label}}
+
+"""
+Tests for grouping DynamoDB writes into BatchWriteItem calls
+"""
+class TestDynamoBatchWriter(unittest.TestCase):
+    def test_sends_full_batches_of_25(self):
+        dynamo = LocalDynamoDB()
+        writer = DynamoBatchWriter(dynamo, flush_interval=60)
+        for i in range(60):
+            writer.put_item(TableName='widgets', Item=item(str(i)))
+        self.assertEqual(dynamo.calls['batch_write_item'], 2)
+        writer.close()
+        self.assertEqual(dynamo.calls['batch_write_item'], 3)
+        self.assertEqual(len(dynamo.tables['widgets']), 60)
+
+
+    def test_same_key_is_never_in_one_batch(self):
+        dynamo = FlakyDynamoDB(0)
+        writer = DynamoBatchWriter(dynamo, flush_interval=60)
+        writer.put_item(TableName='widgets', Item=item('a'))
+        writer.put_item(TableName='widgets', Item=item('b'))
+        writer.delete_item(TableName='widgets', Key={'id': {'S': 'a'}})
+        writer.close()
+        self.assertEqual(len(dynamo.batches), 2)
+        self.assertEqual(list(dynamo.tables['widgets']), ['b'])
+
+
+    def test_update_waits_for_pending_put(self):
+        dynamo = LocalDynamoDB()
+        writer = DynamoBatchWriter(dynamo, flush_interval=60)
+        writer.put_item(TableName='widgets', Item=item('a'))
+        writer.update_item(TableName='widgets', Key={'id': {'S': 'a'}},
+                           UpdateExpression='SET #label = :label',
+                           ExpressionAttributeValues={':label': {'S': 'B'}},
+                           ExpressionAttributeNames={'#label': 'label'})
+        writer.close()
+        self.assertEqual(dynamo.tables['widgets']['a']['label'], {'S': 'B'})
+
+
+    def test_retries_unprocessed_items(self):
+        dynamo = FlakyDynamoDB(2)
+        writer = DynamoBatchWriter(dynamo, flush_interval=60, backoff=0)
+        for i in range(5):
+            writer.put_item(TableName='widgets', Item=item(str(i)))
+        writer.flush()
+        self.assertEqual(len(dynamo.batches), 3)
+        self.assertEqual(len(dynamo.tables['widgets']), 5)
+        writer.close()
+
+
+    def test_flushes_on_time(self):
+        dynamo = LocalDynamoDB()
+        writer = DynamoBatchWriter(dynamo, flush_interval=0.05)
+        writer.put_item(TableName='widgets', Item=item('a'))
+        writer.timer.join(0.2)
+        self.assertIn('a', dynamo.tables['widgets'])
+        writer.close()
+
+
+
+    def test_failed_timer_flush_keeps_the_items(self):
+        dynamo = LocalDynamoDB()
+        writer = DynamoBatchWriter(dynamo, flush_interval=0.05)
+        dynamo.fail_next('batch_write_item')
+        writer.put_item(TableName='widgets', Item=item('w0'))
+        writer.timer.join(0.2)
+        self.assertEqual(dynamo.failures['batch_write_item'], 1)
+        writer.flush()
+        self.assertIn('w0', dynamo.tables['widgets'])
+        writer.close()
+
+
+    def test_flush_raises_until_the_items_are_written(self):
+        dynamo = LocalDynamoDB()
+        writer = DynamoBatchWriter(dynamo, flush_interval=60, backoff=0)
+        dynamo.fail_next('batch_write_item', 2)
+        for i in range(25):
+            # the full batch fails, none of the calls that filled it sees the error
+            writer.put_item(TableName='widgets', Item=item(str(i)))
+        self.assertRaises(Exception, writer.flush)
+        writer.flush()
+        self.assertEqual(len(dynamo.tables['widgets']), 25)
+        writer.close()
+
+
+    def test_later_operation_waits_for_a_failed_one(self):
+        dynamo = LocalDynamoDB()
+        writer = DynamoBatchWriter(dynamo, flush_interval=60)
+        writer.put_item(TableName='widgets', Item=item('a'))
+        dynamo.fail_next('batch_write_item')
+        self.assertRaises(Exception, writer.delete_item, TableName='widgets', Key={'id': {'S': 'a'}})
+        writer.flush()
+        self.assertIn('a', dynamo.tables['widgets'])
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import json
+import os
+import tempfile
+import unittest
+
+import consumer
+from benchmark import synthetic_requests
+from fileSource import iter_directory, iter_jsonl, iter_requests
+from localBackends import LocalDynamoDB
+from metrics import metrics
+
+SAMPLE_REQUESTS = os.path.join(os.path.dirname(os.path.abspath(os.path.dirname(__file__))), 'sample-requests')
+
+"""
+Tests for the local file request sources and the replay loop
+"""
+class TestFileSource(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'requests.jsonl')
+
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+    def test_jsonl_lines_in_order(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'{"a": 1}\n\n{"a": 2}\r\n{"a": 3}')
+        self.assertEqual(list(iter_jsonl(self.path)), [
+            ('requests.jsonl:1', b'{"a": 1}'), ('requests.jsonl:3', b'{"a": 2}'), ('requests.jsonl:4', b'{"a": 3}')])
+        open(self.path, 'wb').close()
+        self.assertEqual(list(iter_jsonl(self.path)), [])
+
+
+    def test_directory_in_name_order(self):
+        for name in ('2', '1', '.hidden'):
+            with open(os.path.join(self.tmp.name, name), 'w') as f:
+                f.write(name)
+        os.mkdir(os.path.join(self.tmp.name, '3'))
+        self.assertEqual(list(iter_directory(self.tmp.name)), [('1', b'1'), ('2', b'2')])
+
+
+    def test_replay_with_workers_matches_serial(self):
+        with open(self.path, 'w') as f:
+            for request in synthetic_requests(500, widgets=25):
+                f.write(json.dumps(request) + '\n')
+            f.write('not json\n')
+        results = []
+        for workers in (1, 4):
+            dest = LocalDynamoDB()
+            dest.create_table(TableName='widgets')
+            self.assertEqual(consumer.run_replay(iter_requests(self.path), dest, 'widgets', workers, commit_every=100), 501)
+            results.append(dest.tables['widgets'])
+        self.assertEqual(results[0], results[1])
+        self.assertGreater(len(results[0]), 0)
+
+
+    def test_replay_sample_requests(self):
+        dest = LocalDynamoDB()
+        dest.create_table(TableName='widgets')
+        rejected = metrics.counter_value('requests', outcome='rejected')
+        consumer.run_replay(iter_requests(SAMPLE_REQUESTS), dest, 'widgets')
+        # the samples include a few broken requests, every other one is written
+        rejected = metrics.counter_value('requests', outcome='rejected') - rejected
+        self.assertGreater(rejected, 0)
+        self.assertEqual(sum(dest.calls.get(call, 0) for call in ('put_item', 'update_item', 'delete_item')),
+                         len(os.listdir(SAMPLE_REQUESTS)) - rejected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import importlib
+import json
+import sys
+import unittest
+from unittest.mock import patch
+
+import jsonCodec
+
+REQUEST = {'type': 'create', 'widgetId': 'w1', 'owner': 'Sue Smith', 'count': 3,
+           'otherAttributes': [{'name': 'note', 'value': 'é' * 2000}]}
+
+"""
+The codec gives the same values with orjson and with the standard library
+"""
+class TestJsonCodec(unittest.TestCase):
+    def check_codec(self, codec):
+        body = codec.dumps(REQUEST)
+        self.assertIsInstance(body, bytes)
+        self.assertEqual(json.loads(body), REQUEST)
+        for data in (body, bytearray(body), memoryview(body), body.decode('utf-8')):
+            self.assertEqual(codec.loads(data), REQUEST)
+        self.assertRaises(ValueError, codec.loads, b'{not json')
+
+
+    def test_installed_backend(self):
+        self.check_codec(jsonCodec)
+
+
+    def test_standard_library_fallback(self):
+        try:
+            with patch.dict(sys.modules, {'orjson': None}):
+                codec = importlib.reload(jsonCodec)
+                self.assertEqual(codec.BACKEND, 'json')
+                self.check_codec(codec)
+        finally:
+            importlib.reload(jsonCodec)
+
+
+if __name__ == '__main__':
+    unittest.main()
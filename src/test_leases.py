@@ -0,0 +1,112 @@
+import json
+import threading
+import time
+import unittest
+
+import consumer
+from leases import LeaseManager
+from localBackends import LocalDynamoDB, LocalS3, LocalServiceError
+
+"""
+Tests for splitting the request bucket between consumers with leases
+"""
+class TestLeaseManager(unittest.TestCase):
+    def setUp(self):
+        self.s3 = LocalS3()
+        self.s3.create_bucket(Bucket='requests')
+
+
+    def manager(self, owner, duration=30.0):
+        return LeaseManager(self.s3, 'requests', partitions=8, owner=owner, duration=duration)
+
+
+    def test_conditional_writes(self):
+        etag = self.s3.put_object(Bucket='requests', Key='k', Body='a', IfNoneMatch='*')['ETag']
+        self.assertRaises(LocalServiceError, self.s3.put_object, Bucket='requests', Key='k', Body='b', IfNoneMatch='*')
+        newEtag = self.s3.put_object(Bucket='requests', Key='k', Body='b', IfMatch=etag)['ETag']
+        with self.assertRaises(LocalServiceError) as raised:
+            self.s3.put_object(Bucket='requests', Key='k', Body='c', IfMatch=etag)
+        self.assertEqual(raised.exception.response['Error']['Code'], 'PreconditionFailed')
+        self.assertEqual(self.s3.get_object(Bucket='requests', Key='k')['ETag'], newEtag)
+
+
+    def test_partitions_are_split_between_consumers(self):
+        first, second = self.manager('a'), self.manager('b')
+        self.assertEqual(len(first.refresh()), 8)
+        # the second consumer finds every partition taken until the first lets its extra ones go
+        self.assertEqual(second.refresh(), set())
+        self.assertEqual(len(first.refresh()), 4)
+        self.assertEqual(len(second.refresh()), 4)
+        self.assertEqual(first.refresh() | second.refresh(), set(range(8)))
+        self.assertEqual(first.refresh() & second.refresh(), set())
+
+        keys = [str(1612306368338 + i) for i in range(100)]
+        for key in keys:
+            self.assertTrue(first.owns(key) != second.owns(key))
+        self.assertFalse(first.owns('leases/partition-0000'))
+
+
+    def test_leases_of_a_dead_consumer_are_taken_over(self):
+        first, second = self.manager('a', duration=0.2), self.manager('b', duration=0.2)
+        first.refresh()
+        second.refresh()
+        first.refresh()
+        second.refresh()
+        self.assertEqual(len(second.owned), 4)
+        # the first consumer stops renewing
+        time.sleep(0.25)
+        self.assertEqual(second.refresh(), set(range(8)))
+        # and loses what it thought it held when it comes back
+        self.assertEqual(first.refresh(), set())
+
+
+    def test_close_hands_the_leases_back(self):
+        first, second = self.manager('a'), self.manager('b')
+        first.refresh()
+        first.close()
+        self.assertEqual(second.refresh(), set(range(8)))
+        self.assertNotIn('leases/member-a', self.s3.buckets['requests'])
+
+
+    def test_consumers_without_leases_leave_lease_objects(self):
+        self.manager('a').refresh()
+        leaseKeys = set(self.s3.buckets['requests'])
+        self.s3.put_object(Bucket='requests', Key='1000', Body=json.dumps(
+            {'type': 'create', 'requestId': '1', 'widgetId': 'w1', 'owner': 'Sue Smith', 'label': 'L',
+             'description': 'D', 'otherAttributes': []}))
+        dynamo = LocalDynamoDB()
+        consumer.run(self.s3, 'requests', dynamo, 'widgets', empty_polls=1, poll_interval=0)
+        self.assertEqual(set(self.s3.buckets['requests']), leaseKeys)
+        self.assertEqual(list(dynamo.tables['widgets']), ['w1'])
+
+
+    def test_leases_are_rejected_with_other_engines(self):
+        for options in ({'engine': 'async'}, {'processes': 2}, {'queue_url': 'local'}):
+            self.assertRaises(ValueError, consumer.run_consumer, 'requests', 'widgets', lease_partitions=8, **options)
+
+
+    def test_consumers_write_each_request_once(self):
+        for i in range(200):
+            self.s3.put_object(Bucket='requests', Key=str(1612306368338 + i), Body=json.dumps(
+                {'type': 'create', 'requestId': str(i), 'widgetId': f"w{i}", 'owner': 'Sue Smith',
+                 'label': 'L', 'description': 'D', 'otherAttributes': []}))
+        dynamo = LocalDynamoDB()
+        managers = [self.manager('a'), self.manager('b')]
+        for manager in managers + managers:
+            manager.refresh()
+        self.assertEqual(sum(len(manager.owned) for manager in managers), 8)
+
+        runs = [threading.Thread(target=consumer.run, args=(self.s3, 'requests', dynamo, 'widgets'),
+                                 kwargs={'empty_polls': 2, 'poll_interval': 0, 'owns': manager.owns})
+                for manager in managers]
+        for run in runs:
+            run.start()
+        for run in runs:
+            run.join()
+        self.assertEqual(len(dynamo.tables['widgets']), 200)
+        self.assertEqual(dynamo.calls['put_item'], 200)
+        self.assertTrue(all(key.startswith('leases/') for key in self.s3.buckets['requests']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import json
+import os
+import tempfile
+import unittest
+import urllib.request
+
+import consumer
+from localBackends import LocalDynamoDB, LocalS3
+from metrics import Metrics, metrics
+
+"""
+Tests for the counters, histograms and their export
+"""
+class TestMetrics(unittest.TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        local = Metrics()
+        for seconds in (0.0001, 0.003, 0.003, 20.0, 100.0):
+            local.observe('stage_seconds', seconds, stage='write', type='create')
+        text = local.render()
+        self.assertIn('# TYPE consumer_stage_seconds histogram', text)
+        self.assertIn('consumer_stage_seconds_bucket{stage="write",type="create",le="0.0005"} 1', text)
+        self.assertIn('consumer_stage_seconds_bucket{stage="write",type="create",le="0.005"} 3', text)
+        self.assertIn('consumer_stage_seconds_bucket{stage="write",type="create",le="+Inf"} 5', text)
+        self.assertIn('consumer_stage_seconds_count{stage="write",type="create"} 5', text)
+
+
+    def test_counters_and_gauges(self):
+        local = Metrics()
+        local.inc('requests', type='create', outcome='processed')
+        local.inc('requests', 2, type='create', outcome='processed')
+        depth = [4]
+        local.gauge('queue_depth', lambda: depth[0])
+        local.gauge('in_flight', 2)
+        depth[0] = 7
+        text = local.render()
+        self.assertIn('consumer_requests_total{outcome="processed",type="create"} 3', text)
+        self.assertIn('consumer_queue_depth 7', text)
+        self.assertIn('consumer_in_flight 2', text)
+
+
+    def test_http_endpoint_and_file_dump(self):
+        local = Metrics()
+        local.inc('requests', outcome='rejected')
+        server = local.serve(0, host='127.0.0.1')
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+            with urllib.request.urlopen(url) as response:
+                self.assertIn('consumer_requests_total{outcome="rejected"} 1', response.read().decode('utf-8'))
+        finally:
+            server.shutdown()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'metrics.prom')
+            stop = local.dump_every(path, interval=60)
+            stop()
+            with open(path) as f:
+                self.assertIn('consumer_requests_total', f.read())
+
+
+    def test_consumer_records_stages(self):
+        source = LocalS3()
+        source.create_bucket(Bucket='requests')
+        request = {'type': 'create', 'requestId': 'r', 'widgetId': 'w', 'owner': 'Sue Smith',
+                   'label': 'L', 'description': 'D', 'otherAttributes': []}
+        source.put_object(Bucket='requests', Key='1', Body=json.dumps(request))
+        source.put_object(Bucket='requests', Key='2', Body='not json')
+        before = metrics.counter_value('requests', type='create', outcome='processed')
+        rejected = metrics.counter_value('requests', outcome='rejected')
+        consumer.run(source, 'requests', LocalDynamoDB(), 'widgets', empty_polls=1, poll_interval=0)
+        self.assertEqual(metrics.counter_value('requests', type='create', outcome='processed'), before + 1)
+        self.assertEqual(metrics.counter_value('requests', outcome='rejected'), rejected + 1)
+        for stage in ('list', 'download', 'decode', 'source_delete'):
+            self.assertIsNotNone(metrics.histogram('stage_seconds', stage=stage))
+        self.assertIsNotNone(metrics.histogram('stage_seconds', stage='write', type='create'))
+
+
+if __name__ == '__main__':
+    unittest.main()
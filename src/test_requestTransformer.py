@@ -0,0 +1,71 @@
+import copy
+import json
+import unittest
+
+import jsonCodec
+import requestTransformer
+from benchmark import load_sample_requests
+from consumer import processData
+from dynamoDBProcessor import dynamoDBProcessor
+
+"""
+The single pass transformer has to give exactly what the old chain of
+processData, dynamoDBProcessor.processData and getUpdateExpression gave
+"""
+class TestRequestTransformer(unittest.TestCase):
+    def setUp(self):
+        self.samples = load_sample_requests()
+        odd = {'type': 'update', 'requestId': 'r', 'widgetId': 'w', 'owner': 'Henry Hops', 'count': 3,
+               'odd-key': 'x', 'description': 'd',
+               'otherAttributes': [{'name': 'size-unit', 'value': 'cm'}, {'name': 'owner', 'value': 'z'}]}
+        self.samples.append(odd)
+
+
+    def old_item(self, request):
+        return dynamoDBProcessor().processData(processData(copy.deepcopy(request)))
+
+
+    def test_s3_object(self):
+        for request in self.samples:
+            data = processData(copy.deepcopy(request))
+            expected = (f"widgets/{data['owner']}/{data['widgetId']}", jsonCodec.dumps(data))
+            self.assertEqual(requestTransformer.to_s3_object(request), expected)
+            self.assertEqual(json.loads(expected[1]), data)
+
+
+    def test_dynamo_item_keeps_order(self):
+        for request in self.samples:
+            expected = self.old_item(request)
+            item = requestTransformer.to_dynamo_item(request)
+            self.assertEqual(item, expected)
+            self.assertEqual(list(item), list(expected))
+
+
+    def test_dynamo_update(self):
+        for request in self.samples:
+            expected = dynamoDBProcessor.getUpdateExpression(self.old_item(request))
+            update = requestTransformer.to_dynamo_update(request)
+            self.assertEqual((update['UpdateExpression'], update['ExpressionAttributeValues'],
+                              update['ExpressionAttributeNames']), expected)
+            self.assertEqual(update['Key'], {'id': {'S': request['widgetId']}})
+
+
+    def test_update_templates_are_cached(self):
+        requestTransformer.update_template.cache_clear()
+        request = self.samples[0]
+        for _ in range(3):
+            requestTransformer.to_dynamo_update(request)
+        info = requestTransformer.update_template.cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+
+
+    def test_request_is_not_changed(self):
+        request = self.samples[0]
+        before = copy.deepcopy(request)
+        requestTransformer.to_s3_object(request)
+        requestTransformer.to_dynamo_update(request)
+        self.assertEqual(request, before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import json
+import os
+import unittest
+
+from requestValidator import RequestValidator, get_validator, load_schema
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(os.path.dirname(__file__))), 'sample-requests')
+
+CREATE = {'type': 'create', 'requestId': 'r1', 'widgetId': 'w1', 'owner': 'Sue Smith', 'label': 'L',
+          'description': 'D', 'otherAttributes': [{'name': 'size', 'value': '5'}]}
+
+"""
+Tests for the schema driven request validator
+"""
+class TestRequestValidator(unittest.TestCase):
+    def setUp(self):
+        self.validator = get_validator()
+
+
+    def test_valid_requests(self):
+        self.assertEqual(self.validator.validate(CREATE), [])
+        self.assertEqual(self.validator.validate({'type': 'delete', 'requestId': 'r', 'widgetId': 'w', 'owner': 'Sue'}), [])
+        self.assertEqual(self.validator.validate(dict(CREATE, type='WidgetCreateRequest')), [])
+
+
+    def test_schema_type_names_come_back_short(self):
+        request, errors = self.validator.check(json.dumps(dict(CREATE, type='WidgetCreateRequest')))
+        self.assertEqual((request, errors), (CREATE, []))
+        request, errors = self.validator.check(dict(CREATE, type='WidgetDeleteRequest'))
+        self.assertEqual(request['type'], 'delete')
+
+
+    def test_per_type_required_fields(self):
+        update = {key: value for key, value in CREATE.items() if key != 'label'}
+        self.assertEqual(self.validator.validate(dict(update, type='update')), [])
+        self.assertEqual(self.validator.validate(update), ['missing required field: label'])
+
+
+    def test_field_errors(self):
+        self.assertEqual(self.validator.validate(dict(CREATE, type='bad')), ["unknown request type: 'bad'"])
+        self.assertEqual(self.validator.validate(dict(CREATE, owner='1234')), ['owner does not match [A-Za-z ]+'])
+        self.assertEqual(self.validator.validate(dict(CREATE, label=5)), ['label must be of type str'])
+        self.assertEqual(self.validator.validate(dict(CREATE, otherAttributes=[{'name': 'size'}])),
+                         ['otherAttributes[0] missing required field: value'])
+
+
+    def test_raw_bodies(self):
+        request, errors = self.validator.check(json.dumps(CREATE).encode('utf-8'))
+        self.assertEqual((request, errors), (CREATE, []))
+        # quotes inside values broke the old str/replace check
+        quoted = dict(CREATE, description="it's \"quoted\"")
+        self.assertEqual(self.validator.validate(json.dumps(quoted)), [])
+        request, errors = self.validator.check(b'{not json')
+        self.assertIsNone(request)
+        self.assertTrue(errors[0].startswith('request is not valid JSON'))
+
+
+    def test_batch_reports_each_item(self):
+        results = self.validator.validate_batch([json.dumps(CREATE), b'', {'type': 'create'}])
+        self.assertEqual(results[0][1], [])
+        self.assertEqual(len(results[1][1]), 1)
+        self.assertIn('missing required field: owner', results[2][1])
+
+
+    def test_sample_requests(self):
+        rejected = []
+        for name in sorted(os.listdir(SAMPLE_DIR)):
+            with open(os.path.join(SAMPLE_DIR, name), 'rb') as f:
+                if self.validator.check(f.read())[1]:
+                    rejected.append(name)
+        # the empty file, the request with type "bad" and the one missing an owner
+        self.assertEqual(rejected, ['1612306374392', '1612306375135', '1612306375892'])
+
+
+    def test_custom_type_requirements(self):
+        validator = RequestValidator(load_schema(), {'create': (), 'delete': ()})
+        self.assertEqual(validator.validate({'type': 'create', 'requestId': 'r', 'widgetId': 'w', 'owner': 'Sue'}), [])
+        self.assertEqual(validator.validate(dict(CREATE, type='update')), ["unknown request type: 'update'"])
+        self.assertEqual(validator.validate(dict(CREATE, type='WidgetUpdateRequest')),
+                         ["unknown request type: 'WidgetUpdateRequest'"])
+
+
+if __name__ == '__main__':
+    unittest.main()
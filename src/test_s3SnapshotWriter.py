@@ -0,0 +1,134 @@
+import json
+import unittest
+
+import consumer
+from benchmark import seed_bucket, synthetic_requests
+from localBackends import LocalS3, LocalServiceError, LocalSQS
+from s3SnapshotWriter import S3SnapshotWriter
+from SQS import SQSHandler
+
+"""
+Tests for the aggregated S3 widget snapshots
+"""
+class TestS3SnapshotWriter(unittest.TestCase):
+    def setUp(self):
+        self.s3 = LocalS3()
+        self.s3.create_bucket(Bucket='web')
+
+
+    def read(self, snapshot):
+        data = self.s3.get_object(Bucket='web', Key=f"widgets-aggregated/{snapshot}.ndjson")['Body'].read()
+        index = json.loads(self.s3.get_object(Bucket='web', Key=f"widgets-aggregated/{snapshot}.index.json")['Body'].read())
+        return {widgetId: json.loads(data[offset:offset + length]) for widgetId, (offset, length) in index.items()}
+
+
+    def test_latest_state_and_tombstones(self):
+        writer = S3SnapshotWriter(self.s3, flush_interval=60)
+        writer.put_object(Bucket='web', Key='widgets/sue/w1', Body=json.dumps({'id': 'w1', 'label': 'a'}))
+        writer.put_object(Bucket='web', Key='widgets/sue/w1', Body=json.dumps({'id': 'w1', 'label': 'b'}))
+        writer.put_object(Bucket='web', Key='widgets/sue/w2', Body=json.dumps({'id': 'w2'}))
+        writer.put_object(Bucket='web', Key='widgets/bob/w3', Body=json.dumps({'id': 'w3'}))
+        writer.delete_object(Bucket='web', Key='widgets/sue/w2')
+        self.assertEqual(self.s3.calls, {})
+        writer.close()
+
+        self.assertEqual(self.read('sue'), {'w1': {'id': 'w1', 'label': 'b'},
+                                            'w2': {'id': 'w2', 'owner': 'sue', 'deleted': True}})
+        self.assertEqual(self.read('bob'), {'w3': {'id': 'w3'}})
+        self.assertEqual(self.s3.calls['put_object'], 4)
+
+
+    def test_tombstones_are_dropped_on_the_next_rewrite(self):
+        writer = S3SnapshotWriter(self.s3, flush_interval=60)
+        writer.put_object(Bucket='web', Key='widgets/sue/w1', Body='{"id": "w1"}')
+        writer.put_object(Bucket='web', Key='widgets/sue/w2', Body='{"id": "w2"}')
+        writer.flush()
+        writer.delete_object(Bucket='web', Key='widgets/sue/w1')
+        writer.flush()
+        self.assertEqual(self.read('sue')['w1'], {'id': 'w1', 'owner': 'sue', 'deleted': True})
+        writer.put_object(Bucket='web', Key='widgets/sue/w3', Body='{"id": "w3"}')
+        writer.close()
+        self.assertEqual(set(self.read('sue')), {'w2', 'w3'})
+
+
+    def test_merges_with_existing_snapshot(self):
+        writer = S3SnapshotWriter(self.s3, flush_interval=60)
+        writer.put_object(Bucket='web', Key='widgets/sue/w1', Body='{"id": "w1"}')
+        writer.close()
+        writer = S3SnapshotWriter(self.s3, flush_interval=60)
+        writer.put_object(Bucket='web', Key='widgets/sue/w2', Body='{"id": "w2"}')
+        writer.close()
+        self.assertEqual(set(self.read('sue')), {'w1', 'w2'})
+
+
+    def test_failed_flush_keeps_changes(self):
+        writer = S3SnapshotWriter(self.s3, flush_interval=60, partitions=4)
+        writer.put_object(Bucket='web', Key='widgets/sue/w1', Body='{"id": "w1"}')
+        self.s3.fail_next('put_object')
+        self.assertRaises(LocalServiceError, writer.flush)
+        writer.close()
+        self.assertEqual(self.read(writer.snapshot_name('sue')), {'w1': {'id': 'w1'}})
+
+
+    def test_failed_flush_keeps_the_requests(self):
+        source = LocalS3()
+        seed_bucket(source, 'requests', synthetic_requests(5, widgets=5))
+        writer = S3SnapshotWriter(self.s3, flush_interval=60)
+        self.s3.fail_next('put_object')
+        # the failed ack keeps the keys in the bucket, the next run writes and deletes them
+        consumer.run(source, 'requests', writer, 'web', empty_polls=1, poll_interval=0)
+        self.assertEqual(self.s3.failures, {'put_object': 1})
+        self.assertEqual(len(source.buckets['requests']), 5)
+        consumer.run(source, 'requests', writer, 'web', empty_polls=1, poll_interval=0)
+        self.assertEqual(source.buckets['requests'], {})
+        writer.close()
+
+
+    def test_bucket_run_rewrites_once_per_ack_interval(self):
+        for workers in (1, 2):
+            self.setUp()
+            source = LocalS3()
+            requests = synthetic_requests(3000, widgets=300)
+            seed_bucket(source, 'requests', requests)
+            writer = S3SnapshotWriter(self.s3, flush_interval=3600)
+            consumer.run(source, 'requests', writer, 'web', workers=workers, empty_polls=2, poll_interval=0,
+                         ack_interval=3600)
+            writer.close()
+            owners = {request['owner'].replace(' ', '-').lower() for request in requests}
+            self.assertEqual(source.buckets['requests'], {})
+            # the ndjson and the index of every owner, written once
+            self.assertEqual(self.s3.calls['put_object'], 2 * len(owners))
+
+
+    def test_run_writes_a_snapshot_per_owner(self):
+        source = LocalS3()
+        requests = synthetic_requests(1000, widgets=100)
+        seed_bucket(source, 'requests', requests)
+        writer = S3SnapshotWriter(self.s3, flush_interval=60)
+        consumer.run(source, 'requests', writer, 'web', empty_polls=1, poll_interval=0)
+        writer.close()
+        owners = {request['owner'].replace(' ', '-').lower() for request in requests}
+        self.assertLessEqual(self.s3.calls['put_object'], 2 * len(owners) * 2)
+        widgets = set()
+        for owner in owners:
+            widgets.update(self.read(owner))
+        self.assertEqual(widgets, {request['widgetId'] for request in requests})
+
+
+
+    def test_sqs_messages_are_deleted_with_the_snapshots(self):
+        sqs = LocalSQS(visibility_timeout=60)
+        for request in synthetic_requests(200, widgets=20):
+            sqs.send_message(QueueUrl='local', MessageBody=json.dumps(request))
+        writer = S3SnapshotWriter(self.s3, flush_interval=60)
+        handler = SQSHandler('local', wait_time=0, sqs=sqs)
+        consumer.run_consumer_with_sqs('local', writer, 'web', sqs_handler=handler, empty_receives=1, ack_interval=60)
+        writer.close()
+        self.assertEqual(len(sqs.messages), 0)
+        # one flush when the queue ran dry instead of one per receive of 10 messages
+        self.assertEqual(self.s3.calls['put_object'], len(self.s3.buckets['web']))
+        self.assertLessEqual(sqs.calls['delete_message_batch'], 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import json
+import os
+import tempfile
+import unittest
+
+from benchmark import seed_bucket, synthetic_requests
+from localBackends import LocalS3, LocalSQS
+from sendWidgetsSQS import MAX_BATCH_BYTES, SQSRequeuer
+
+"""
+Tests for re-queueing the request bucket into SQS
+"""
+class TestSQSRequeuer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.progress_path = os.path.join(self.tmp.name, 'progress.json')
+        self.s3 = LocalS3()
+        self.requests = synthetic_requests(95, widgets=10)
+        seed_bucket(self.s3, 'requests', self.requests, start=1000)
+        self.sqs = LocalSQS()
+
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+    def bodies(self):
+        return sorted(json.loads(message[0])['requestId'] for message in self.sqs.messages.values())
+
+
+    def test_sends_every_request_in_batches(self):
+        stats = SQSRequeuer(self.s3, self.sqs, 'requests', 'local', threads=4).run()
+        self.assertEqual(stats['sent'], 95)
+        self.assertEqual(self.bodies(), sorted(request['requestId'] for request in self.requests))
+        self.assertEqual(self.sqs.calls['send_message_batch'], 10)
+
+
+    def test_retries_failed_batches(self):
+        self.sqs.fail_next('send_message_batch', 2)
+        stats = SQSRequeuer(self.s3, self.sqs, 'requests', 'local', threads=1, backoff=0).run()
+        self.assertEqual((stats['sent'], stats['failed']), (95, 0))
+        self.assertEqual(len(self.sqs.messages), 95)
+
+
+    def test_skips_messages_over_the_limit(self):
+        self.s3.put_object(Bucket='requests', Key='1500', Body=b'x' * (MAX_BATCH_BYTES + 1))
+        stats = SQSRequeuer(self.s3, self.sqs, 'requests', 'local').run()
+        self.assertEqual((stats['sent'], stats['failed']), (95, 1))
+
+
+    def test_continues_from_saved_progress(self):
+        with open(self.progress_path, 'w') as f:
+            json.dump({'bucket': 'requests', 'queue_url': 'local', 'lastKey': '1059'}, f)
+        requeuer = SQSRequeuer(self.s3, self.sqs, 'requests', 'local', progress_path=self.progress_path)
+        self.assertEqual(requeuer.run()['sent'], 35)
+        with open(self.progress_path) as f:
+            self.assertEqual(json.load(f)['lastKey'], '1094')
+
+
+
+    def test_failed_keys_are_sent_on_the_next_run(self):
+        self.s3.fail_next('get_object')
+        requeuer = SQSRequeuer(self.s3, self.sqs, 'requests', 'local', threads=1, progress_path=self.progress_path)
+        self.assertEqual((requeuer.run()['sent'], requeuer.failed), (94, 1))
+        with open(self.progress_path) as f:
+            progress = json.load(f)
+        self.assertEqual((progress['lastKey'], progress['retryKeys']), ('1094', ['1000']))
+
+        requeuer = SQSRequeuer(self.s3, self.sqs, 'requests', 'local', progress_path=self.progress_path)
+        self.assertEqual(requeuer.run()['sent'], 1)
+        self.assertEqual(self.bodies(), sorted(request['requestId'] for request in self.requests))
+        with open(self.progress_path) as f:
+            self.assertEqual(json.load(f)['retryKeys'], [])
+
+
+
+    def test_batches_not_sent_after_the_retries_are_kept(self):
+        self.sqs.fail_next('send_message_batch', 4)
+        requeuer = SQSRequeuer(self.s3, self.sqs, 'requests', 'local', threads=1, backoff=0, progress_path=self.progress_path)
+        self.assertEqual(requeuer.run()['sent'], 85)
+        self.assertEqual(sorted(requeuer.retryKeys), [str(1000 + i) for i in range(10)])
+        requeuer = SQSRequeuer(self.s3, self.sqs, 'requests', 'local', progress_path=self.progress_path)
+        self.assertEqual(requeuer.run()['sent'], 10)
+        self.assertEqual(len(self.sqs.messages), 95)
+
+
+if __name__ == '__main__':
+    unittest.main()
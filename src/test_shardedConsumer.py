@@ -0,0 +1,102 @@
+import json
+import os
+import tempfile
+import unittest
+from functools import partial
+
+from benchmark import seed_bucket
+from localBackends import LocalS3
+from shardedConsumer import run_sharded, widget_id_of
+
+
+class RecordingS3(LocalS3):
+    """
+    Destination that appends every write to a file, so the test can see
+    what the worker processes did
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def put_object(self, Bucket, Key, Body):
+        data = json.loads(Body)
+        with open(self.path, 'a') as f:
+            f.write(f"{os.getpid()} {data['widgetId']} {data['description']}\n")
+
+    def delete_object(self, Bucket, Key):
+        with open(self.path, 'a') as f:
+            f.write(f"{os.getpid()} {Key.rsplit('/', 1)[1]} deleted\n")
+
+
+def recording_destination(path):
+    return RecordingS3(path)
+
+"""
+Tests for the multi-process consumer
+"""
+class TestShardedConsumer(unittest.TestCase):
+    def test_widget_id_of(self):
+        self.assertEqual(widget_id_of(b'{"type":"create","widgetId": "abc","owner":"x"}', 'key'), b'abc')
+        self.assertEqual(widget_id_of(b'{}', 'key'), b'key')
+
+
+    def test_each_widget_stays_on_one_process_in_order(self):
+        requests = [{'type': 'create' if i < 10 else 'update', 'requestId': str(i), 'widgetId': f"w{i % 10}",
+                     'owner': 'Sue Smith', 'label': 'L', 'description': str(i), 'otherAttributes': []}
+                    for i in range(200)]
+        source = LocalS3()
+        seed_bucket(source, 'requests', requests)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'writes')
+            sharded = run_sharded(source, 'requests', partial(recording_destination, path), 'widgets', 3,
+                                  chunk_size=7, empty_polls=1, poll_interval=0)
+            with open(path) as f:
+                writes = [line.split() for line in f]
+
+        self.assertEqual(sharded.done, 200)
+        self.assertEqual(source.buckets['requests'], {})
+        self.assertEqual(len(writes), 200)
+        for widgetId in {widget for pid, widget, n in writes}:
+            mine = [(pid, int(n)) for pid, widget, n in writes if widget == widgetId]
+            self.assertEqual(len({pid for pid, n in mine}), 1)
+            self.assertEqual([n for pid, n in mine], sorted(n for pid, n in mine))
+
+
+
+    def test_rejected_requests_are_deleted_at_once(self):
+        source = LocalS3()
+        seed_bucket(source, 'requests', [{'type': 'create', 'widgetId': 'w1'}, {'type': 'bad'}])
+        with tempfile.TemporaryDirectory() as tmp:
+            sharded = run_sharded(source, 'requests', partial(recording_destination, os.path.join(tmp, 'writes')),
+                                  'widgets', 2, empty_polls=3, poll_interval=0)
+        self.assertEqual((sharded.done, sharded.errors), (2, 0))
+        self.assertEqual(source.buckets['requests'], {})
+        self.assertEqual(source.calls['get_object'], 2)
+
+
+    def test_failed_download_ends_the_pass(self):
+        class FirstGetFails(LocalS3):
+            def get_object(self, Bucket, Key):
+                if Key == '1000' and not self.failures:
+                    self.failures['get_object'] = 1
+                    raise Exception('InternalError')
+                return super().get_object(Bucket=Bucket, Key=Key)
+
+        create = {'type': 'create', 'requestId': '1', 'widgetId': 'w1', 'owner': 'Sue Smith', 'label': 'L',
+                  'description': 'created', 'otherAttributes': []}
+        source = FirstGetFails()
+        source.create_bucket(Bucket='requests')
+        source.put_object(Bucket='requests', Key='1000', Body=json.dumps(create))
+        source.put_object(Bucket='requests', Key='1001', Body=json.dumps(dict(create, type='delete', requestId='2')))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'writes')
+            run_sharded(source, 'requests', partial(recording_destination, path), 'widgets', 2,
+                        empty_polls=3, poll_interval=0)
+            with open(path) as f:
+                writes = [line.split()[1:] for line in f]
+        self.assertEqual(source.buckets['requests'], {})
+        self.assertEqual(writes, [['w1', 'created'], ['w1', 'deleted']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import json
+import unittest
+
+import consumer
+from localBackends import LocalDynamoDB, LocalS3, LocalServiceError
+from throttle import AdaptiveLimiter, ThrottledClient
+
+"""
+Tests for pacing destination writes to what the destination takes
+"""
+class TestAdaptiveLimiter(unittest.TestCase):
+    def test_throttle_halves_once_per_cooldown(self):
+        limiter = AdaptiveLimiter(100, concurrency=8, cooldown=60)
+        limiter.throttled()
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 50)
+        self.assertEqual(limiter.concurrency, 4)
+
+
+    def test_grows_only_while_it_holds_writes_back(self):
+        limiter = AdaptiveLimiter(100)
+        limiter.succeeded(10)
+        self.assertEqual(limiter.rate, 100)
+        # slow start, a tenth of a second's writes adds a tenth of the rate
+        limiter.limited = True
+        limiter.succeeded(10)
+        self.assertAlmostEqual(limiter.rate, 110)
+        # after a throttle the step is a share of the rate it happened at
+        limiter.throttled()
+        limiter.limited = True
+        limiter.succeeded(11)
+        self.assertAlmostEqual(limiter.rate, 55 + 0.05 * 110 * 11 / 55)
+
+
+    def test_consumed_capacity_sets_the_cost(self):
+        limiter = AdaptiveLimiter(100)
+        for _ in range(50):
+            charged = limiter.acquire(1)
+            limiter.release(1, charged, 3.0)
+        self.assertAlmostEqual(limiter.unitCost, 3.0, places=1)
+
+
+class TestThrottledClient(unittest.TestCase):
+    def item(self, i):
+        return {'id': {'S': f"w{i}"}, 'owner': {'S': 'sue'}}
+
+
+    def test_retries_throttled_writes(self):
+        dynamo = LocalDynamoDB()
+        client = ThrottledClient(dynamo, AdaptiveLimiter(1000), backoff=0)
+        dynamo.fail_next('put_item', 3, code='ProvisionedThroughputExceededException')
+        response = client.put_item(TableName='widgets', Item=self.item(1))
+        self.assertEqual(response['ConsumedCapacity']['CapacityUnits'], 1.0)
+        self.assertEqual(dynamo.calls['put_item'], 4)
+        # halved once for the three throttles, the write that went through adds a little back
+        self.assertAlmostEqual(client.limiter.rate, 500, delta=1)
+        self.assertEqual(client.limiter.inflight, 0)
+
+
+    def test_other_errors_are_not_retried(self):
+        dynamo = LocalDynamoDB()
+        client = ThrottledClient(dynamo, AdaptiveLimiter(1000), backoff=0)
+        dynamo.fail_next('put_item', 1, code='ValidationException')
+        self.assertRaises(LocalServiceError, client.put_item, TableName='widgets', Item=self.item(1))
+        self.assertEqual(dynamo.calls['put_item'], 1)
+        self.assertEqual(client.describe_table, dynamo.describe_table)
+
+
+    def test_unprocessed_items_slow_the_rate(self):
+        dynamo = LocalDynamoDB(capacity=5)
+        client = ThrottledClient(dynamo, AdaptiveLimiter(1000))
+        response = client.batch_write_item(RequestItems={'widgets': [
+            {'PutRequest': {'Item': self.item(i)}} for i in range(10)]})
+        self.assertEqual(len(response['UnprocessedItems']['widgets']), 5)
+        self.assertEqual(client.limiter.rate, 500)
+
+
+    def test_run_against_a_table_with_little_capacity(self):
+        source = LocalS3()
+        source.create_bucket(Bucket='requests')
+        for i in range(100):
+            source.put_object(Bucket='requests', Key=str(1000 + i), Body=json.dumps(
+                {'type': 'create', 'requestId': str(i), 'widgetId': f"w{i}", 'owner': 'Sue Smith',
+                 'label': 'L', 'description': 'D', 'otherAttributes': []}))
+        dynamo = LocalDynamoDB(capacity=200)
+        dest = ThrottledClient(dynamo, AdaptiveLimiter(400, concurrency=4))
+        consumer.run(source, 'requests', dest, 'widgets', workers=4, empty_polls=2, poll_interval=0)
+        # without the limiter requests are given up on after three throttled writes
+        self.assertEqual(len(dynamo.tables['widgets']), 100)
+        self.assertEqual(source.buckets['requests'], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import os
+import tempfile
+import unittest
+
+from localBackends import LocalServiceError
+from utils import error_code, replace_file
+
+"""
+Tests for the shared helpers
+"""
+class TestUtils(unittest.TestCase):
+    def test_error_code(self):
+        self.assertEqual(error_code(LocalServiceError('NoSuchKey', 'get_object')), 'NoSuchKey')
+        self.assertIsNone(error_code(ValueError('not a service error')))
+
+
+    def test_replace_file_leaves_no_temporary_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'progress.json')
+            replace_file(path, 'first')
+            replace_file(path, 'second', sync=True)
+            with open(path) as f:
+                self.assertEqual(f.read(), 'second')
+            self.assertEqual(os.listdir(tmp), ['progress.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
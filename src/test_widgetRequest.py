@@ -0,0 +1,56 @@
+import copy
+import sys
+import unittest
+
+import requestTransformer
+from benchmark import load_sample_requests
+from widgetRequest import WidgetRequest
+
+"""
+A WidgetRequest has to read exactly like the decoded dict it was made from
+"""
+class TestWidgetRequest(unittest.TestCase):
+    def setUp(self):
+        self.samples = load_sample_requests()
+
+
+    def test_reads_like_the_dict(self):
+        for request in self.samples:
+            compact = WidgetRequest.from_dict(copy.deepcopy(request))
+            self.assertEqual(compact, request)
+            self.assertEqual(list(compact.items()), list(request.items()))
+            self.assertEqual(compact.to_dict(), request)
+            self.assertEqual(compact.get('missing', 'x'), 'x')
+            self.assertNotIn('missing', compact)
+
+
+    def test_transformer_gives_the_same_output(self):
+        for request in self.samples:
+            compact = WidgetRequest.from_dict(copy.deepcopy(request))
+            self.assertEqual(requestTransformer.to_s3_object(compact), requestTransformer.to_s3_object(request))
+            self.assertEqual(requestTransformer.to_dynamo_item(compact), requestTransformer.to_dynamo_item(request))
+            if request.get('type') == 'update':
+                self.assertEqual(requestTransformer.to_dynamo_update(compact), requestTransformer.to_dynamo_update(request))
+
+
+    def test_repeated_strings_are_shared(self):
+        first = WidgetRequest.from_dict({'type': ''.join(['cre', 'ate']), 'owner': ''.join(['Sue ', 'Smith']),
+                                         'otherAttributes': [{'name': ''.join(['co', 'lor']), 'value': ''.join(['r', 'ed'])}]})
+        second = WidgetRequest.from_dict({'type': 'create', 'owner': 'Sue Smith',
+                                          'otherAttributes': [{'name': 'color', 'value': 'red'}]})
+        self.assertIs(first.shape, second.shape)
+        self.assertIs(first['type'], second['type'])
+        self.assertIs(first['owner'], sys.intern('Sue Smith'))
+        self.assertIs(first.data[2][0][0], second.data[2][0][0])
+        self.assertIs(first.data[2][0][1], second.data[2][0][1])
+
+
+    def test_unusual_attributes_are_kept(self):
+        attributes = [{'name': 'color', 'value': 'red', 'extra': 1}]
+        compact = WidgetRequest.from_dict({'widgetId': 'w', 'otherAttributes': attributes})
+        self.assertEqual(compact['otherAttributes'], attributes)
+        self.assertEqual(WidgetRequest.from_dict('not a request'), 'not a request')
+
+
+if __name__ == '__main__':
+    unittest.main()
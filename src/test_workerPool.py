@@ -0,0 +1,63 @@
+import threading
+import time
+import unittest
+
+import consumer
+from benchmark import seed_bucket, synthetic_requests
+from localBackends import LocalDynamoDB, LocalS3
+from workerPool import KeyedWorkerPool
+
+"""
+Tests for the keyed worker pool and the worker version of run
+"""
+class TestKeyedWorkerPool(unittest.TestCase):
+    def test_same_key_runs_in_order(self):
+        pool = KeyedWorkerPool(4)
+        seen = {}
+        lock = threading.Lock()
+
+        def record(key, i):
+            time.sleep(0.001 * (i % 3))
+            with lock:
+                seen.setdefault(key, []).append(i)
+
+        for i in range(60):
+            pool.submit(i % 5, record, i % 5, i)
+        pool.join()
+        pool.close()
+
+        for key, order in seen.items():
+            self.assertEqual(order, sorted(order))
+        self.assertEqual(sum(len(order) for order in seen.values()), 60)
+
+
+    def test_errors_are_counted_not_raised(self):
+        pool = KeyedWorkerPool(2)
+
+        def fail():
+            raise ValueError("bad request")
+
+        pool.submit('a', fail)
+        pool.submit('a', fail)
+        pool.join()
+        pool.close()
+        self.assertEqual(pool.errors, 2)
+
+
+    def test_run_with_workers_matches_serial_run(self):
+        requests = synthetic_requests(300, widgets=20)
+        results = []
+        for workers in (1, 8):
+            source = LocalS3()
+            seed_bucket(source, 'requests', requests)
+            dest = LocalDynamoDB()
+            dest.create_table(TableName='widgets')
+            consumer.run(source, 'requests', dest, 'widgets',
+                         workers=workers, empty_polls=1, poll_interval=0)
+            self.assertEqual(source.buckets['requests'], {})
+            results.append(dest.tables['widgets'])
+        self.assertEqual(results[0], results[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import json
+import os
+import tempfile
+import unittest
+
+import consumer
+import writeCache
+from localBackends import LocalDynamoDB, LocalS3, LocalServiceError
+from writeCache import WriteCache
+
+"""
+Tests for skipping destination writes that change nothing
+"""
+class TestWriteCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dynamo = LocalDynamoDB()
+
+
+    def tearDown(self):
+        writeCache.close_cache()
+        self.tmp.cleanup()
+
+
+    def item(self, widgetId, description):
+        return {'id': {'S': widgetId}, 'description': {'S': description}}
+
+
+    def test_skips_repeated_writes(self):
+        cache = WriteCache(self.dynamo)
+        cache.put_item(TableName='widgets', Item=self.item('w1', 'a'))
+        cache.put_item(TableName='widgets', Item=self.item('w1', 'a'))
+        cache.put_item(TableName='widgets', Item=self.item('w2', 'a'))
+        cache.put_item(TableName='widgets', Item=self.item('w1', 'b'))
+        self.assertEqual(self.dynamo.calls['put_item'], 3)
+        cache.delete_item(TableName='widgets', Key={'id': {'S': 'w1'}})
+        cache.delete_item(TableName='widgets', Key={'id': {'S': 'w1'}})
+        self.assertEqual(self.dynamo.calls['delete_item'], 1)
+        # a put after the delete has to be written again
+        cache.put_item(TableName='widgets', Item=self.item('w1', 'b'))
+        self.assertEqual(self.dynamo.calls['put_item'], 4)
+
+
+    def test_failed_write_is_forgotten(self):
+        cache = WriteCache(self.dynamo)
+        cache.put_item(TableName='widgets', Item=self.item('w1', 'a'))
+        self.dynamo.fail_next('put_item', 1)
+        self.assertRaises(LocalServiceError, cache.put_item, TableName='widgets', Item=self.item('w1', 'b'))
+        cache.put_item(TableName='widgets', Item=self.item('w1', 'a'))
+        self.assertEqual(self.dynamo.calls['put_item'], 3)
+
+
+    def test_unprocessed_items_are_not_remembered(self):
+        dynamo = LocalDynamoDB(capacity=2)
+        cache = WriteCache(dynamo)
+        batch = {'widgets': [{'PutRequest': {'Item': self.item(f"w{i}", 'a')}} for i in range(4)]}
+        response = cache.batch_write_item(RequestItems=batch)
+        self.assertEqual(len(response['UnprocessedItems']['widgets']), 2)
+        dynamo.capacity = None
+        cache.batch_write_item(RequestItems=batch)
+        self.assertEqual(dynamo.calls['batch_write_item'], 2)
+        self.assertEqual(len(dynamo.tables['widgets']), 4)
+        # every item is known now, nothing is sent
+        cache.batch_write_item(RequestItems=batch)
+        self.assertEqual(dynamo.calls['batch_write_item'], 2)
+
+
+    def test_warm_start_from_the_file(self):
+        path = os.path.join(self.tmp.name, 'journal.writes')
+        s3 = LocalS3()
+        s3.create_bucket(Bucket='web')
+        cache = writeCache.open_cache(s3, path)
+        cache.put_object(Bucket='web', Key='widgets/sue/w1', Body='{"id": "w1"}')
+        consumer.flush_destination(cache, close=True)
+
+        cache = writeCache.open_cache(s3, path)
+        cache.put_object(Bucket='web', Key='widgets/sue/w1', Body=b'{"id": "w1"}')
+        self.assertEqual(s3.calls['put_object'], 1)
+
+
+    def test_repeated_updates_are_not_written(self):
+        source = LocalS3()
+        source.create_bucket(Bucket='requests')
+        request = {'type': 'create', 'requestId': 'r0', 'widgetId': 'w1', 'owner': 'Sue Smith',
+                   'label': 'L', 'description': 'D', 'otherAttributes': [{'name': 'color', 'value': 'red'}]}
+        source.put_object(Bucket='requests', Key='1000', Body=json.dumps(request))
+        for i in range(1, 6):
+            update = dict(request, type='update', requestId=f"r{i}", description='D' if i < 4 else 'E')
+            source.put_object(Bucket='requests', Key=str(1000 + i), Body=json.dumps(update))
+        consumer.run(source, 'requests', WriteCache(self.dynamo), 'widgets', empty_polls=1, poll_interval=0)
+        # the first update and the one that changes the description
+        self.assertEqual(self.dynamo.calls['update_item'], 2)
+        self.assertEqual(self.dynamo.tables['widgets']['w1']['description'], {'S': 'E'})
+        self.assertEqual(source.buckets['requests'], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+"""
+Adaptive rate control for destination writes.
+
+AdaptiveLimiter is a token bucket in capacity units per second with a cap
+on the calls in flight, both adjusted AIMD style. Until the first throttle
+the rate doubles about every second the bucket holds writes back, after
+it every such second adds increase times the rate the table last pushed
+back at. A throttle halves the rate and the cap, at most once per
+cooldown so the writes already in flight when the table pushed back do
+not halve it again. Over a run the rate settles just under what the
+table can actually take.
+
+ThrottledClient puts a limiter in front of a DynamoDB or S3 client. Write
+calls wait for the limiter, DynamoDB writes ask for ConsumedCapacity so a
+call is charged what it really used, and throttled calls are retried with
+jittered backoff instead of failing the request. Other calls pass through.
+"""
+import logging
+import random
+import threading
+import time
+
+from metrics import metrics
+from utils import error_code
+
+THROTTLE_CODES = frozenset((
+    'ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded',
+    'Throttling', 'TooManyRequestsException', 'SlowDown', 'ServiceUnavailable',
+))
+
+# calls that write, and how many items each one carries
+WRITE_CALLS = {
+    'put_item': lambda params: 1,
+    'update_item': lambda params: 1,
+    'delete_item': lambda params: 1,
+    'batch_write_item': lambda params: sum(len(items) for items in params['RequestItems'].values()),
+    'put_object': lambda params: 1,
+    'delete_object': lambda params: 1,
+    'delete_objects': lambda params: len(params['Delete']['Objects']),
+}
+DYNAMO_CALLS = frozenset(('put_item', 'update_item', 'delete_item', 'batch_write_item'))
+
+
+class AdaptiveLimiter():
+    def __init__(self, rate=100.0, min_rate=1.0, max_rate=None, concurrency=32, max_concurrency=None,
+                 increase=0.05, decrease=0.5, cooldown=1.0):
+        self.rate = float(rate) # capacity units per second
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.concurrency = concurrency # calls allowed in flight
+        self.max_concurrency = max_concurrency or concurrency * 4
+        self.increase = increase # share of the last throttled rate added per second of limited writes
+        self.ceiling = None # rate at the last throttle, None until the first one
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.cond = threading.Condition()
+        self.tokens = self.rate
+        self.refilled = time.monotonic()
+        self.lastDecrease = 0.0
+        self.inflight = 0
+        self.limited = False # the bucket made a caller wait since the last increase
+        self.unitCost = 1.0 # average capacity units per item, from ConsumedCapacity
+
+
+    """
+    Wait for room for a call carrying items, returns the units it was charged
+    """
+    def acquire(self, items=1):
+        with self.cond:
+            while self.inflight >= self.concurrency:
+                self.limited = True
+                self.cond.wait()
+            self.inflight += 1
+            cost = items * self.unitCost
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate) - cost
+            self.refilled = now
+            # the bucket can go into debt, the caller waits until it is paid off
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            if wait:
+                self.limited = True
+        if wait:
+            time.sleep(wait)
+        return cost
+
+
+    """
+    A call finished. consumed is the capacity it really used, when the
+    service said so, the difference to what it was charged is settled
+    """
+    def release(self, items, charged, consumed=None):
+        with self.cond:
+            self.inflight -= 1
+            if consumed is not None:
+                self.tokens -= consumed - charged
+                if items:
+                    self.unitCost = max(0.5, 0.9 * self.unitCost + 0.1 * consumed / items)
+            self.cond.notify()
+
+
+    """
+    A call went through, grow the rate and the in flight cap if they held the writes back
+    """
+    def succeeded(self, items=1):
+        with self.cond:
+            if not self.limited:
+                return
+            # the units of this call as a share of a second's worth of writes
+            share = items * self.unitCost / self.rate
+            step = self.rate if self.ceiling is None else max(1.0, self.increase * self.ceiling)
+            self.rate += step * share
+            if self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+            if self.concurrency < self.max_concurrency and random.random() < 1 / self.concurrency:
+                self.concurrency += 1
+                self.cond.notify()
+            self.limited = False
+
+
+    """
+    The service pushed back, halve the rate and the in flight cap
+    """
+    def throttled(self):
+        with self.cond:
+            now = time.monotonic()
+            if now - self.lastDecrease < self.cooldown:
+                return
+            self.lastDecrease = now
+            self.ceiling = self.rate
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, 0)
+            self.concurrency = max(1, int(self.concurrency * self.decrease))
+            logging.info(f"Throttled, writing at {self.rate:.1f} units/s with {self.concurrency} calls in flight")
+
+
+class ThrottledClient():
+    def __init__(self, client, limiter=None, max_retries=8, backoff=0.05):
+        self.client = client
+        self.limiter = limiter or AdaptiveLimiter()
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name not in WRITE_CALLS:
+            return attribute
+        return lambda **params: self._write(name, attribute, params)
+
+
+    def _write(self, name, call, params):
+        items = WRITE_CALLS[name](params)
+        if name in DYNAMO_CALLS:
+            params.setdefault('ReturnConsumedCapacity', 'TOTAL')
+        for attempt in range(self.max_retries + 1):
+            charged = self.limiter.acquire(items)
+            try:
+                response = call(**params)
+            except Exception as e:
+                self.limiter.release(items, charged)
+                if error_code(e) not in THROTTLE_CODES or attempt == self.max_retries:
+                    raise
+                metrics.inc('throttled', call=name)
+                self.limiter.throttled()
+                time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+                continue
+
+            self.limiter.release(items, charged, _consumed_units(response))
+            unprocessed = sum(len(requests) for requests in (response.get('UnprocessedItems') or {}).values())
+            if unprocessed:
+                # the batch writer retries these itself, the rate still has to come down
+                metrics.inc('throttled', call=name)
+                self.limiter.throttled()
+            else:
+                self.limiter.succeeded(items)
+            return response
+
+
+def _consumed_units(response):
+    consumed = response.get('ConsumedCapacity')
+    if consumed is None:
+        return None
+    if isinstance(consumed, list):
+        return sum(entry.get('CapacityUnits', 0) for entry in consumed)
+    return consumed.get('CapacityUnits', 0)
@@ -0,0 +1,29 @@
+"""
+Helpers shared by several of the consumer's modules
+"""
+import os
+
+
+"""
+The error code of a boto3 ClientError or a localBackends error, None for
+any other exception
+"""
+def error_code(error):
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code')
+
+
+"""
+Replace a file's contents with text. It is written next to the file and
+renamed over it, so a reader or a crash never sees half a file. The
+temporary name carries the process id, so processes sharing the file do
+not write into each other's copy. sync waits for it to reach the disk
+"""
+def replace_file(path, text, sync=False):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
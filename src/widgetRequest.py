@@ -0,0 +1,129 @@
+"""
+Compact in-memory form of a decoded widget request.
+
+A decoded request is a dict, and each of its otherAttributes is another
+dict, a few hundred bytes of overhead per request before any of the data.
+WidgetRequest keeps the values in one tuple next to a field name tuple
+that is shared by every request with the same fields, stores
+otherAttributes as (name, value) pairs and interns the request type,
+owner, attribute names and short attribute values, which repeat across
+requests.
+
+It is a read-only Mapping, so the create/update/delete handlers, the
+transformer, the coalescer and the checkpoint read it like the dict it
+was made from. request['otherAttributes'] and items() hand out the
+attributes as fresh {'name', 'value'} dicts.
+"""
+import sys
+from collections.abc import Mapping
+from functools import lru_cache
+
+INTERNED_FIELDS = frozenset(('type', 'owner'))
+INTERN_MAX_LENGTH = 32 # attribute values up to this long are interned, units, colors and the like
+
+
+class Shape():
+    """
+    The field names of a request in their original order, shared by every
+    request that has the same fields
+    """
+    __slots__ = ('names', 'index')
+
+    def __init__(self, names):
+        self.names = names
+        self.index = {name: position for position, name in enumerate(names)}
+
+
+@lru_cache(maxsize=1024)
+def shape_of(names):
+    return Shape(tuple(sys.intern(name) for name in names))
+
+
+class WidgetRequest(Mapping):
+    __slots__ = ('shape', 'data')
+
+    def __init__(self, shape, data):
+        self.shape = shape
+        self.data = data # the values, in shape order
+
+
+    """
+    Build from a decoded request, requests that are not dicts are returned as they are
+    """
+    @classmethod
+    def from_dict(cls, request):
+        if not isinstance(request, dict):
+            return request
+        values = []
+        for name, value in request.items():
+            if name == 'otherAttributes':
+                value = _pack_attributes(value)
+            elif name in INTERNED_FIELDS and isinstance(value, str):
+                value = sys.intern(value)
+            values.append(value)
+        return cls(shape_of(tuple(request)), tuple(values))
+
+
+    def __getitem__(self, name):
+        value = self.data[self.shape.index[name]]
+        if name == 'otherAttributes':
+            return _unpack_attributes(value)
+        return value
+
+
+    def get(self, name, default=None):
+        position = self.shape.index.get(name)
+        if position is None:
+            return default
+        return self[name]
+
+
+    def __contains__(self, name):
+        return name in self.shape.index
+
+
+    def __iter__(self):
+        return iter(self.shape.names)
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    def items(self):
+        for name, value in zip(self.shape.names, self.data):
+            yield name, _unpack_attributes(value) if name == 'otherAttributes' else value
+
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+    def __repr__(self):
+        return f"WidgetRequest({self.to_dict()!r})"
+
+
+"""
+otherAttributes as a tuple of (name, value) pairs. Lists with anything
+but {'name', 'value'} dicts are kept as they are, nothing is lost
+"""
+def _pack_attributes(attributes):
+    if not isinstance(attributes, list):
+        return attributes
+    pairs = []
+    for attribute in attributes:
+        if not isinstance(attribute, dict) or len(attribute) != 2 or 'name' not in attribute or 'value' not in attribute:
+            return attributes
+        name, value = attribute['name'], attribute['value']
+        if isinstance(name, str):
+            name = sys.intern(name)
+        if isinstance(value, str) and len(value) <= INTERN_MAX_LENGTH:
+            value = sys.intern(value)
+        pairs.append((name, value))
+    return tuple(pairs)
+
+
+def _unpack_attributes(value):
+    if isinstance(value, tuple):
+        return [{'name': name, 'value': attributeValue} for name, attributeValue in value]
+    return value
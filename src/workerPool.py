@@ -0,0 +1,105 @@
+import logging
+import queue
+import threading
+import zlib
+
+
+class KeyedWorkerPool():
+    """
+    A bounded pool of worker threads. Every task is submitted with a key and
+    tasks with the same key always run on the same worker, one after another,
+    so they are applied in the order they were submitted.
+    """
+    def __init__(self, workers, queue_size=100):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.errors = 0
+        self.errorLock = threading.Lock()
+        self.lanes = []
+        self.threads = []
+        self._start(workers)
+
+
+    def _start(self, workers):
+        for _ in range(workers):
+            lane = queue.Queue(maxsize=self.queue_size)
+            thread = threading.Thread(target=self._work, args=(lane,), daemon=True)
+            thread.start()
+            self.lanes.append(lane)
+            self.threads.append(thread)
+
+
+    """
+    Change the number of workers. Waits for the queued work first, keys map
+    to different workers afterwards so nothing may be left in a lane
+    """
+    def resize(self, workers):
+        if workers == self.workers:
+            return
+        self.join()
+        if workers > self.workers:
+            self._start(workers - self.workers)
+        else:
+            for lane in self.lanes[workers:]:
+                lane.put(None)
+            for thread in self.threads[workers:]:
+                thread.join()
+            del self.lanes[workers:]
+            del self.threads[workers:]
+        self.workers = workers
+
+
+    """
+    Pick the worker for a key. crc32 keeps the choice stable between runs
+    """
+    def laneFor(self, key):
+        return zlib.crc32(str(key).encode('utf-8')) % self.workers
+
+
+    """
+    Queue fn(*args) on the key's worker, blocks if that worker is full
+    """
+    def submit(self, key, fn, *args):
+        self.lanes[self.laneFor(key)].put((key, fn, args))
+
+
+    """
+    Tasks submitted and not finished yet, queued or running
+    """
+    def pending(self):
+        return sum(lane.unfinished_tasks for lane in self.lanes)
+
+
+    """
+    Wait until every submitted task has finished
+    """
+    def join(self):
+        for lane in self.lanes:
+            lane.join()
+
+
+    """
+    Finish the queued work and stop the worker threads
+    """
+    def close(self):
+        for lane in self.lanes:
+            lane.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+    def _work(self, lane):
+        while True:
+            task = lane.get()
+            if task is None:
+                lane.task_done()
+                break
+            key, fn, args = task
+            try:
+                fn(*args)
+            except Exception as e:
+                with self.errorLock:
+                    self.errors += 1
+                logging.error(f"Error processing request for {key}: {e}")
+            finally:
+                lane.task_done()
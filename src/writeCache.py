@@ -0,0 +1,179 @@
+"""
+Skip destination writes that would not change anything.
+
+WriteCache wraps the DynamoDB or S3 client and remembers a digest of the
+last write made to each widget, keyed by table and id or by bucket and
+object key. A put whose item or body hashes the same as the widget's last
+put, an update_item with the same assignments as its last update, or a
+delete of a widget that was just deleted is not sent, it is counted as
+writes_skipped. Puts and deletes inside a BatchWriteItem are checked one
+by one.
+
+It sits directly on the client, under the batch writer, so a digest is
+only remembered once the call that made the write has returned, and
+never for UnprocessedItems. A failed call forgets the widget, the state
+it left behind is unknown.
+
+The digests are held in a bounded CheckpointJournal, in memory or in a
+file next to the checkpoint, committed with it in flush_destination so a
+restart starts warm. The cache assumes this consumer is the only writer
+of its widgets, a change made by anyone else is not seen.
+"""
+import hashlib
+
+from checkpoint import CheckpointJournal
+from metrics import metrics
+
+DELETED = 'deleted'
+
+
+class WriteCache():
+    def __init__(self, client, journal=None, capacity=100000):
+        self.client = client
+        self.journal = journal if journal is not None else CheckpointJournal(None, capacity)
+
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+    def put_item(self, **params):
+        return self._write('put_item', _table_key(params['TableName'], params['Item']),
+                           _digest('put', params['Item']), params)
+
+
+    def update_item(self, **params):
+        key = _table_key(params['TableName'], params['Key'])
+        if 'ConditionExpression' in params:
+            key = None
+        digest = _digest('update', params.get('UpdateExpression'), params.get('ExpressionAttributeNames'),
+                         params.get('ExpressionAttributeValues'))
+        return self._write('update_item', key, digest, params)
+
+
+    def delete_item(self, **params):
+        return self._write('delete_item', _table_key(params['TableName'], params['Key']), DELETED, params)
+
+
+    def put_object(self, **params):
+        key = None if len(params) > 3 else f"{params['Bucket']}/{params['Key']}"
+        body = params['Body']
+        return self._write('put_object', key, _digest_bytes(body.encode('utf-8') if isinstance(body, str) else body),
+                           params)
+
+
+    def delete_object(self, **params):
+        key = None if len(params) > 2 else f"{params['Bucket']}/{params['Key']}"
+        return self._write('delete_object', key, DELETED, params)
+
+
+    """
+    Drop the puts and deletes that change nothing, send the rest and
+    remember the ones DynamoDB did not hand back
+    """
+    def batch_write_item(self, **params):
+        requestItems = {}
+        written = []
+        skipped = 0
+        for table, requests in params['RequestItems'].items():
+            kept = []
+            for request in requests:
+                if 'PutRequest' in request:
+                    key = _table_key(table, request['PutRequest']['Item'])
+                    digest = _digest('put', request['PutRequest']['Item'])
+                else:
+                    key = _table_key(table, request['DeleteRequest']['Key'])
+                    digest = DELETED
+                if key is not None and self.journal.get(key) == digest:
+                    skipped += 1
+                    continue
+                kept.append(request)
+                written.append((key, digest, table, request))
+            if kept:
+                requestItems[table] = kept
+        if skipped:
+            metrics.inc('writes_skipped', skipped, call='batch_write_item')
+        if not requestItems:
+            return {'UnprocessedItems': {}}
+
+        try:
+            response = self.client.batch_write_item(**dict(params, RequestItems=requestItems))
+        except Exception:
+            for key, digest, table, request in written:
+                self._forget(key)
+            raise
+        unprocessed = response.get('UnprocessedItems') or {}
+        for key, digest, table, request in written:
+            if key is None:
+                continue
+            if request in unprocessed.get(table, ()):
+                self._forget(key)
+            else:
+                self.journal.record(key, digest)
+        return response
+
+
+    def _write(self, name, key, digest, params):
+        if key is not None and self.journal.get(key) == digest:
+            metrics.inc('writes_skipped', call=name)
+            return {}
+        try:
+            response = getattr(self.client, name)(**params)
+        except Exception:
+            self._forget(key)
+            raise
+        if key is not None:
+            self.journal.record(key, digest)
+        return response
+
+
+    def _forget(self, key):
+        if key is not None and self.journal.get(key) is not None:
+            self.journal.record(key)
+
+
+    """
+    Write the digests recorded since the last commit, called with the checkpoint commit
+    """
+    def commit(self):
+        self.journal.commit()
+
+
+    def close(self):
+        self.journal.close()
+
+
+def _table_key(table, item):
+    key = item.get('id')
+    if not isinstance(key, dict) or 'S' not in key:
+        return None
+    return f"{table}/{key['S']}"
+
+
+def _digest(*payload):
+    return _digest_bytes(repr(payload).encode('utf-8'))
+
+
+def _digest_bytes(data):
+    return hashlib.blake2b(data, digest_size=12).hexdigest()
+
+
+# the write cache flush_destination commits, None when it is off
+cache = None
+
+
+"""
+Wrap the destination client in the process wide write cache. With a path
+the digests are kept in that file and read back on the next start
+"""
+def open_cache(client, path=None, capacity=100000):
+    global cache
+    cache = WriteCache(client, CheckpointJournal(path, capacity, sync=False) if path else None, capacity)
+    return cache
+
+
+def close_cache():
+    global cache
+    if cache is not None:
+        cache.close()
+        cache = None